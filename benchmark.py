@@ -0,0 +1,1341 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import server
+from chatclient import connect_many
+from cluster import join_cluster, node_will
+from compression import COMPRESS_THRESHOLD, Compressor, Decompressor
+from connection import PROMPT_TIMEOUT, Connection
+from metrics import metrics
+from presence import PRESENCE_WINDOW, Presence
+from protocol import HELLO, KIND_PING, KIND_PONG, KIND_SESSION, KIND_TEXT, FrameDecoder, encode_frame, frame_header
+from pubsub import LocalBroker
+from ratelimit import RateLimiter
+from state import GroupStore, UserRegistry
+from storage import GroupLog
+
+
+# Connection that keeps whatever it is given, like a user whose writer has not
+# caught up yet, so queued bytes show up in the allocation count
+class QueueingConnection(Connection):
+    def __init__(self, framed, prompt_timeout=PROMPT_TIMEOUT):
+        super().__init__(prompt_timeout=prompt_timeout)
+        self.framed = framed
+
+    def write(self, data):
+        self.outbox.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+# Function with the old fan-out, which formatted and encoded per recipient
+def broadcast_per_recipient(message, sender_socket, user_names):
+    for user in user_names.all_connections():
+        if user is not sender_socket:
+            user.sendall(f"[{user_names[sender_socket]}]: {message}".encode('utf-8'))
+
+
+# Function to measure bytes allocated and time taken by one broadcast
+def measure_fanout(broadcast, recipients, message_size, rounds):
+    connections = [QueueingConnection(framed=index % 2 == 0) for index in range(recipients + 1)]
+    sender = connections[0]
+    user_names = UserRegistry()
+    for index, connection in enumerate(connections):
+        user_names.claim(f"user{index}", connection)
+    message = "x" * message_size
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    broadcast(message, sender, user_names)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for connection in connections:
+            connection.outbox.clear()
+        broadcast(message, sender, user_names)
+    elapsed = (time.perf_counter() - started) / rounds
+
+    return {"bytes_per_broadcast": allocated, "seconds_per_broadcast": elapsed}
+
+
+# Function to compare per-recipient encoding with encode-once fan-out
+def run_fanout(args):
+    return {
+        "benchmark": "fanout",
+        "recipients": args.recipients,
+        "message_bytes": args.message_size,
+        "per_recipient": measure_fanout(broadcast_per_recipient, args.recipients, args.message_size, args.rounds),
+        "encode_once": measure_fanout(server.broadcast, args.recipients, args.message_size, args.rounds),
+    }
+
+
+# Function to make a message that reads like a pasted log, the kind of
+# large message compression is for
+def pasted_log(size):
+    generator = random.Random(size)
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(f"2026-10-18 12:{generator.randrange(60):02d}:{generator.randrange(60):02d} "
+                     f"{generator.choice(('INFO', 'INFO', 'INFO', 'WARNING', 'ERROR'))} worker-{generator.randrange(8)} "
+                     f"handled GET /api/items/{generator.randrange(100000)} in {generator.randrange(1, 500)} ms")
+    return "\n".join(lines)[:size]
+
+
+# Function to measure the bytes queued per recipient and the time taken by
+# broadcasts to recipients that take compressed messages at the given level
+# (None for none), compressing once per fan-out or once per recipient. Also
+# times inflating one message, as each client does.
+def measure_compression(level, once, args):
+    connections = [QueueingConnection(framed=True) for _ in range(args.recipients + 1)]
+    user_names = UserRegistry()
+    for index, connection in enumerate(connections):
+        user_names.claim(f"user{index}", connection)
+        if level is not None:
+            connection.compressor = Compressor(args.threshold, level)
+            connection.decompressor = Decompressor(args.message_size * 2)
+    message = pasted_log(args.message_size)
+    broadcast = server.broadcast if once else broadcast_per_recipient
+
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for connection in connections:
+            connection.outbox.clear()
+        broadcast(message, connections[0], user_names)
+    elapsed = (time.perf_counter() - started) / args.rounds
+
+    frame = connections[1].outbox[0]
+    inflate_seconds = None
+    if level is not None:
+        payload = frame[frame_header.size:]
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            connections[1].decompressor.decompress(payload)
+        inflate_seconds = (time.perf_counter() - started) / args.rounds
+    return {
+        "level": level,
+        "compress": "off" if level is None else "once per fan-out" if once else "per recipient",
+        "bytes_per_recipient": len(frame),
+        "bytes_per_broadcast": len(frame) * args.recipients,
+        "seconds_per_broadcast": elapsed,
+        "client_inflate_seconds": inflate_seconds,
+    }
+
+
+# Function to compare compression levels, and compressing once per fan-out
+# with compressing for each recipient
+def run_compression(args):
+    runs = [measure_compression(None, True, args)]
+    runs += [measure_compression(level, True, args) for level in args.levels]
+    runs.append(measure_compression(args.levels[-1], False, args))
+    uncompressed = runs[0]["bytes_per_recipient"]
+    for run in runs:
+        run["ratio"] = run["bytes_per_recipient"] / uncompressed
+    return {
+        "benchmark": "compression",
+        "recipients": args.recipients,
+        "message_bytes": args.message_size,
+        "runs": runs,
+        "ok": all(run["bytes_per_recipient"] < uncompressed for run in runs[1:]),
+    }
+
+
+# Connection that keeps what it is given in its outbound queue, as the
+# engines' connections do
+class MeteredConnection(QueueingConnection):
+    def write(self, data):
+        self.enqueue(data)
+
+
+# Function to time process_message on one kind of message, sent by the
+# first of recipients + 1 users
+def measure_messages(message, recipients, rounds):
+    connections = [MeteredConnection(framed=True) for index in range(recipients + 1)]
+    user_names = UserRegistry()
+    for index, connection in enumerate(connections):
+        user_names.claim(f"user{index}", connection)
+    groups = GroupStore()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for connection in connections:
+            connection.outbox.clear()
+        server.process_message(message, connections[0], user_names, groups)
+    return (time.perf_counter() - started) / rounds
+
+
+# Function to compare the cost of messages with metrics on and off
+def run_metrics(args):
+    results = {}
+    for name, message in (("broadcast", "hello"), ("personal", "@user1 hello"), ("names", "@names")):
+        enabled = measure_messages(message, args.recipients, args.rounds)
+        metrics.enabled = False
+        try:
+            disabled = measure_messages(message, args.recipients, args.rounds)
+        finally:
+            metrics.enabled = True
+        results[name] = {
+            "seconds_per_message_enabled": enabled,
+            "seconds_per_message_disabled": disabled,
+            "overhead": enabled / disabled - 1,
+        }
+    return {"benchmark": "metrics", "recipients": args.recipients, "messages": results}
+
+
+# Function with the old dispatch, up to the handler: split to find the
+# command, split again as the handler did, and a chain of startswith checks
+# for everything else
+def dispatch_the_old_way(message):
+    parts = message.split(' ', 2)
+    command = parts[0]
+    if command == "@group" and len(parts) > 1:
+        command = " ".join(parts[:2])
+    if command.startswith("@group "):
+        if command not in server.commands:
+            return "invalid", None
+        parts = message.split()[2:]
+        if command == "@group send":
+            return command, (parts[0], ' '.join(parts[1:]))
+        if command in ("@group set", "@group add", "@group remove", "@group authorize"):
+            return command, (parts[0], [member.strip() for member in ''.join(parts[1:]).split(',')])
+        return command, parts
+    if command in server.commands:
+        return command, message.split()
+    if message.startswith("@") and not message.startswith("@group"):
+        space_index = message.find(' ')
+        if space_index == -1:
+            space_index = len(message)
+        return "personal", (message[1:space_index], message[space_index:].strip())
+    return "broadcast", message
+
+
+# Function with the table-driven dispatch, up to the handler
+def dispatch_with_table(message):
+    if not message.startswith("@"):
+        return "broadcast", message
+    command, rest, partial = server.command_table.lookup(message)
+    if command is None:
+        return ("invalid", None) if partial else ("personal", message[1:].partition(' '))
+    return command.name, command.parse(rest)
+
+
+# Function to time finding and parsing the command of each kind of message
+def run_dispatch(args):
+    text = "x" * args.message_size
+    samples = {
+        "broadcast": f"hello {text}",
+        "personal": f"@bob hello {text}",
+        "group_send": f"@group send team hello {text}",
+        "group_add": "@group add team alice, bob, carol",
+        "names": "@names",
+    }
+    results = {}
+    for kind, message in samples.items():
+        results[kind] = {}
+        for name, dispatch in (("old", dispatch_the_old_way), ("table", dispatch_with_table)):
+            started = time.perf_counter()
+            for _ in range(args.rounds):
+                dispatch(message)
+            results[kind][f"seconds_per_message_{name}"] = (time.perf_counter() - started) / args.rounds
+    return {"benchmark": "dispatch", "message_bytes": args.message_size, "messages": results}
+
+
+# Function to log as many users in as a storm as are connected already, with
+# presence changes gathered over a window, and count the notices queued for
+# the users who were there and the time until the last one was sent
+def measure_presence(clients, window):
+    connections = [QueueingConnection(framed=True) for _ in range(clients * 2)]
+    user_names = UserRegistry()
+    for index, connection in enumerate(connections[:clients]):
+        user_names.claim(f"user{index}", connection)
+    user_names.presence = feed = Presence(user_names, window)
+    started = time.perf_counter()
+    for index, connection in enumerate(connections[clients:], clients):
+        user_names.claim(f"user{index}", connection)
+    # Changes are gathered, then sent; wait for both
+    while True:
+        time.sleep(window + 0.05)
+        with feed.changes:
+            if not feed.pending:
+                break
+    queued = sum(len(connection.outbox) for connection in connections[:clients])
+    return {"window_seconds": window, "notices": queued, "notices_per_user": queued / clients,
+            "seconds": time.perf_counter() - started}
+
+
+# Function to time @names against everyone connected, and the size of the reply
+def measure_names(clients, rounds):
+    connections = [QueueingConnection(framed=True) for _ in range(clients)]
+    user_names = UserRegistry()
+    for index, connection in enumerate(connections):
+        user_names.claim(f"user{index}", connection)
+    groups = GroupStore()
+    results = {}
+    for name, handler in (("whole_list", lambda: connections[0].sendall(f"Connected users: {', '.join(user_names.usernames())}".encode('utf-8'))),
+                          ("first_page", lambda: server.process_message("@names", connections[0], user_names, groups)),
+                          ("prefix_page", lambda: server.process_message("@names user12", connections[0], user_names, groups))):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            connections[0].outbox.clear()
+            handler()
+        results[name] = {"seconds": (time.perf_counter() - started) / rounds,
+                         "reply_bytes": len(connections[0].outbox[0]) - frame_header.size}
+    return results
+
+
+# Function to compare the old join notice per login (one message to every
+# other user each time) with notices gathered over a window, and whole user
+# lists with pages of them
+def run_presence(args):
+    return {
+        "benchmark": "presence",
+        "clients": args.clients,
+        "notices_one_per_login": args.clients * args.clients,
+        "windows": [measure_presence(args.clients, window) for window in args.windows],
+        "names": measure_names(args.clients, args.rounds),
+    }
+
+
+# Log that only counts the changes it is given
+class CountingLog:
+    def __init__(self):
+        self.changes = 0
+
+    def append(self, change):
+        self.changes += 1
+
+
+# Function to provision a group of members, a tenth of them admins, with the
+# given commands from its creator; returns the time taken, the changes made
+# to the group store and the messages queued for the users
+def measure_provision(commands, members):
+    connections = [MeteredConnection(framed=True) for _ in range(members + 1)]
+    user_names = UserRegistry()
+    for index, connection in enumerate(connections):
+        user_names.claim(f"user{index}", connection)
+    groups = GroupStore()
+    groups.log = CountingLog()
+    started = time.perf_counter()
+    for command in commands:
+        server.process_message(command, connections[0], user_names, groups)
+    elapsed = time.perf_counter() - started
+    group = groups.get("team")
+    return {
+        "commands": len(commands),
+        "seconds": elapsed,
+        "store_changes": groups.log.changes,
+        "messages_queued": sum(len(connection.outbox) for connection in connections),
+        "ok": len(group.members) == members - members // 10 and len(group.admins) == members // 10 + 1,
+    }
+
+
+# Function to compare provisioning a group a command per member with one
+# @group batch command
+def run_provision(args):
+    usernames = [f"user{index}" for index in range(1, args.members + 1)]
+    admins = usernames[::10]
+    one_by_one = ([f"@group set team {usernames[0]}"] + [f"@group add team {username}" for username in usernames[1:]] +
+                  [f"@group authorize team {username}" for username in admins])
+    batch = [f"@group batch team set {', '.join(usernames)}; authorize {', '.join(admins)}"]
+    runs = {"one_by_one": measure_provision(one_by_one, args.members), "batch": measure_provision(batch, args.members)}
+    return {"benchmark": "provision", "members": args.members, "runs": runs,
+            "ok": all(run["ok"] for run in runs.values())}
+
+
+# Function to log a worker's users in and out and run random commands as them
+def stress_worker(worker, names, own_names, user_names, groups, deadline, prompt_timeout, operations, errors, logged_in):
+    rng = random.Random(worker)
+    group_names = [f"g{index}" for index in range(8)]
+    sessions = {}  # username -> connection, for this worker's users that are logged in
+    while time.monotonic() < deadline:
+        try:
+            username = rng.choice(own_names)
+            if username not in sessions or rng.random() < 0.05:
+                # Log the user in, or out if they already are
+                user_socket = sessions.pop(username, None)
+                if user_socket is not None:
+                    logged_in.discard(username)
+                    server.cleanup_user(user_socket, user_names, groups)
+                else:
+                    user_socket = QueueingConnection(framed=True, prompt_timeout=prompt_timeout)
+                    if user_names.claim(username, user_socket):
+                        sessions[username] = user_socket
+                        if username in logged_in:
+                            errors[f"{username} logged in twice"] += 1
+                        logged_in.add(username)
+                continue
+
+            user_socket = sessions[username]
+            # Mostly pick one of the user's own groups so admin commands get through
+            own_groups = groups.groups_of(username)
+            group = rng.choice(own_groups) if own_groups and rng.random() < 0.7 else rng.choice(group_names)
+            others = ",".join(rng.sample(names, 3))
+            message = rng.choice([
+                f"@group set {group} {others}",
+                f"@group add {group} {others}",
+                f"@group remove {group} {others}",
+                f"@group authorize {group} {others}",
+                f"@group batch {group} add {rng.choice(names)}; remove {rng.choice(names)}; authorize {rng.choice(names)}",
+                f"%{operations[worker]} @group batch {group} set {others}; authorize {rng.choice(names)}",
+                f"@group send {group} hello",
+                f"@group leave {group}",
+                f"@group delete {group}",
+                f"@group members {group}",
+                "@group list",
+                "@names",
+                f"@{rng.choice(names)} hi",
+                "hello everyone",
+                # Answers to @group delete and @group leave, if one is open
+                "yes",
+                "no",
+                rng.choice(names),
+            ])
+            server.process_message(message, user_socket, user_names, groups)
+            operations[worker] += 1
+            user_socket.outbox.clear()
+        except Exception as e:
+            errors[f"{type(e).__name__}: {e}"] += 1
+
+    for username, user_socket in sessions.items():
+        logged_in.discard(username)
+        server.cleanup_user(user_socket, user_names, groups)
+
+
+# Function to list every way the registry and the group store disagree
+def check_state(user_names, groups):
+    problems = []
+    for user_socket, username in user_names.items():
+        if user_names.connection_for(username) is not user_socket:
+            problems.append(f"registry: {username} does not map back to its connection")
+    if len(user_names.connections) != len(user_names.names):
+        problems.append("registry: name and connection maps differ in size")
+    for name, group in groups.groups.items():
+        if group.members & group.admins:
+            problems.append(f"group {name}: users are both member and admin")
+        for username in group.everyone():
+            if name not in groups.memberships.get(username, ()):
+                problems.append(f"group {name}: {username} missing from the index")
+    for username, names in groups.memberships.items():
+        for name in names:
+            group = groups.get(name)
+            if group is None or username not in group:
+                problems.append(f"index: {username} listed in {name} but not a member")
+    return problems
+
+
+# Function to describe the groups of a store in a form that can be compared
+def group_state(groups):
+    return sorted([group.name, sorted(group.members), sorted(group.admins)] for group in list(groups.groups.values()))
+
+
+# Function to describe a node's state without the expiry times of its mail,
+# which each node counts from when it stored the message
+def node_state(node):
+    state = node.dump()
+    state["mail"]["boxes"] = sorted([username, [data for seconds_left, data in messages]]
+                                    for username, messages in state["mail"]["boxes"])
+    return state
+
+
+# Function to hammer the shared state from many threads and check it afterwards
+def run_stress(args):
+    logs = []
+    if args.data_dir is not None:
+        logs = [GroupLog(os.path.join(args.data_dir, str(index)), snapshot_every=args.snapshot_every)
+                for index in range(args.nodes)]
+    if args.nodes > 1:
+        # Nodes of one cluster in this process; threads on different nodes
+        # share usernames, so they race to claim them
+        broker = LocalBroker()
+        nodes = [join_cluster(broker.connect(node_will(f"n{index}")), f"n{index}", logs[index] if logs else None)
+                 for index in range(args.nodes)]
+        stores = [(user_names, groups) for node, user_names, groups in nodes]
+    else:
+        stores = [(UserRegistry(), GroupStore())]
+        if logs:
+            logs[0].restore(stores[0][1])
+    names = [f"user{index}" for index in range(args.users)]
+    rivals = -(-args.threads // len(stores))  # Threads sharing a node, each with its own names
+    operations = [0] * args.threads
+    errors = collections.Counter()
+    logged_in = set()  # Usernames some thread holds, on any node
+    deadline = time.monotonic() + args.seconds
+
+    threads = [threading.Thread(target=stress_worker,
+                                args=(worker, names, names[worker // len(stores)::rivals], *stores[worker % len(stores)],
+                                      deadline, args.prompt_timeout, operations, errors, logged_in))
+               for worker in range(args.threads)]
+    # Switch threads far more often than usual to shake out races
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    sys.setswitchinterval(switch_interval)
+    # Let question timers that already fired finish before looking at the state
+    time.sleep(args.prompt_timeout * 10)
+
+    problems = [problem for user_names, groups in stores for problem in check_state(user_names, groups)]
+    if args.nodes > 1:
+        first = node_state(nodes[0][0])
+        for node, user_names, groups in nodes[1:]:
+            if node_state(node) != first:
+                problems.append(f"node {node.node_id}: state differs from node {nodes[0][0].node_id}")
+    for index, log in enumerate(logs):
+        # What was saved must come back as it is now
+        log.close()
+        restored = GroupStore()
+        GroupLog(log.directory).load_into(restored)
+        if group_state(restored) != group_state(stores[index][1]):
+            problems.append(f"{log.directory}: restored groups differ from the live ones")
+    return {
+        "benchmark": "stress",
+        "threads": args.threads,
+        "nodes": args.nodes,
+        "operations": sum(operations),
+        "operations_per_second": sum(operations) / elapsed,
+        "errors": dict(errors),
+        "invariant_violations": problems[:20],
+        "ok": not errors and not problems,
+    }
+
+
+# Function to save a large set of groups plus a tail of changes, then time
+# how long a restart takes to restore them
+def run_restart(args):
+    rng = random.Random(0)
+    users = [f"user{index}" for index in range(args.users)]
+    with tempfile.TemporaryDirectory(prefix="chat-restart-") as directory:
+        groups = GroupStore()
+        saved = []
+        for index in range(args.groups):
+            admin, *members = rng.sample(users, args.members)
+            saved.append((f"group{index}", members, [admin]))
+        groups.load_all(saved)
+        log = GroupLog(directory, snapshot_every=args.changes + 1)
+        started = time.perf_counter()
+        log.reset(groups)
+        snapshot_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(args.changes):
+            group = groups.get(f"group{rng.randrange(args.groups)}")
+            if rng.random() < 0.5:
+                groups.add_members(group, rng.sample(users, 2))
+            else:
+                groups.remove_members(group, rng.sample(sorted(group.members), 1) if group.members else [])
+        log.close()
+        logging_seconds = time.perf_counter() - started
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        restored = GroupStore()
+        started = time.perf_counter()
+        GroupLog(directory).restore(restored)
+        restore_seconds = time.perf_counter() - started
+        restored.log.close()
+        ok = group_state(restored) == group_state(groups)
+
+    return {
+        "benchmark": "restart",
+        "groups": args.groups,
+        "changes": args.changes,
+        "bytes_on_disk": size,
+        "snapshot_seconds": snapshot_seconds,
+        "changes_logged_per_second": args.changes / logging_seconds,
+        "restore_seconds": restore_seconds,
+        "ok": ok,
+    }
+
+
+# Simulated user for the load benchmark. It logs in over the framed protocol
+# and records how long every timed message took to reach it.
+class LoadClient:
+    def __init__(self, username, latencies):
+        self.username = username
+        self.latencies = latencies  # Shared by every client of a run
+        self.decoder = FrameDecoder(16 * 1024 * 1024)
+        self.expected = {}  # Message prefix -> future resolved when such a message arrives
+        self.received = 0
+
+    async def connect(self, host, port, local_address=None):
+        await self.open(host, port, local_address)
+        welcome = self.expect("[Welcome ")
+        self.send(self.username)
+        await welcome
+
+    # Function to connect and switch to frames, without logging in
+    async def open(self, host, port, local_address=None):
+        self.reader, self.writer = await asyncio.open_connection(host, port, local_addr=local_address)
+        self.writer.write(HELLO)
+        received = b''
+        while HELLO not in received:
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConnectionError("server closed the connection during negotiation")
+            received += data
+        self.receiver = asyncio.create_task(self.receive(received[received.index(HELLO) + len(HELLO):]))
+
+    # Function to get a future for the next message starting with prefix
+    def expect(self, prefix):
+        future = self.expected[prefix] = asyncio.get_running_loop().create_future()
+        return future
+
+    def send(self, message):
+        self.writer.write(encode_frame(message.encode('utf-8')))
+
+    # Function to read messages until the server closes the connection
+    async def receive(self, data):
+        while True:
+            for kind, payload in self.decoder.feed(data):
+                self.handle_frame(kind, payload)
+            data = await self.reader.read(65536)
+            if not data:
+                break
+
+    def handle_frame(self, kind, payload):
+        if kind == KIND_PING:
+            self.writer.write(encode_frame(payload, KIND_PONG))
+        else:
+            self.handle(payload)
+
+    def handle(self, payload):
+        received_at = time.perf_counter_ns()
+        match = timed_message.search(payload)
+        if match is not None:
+            # Group messages come back to their sender as well; only count deliveries
+            if not payload.startswith(b"[myself "):
+                self.received += 1
+                self.latencies.append(received_at - int(match.group(1)))
+            return
+        text = payload.decode('utf-8', 'replace')
+        for prefix, future in list(self.expected.items()):
+            if text.startswith(prefix):
+                del self.expected[prefix]
+                future.set_result(text)
+
+    async def close(self):
+        self.writer.close()
+        await self.receiver
+
+
+# Client of the resume benchmark. It asks for a session and counts the
+# messages it gets, as client.py does, and keeps every one of them.
+class ResumingClient(LoadClient):
+    def __init__(self, username, latencies):
+        super().__init__(username, latencies)
+        self.token = None
+        self.count = 0
+        self.texts = []
+        self.session = None  # Future resolved by the next session frame
+
+    async def open(self, host, port, local_address=None):
+        await super().open(host, port, local_address)
+        self.writer.write(encode_frame(b'', KIND_SESSION))
+        self.session = asyncio.get_running_loop().create_future()
+
+    # Function to take the session of a client whose connection dropped
+    async def resume(self, host, port, token, count):
+        await self.open(host, port)
+        self.send(f"@resume {token} {count}")
+        await self.session
+
+    def handle_frame(self, kind, payload):
+        if kind == KIND_TEXT:
+            self.count += 1
+            self.texts.append(payload.decode('utf-8', 'replace'))
+        elif kind == KIND_SESSION:
+            token, count, username = payload.decode('utf-8').split(" ", 2)
+            self.token, self.count = token, int(count)
+            if not self.session.done():
+                self.session.set_result(token)
+        super().handle_frame(kind, payload)
+
+
+# Messages sent by the load benchmark carry the time they were sent at
+timed_message = re.compile(rb"\bt=(\d+)\b")
+
+
+# Function to find a free local port for a server started by a benchmark
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+# Function to start server.py and wait until it accepts connections
+def start_server(engine, port, extra_args):
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+                                "--engine", engine, "--port", str(port)] + extra_args,
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+# Function to stop a server started by start_server
+def stop_server(process):
+    try:
+        process.stdin.write("@quit\n")
+        process.stdin.flush()
+        process.wait(timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        process.kill()
+        process.wait()
+
+
+# Function to read the resident memory in bytes and CPU time in seconds of a
+# process and its children (the workers of a multi-process server); None
+# where /proc is not available
+def process_usage(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            pids = [pid] + [int(child) for child in children.read().split()]
+        rss = cpu = 0
+        for each in pids:
+            with open(f"/proc/{each}/statm") as statm:
+                rss += int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            with open(f"/proc/{each}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        return rss, cpu
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+# Function to send a client's share of the load until the deadline
+async def generate_load(client, index, clients, groups, args, deadline, sent):
+    rng = random.Random(index)
+    group_name, group_size = groups[index // args.group_size]
+    interval = 1 / args.rate
+    kinds = ["broadcast", "personal", "group"]
+    weights = [args.broadcast_share, args.personal_share, args.group_share]
+    # Start at a random point of the interval so clients do not send in lockstep
+    await asyncio.sleep(rng.random() * interval)
+    while time.monotonic() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        body = f"t={time.perf_counter_ns()} {'x' * args.message_size}"
+        if kind == "broadcast":
+            client.send(body)
+            sent["expected"] += len(clients) - 1
+        elif kind == "personal":
+            recipient = clients[rng.randrange(len(clients) - 1) + 1 + index - len(clients)]
+            client.send(f"@{recipient.username} {body}")
+            sent["expected"] += 1
+        else:
+            client.send(f"@group send {group_name} {body}")
+            sent["expected"] += group_size - 1
+        sent[kind] += 1
+        await client.writer.drain()
+        await asyncio.sleep(interval)
+
+
+# Function to run one load test against a server that is already listening
+async def drive_load(host, port, args, pid, metrics_port=None):
+    latencies = []
+    clients = [LoadClient(f"load{index}", latencies) for index in range(args.clients)]
+    rss_idle = process_usage(pid)[0] if pid else None
+
+    started = time.perf_counter()
+    for first in range(0, len(clients), 100):
+        await asyncio.gather(*(client.connect(host, port) for client in clients[first:first + 100]))
+    login_seconds = time.perf_counter() - started
+
+    # Each block of group_size clients forms a group, created by its first client
+    groups = []
+    created = []
+    for first in range(0, len(clients), args.group_size):
+        members = clients[first:first + args.group_size]
+        name = f"load{first // args.group_size}"
+        groups.append((name, len(members)))
+        created.append(members[0].expect(f"[You created the {name} group"))
+        members[0].send(f"@group set {name} {','.join(member.username for member in members)}")
+    await asyncio.gather(*created)
+
+    rss_loaded, cpu_before = process_usage(pid) if pid else (None, None)
+    writes_before = server_counters(metrics_port)
+    sent = collections.Counter()
+    deadline = time.monotonic() + args.seconds
+    started = time.perf_counter()
+    await asyncio.gather(*(generate_load(client, index, clients, groups, args, deadline, sent)
+                           for index, client in enumerate(clients)))
+    elapsed = time.perf_counter() - started
+    cpu_after = process_usage(pid)[1] if pid else None
+
+    # Give messages still on their way time to arrive
+    await asyncio.sleep(args.drain_seconds)
+    writes_after = server_counters(metrics_port)
+    for client in clients:
+        await client.close()
+
+    latencies.sort()
+    expected = sent.pop("expected", 0)
+    messages = sum(sent.values())
+    delivered = sum(client.received for client in clients)
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None else None
+    writes = None
+    if writes_before is not None and writes_after is not None:
+        writes = writes_after - writes_before
+    return {
+        "clients": len(clients),
+        "login_seconds": login_seconds,
+        "messages_sent": dict(sent, total=messages),
+        "messages_per_second": messages / elapsed,
+        "deliveries": delivered,
+        "deliveries_expected": expected,
+        "deliveries_per_second": delivered / elapsed,
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] / 1e9 if latencies else None,
+        },
+        "server_rss_bytes_per_connection": (rss_loaded - rss_idle) / len(clients) if rss_idle is not None else None,
+        "server_cpu_seconds": cpu_seconds,
+        "server_cpu_seconds_per_connection": cpu_seconds / len(clients) if cpu_seconds is not None else None,
+        "server_cpu_seconds_per_1000_messages": cpu_seconds / messages * 1000 if cpu_seconds is not None and messages else None,
+        "server_socket_writes": writes["socket_writes"] if writes else None,
+        "socket_writes_per_delivery": writes["socket_writes"] / delivered if writes and delivered else None,
+        "messages_per_socket_write": writes["socket_messages"] / writes["socket_writes"] if writes and writes["socket_writes"] else None,
+    }
+
+
+# Function to read the counters of a started server from its metrics, added
+# up with those of its workers (on the ports after it); None without metrics
+def server_counters(metrics_port):
+    if metrics_port is None:
+        return None
+    totals = collections.Counter()
+    port = metrics_port
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics.json", timeout=5) as response:
+                totals.update(json.load(response)["counters"])
+        except OSError:
+            break
+        port += 1
+    return totals if port > metrics_port else None
+
+
+# Function to get a percentile in seconds from sorted nanosecond samples
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))] / 1e9
+
+
+# Function to load each engine in turn, or a server that is already running
+def run_load(args):
+    runs = []
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        runs.append(dict(asyncio.run(drive_load(host, int(port), args, None)), server=args.connect))
+    else:
+        for engine in args.engine:
+            port = free_port()
+            metrics_port = free_port()
+            # Every client connects from the same address, which the rate limits would hold back
+            process = start_server(engine, port, ["--no-rate-limits", "--metrics-port", str(metrics_port)] + args.server_args.split())
+            try:
+                runs.append(dict(asyncio.run(drive_load("localhost", port, args, process.pid, metrics_port)), engine=engine))
+            finally:
+                stop_server(process)
+    return {
+        "benchmark": "load",
+        "seconds": args.seconds,
+        "rate_per_client": args.rate,
+        "message_bytes": args.message_size,
+        "runs": runs,
+    }
+
+
+# Function to fill an offline user's mailbox, then time how long that user
+# takes to be welcomed and to get all of the mail
+async def drive_mail(port, args):
+    latencies = []
+    sender = LoadClient("sender", latencies)
+    await sender.connect("localhost", port)
+    recipient = LoadClient("recipient", latencies)
+    await recipient.connect("localhost", port)
+    await recipient.close()
+
+    body = "x" * args.message_size
+    for index in range(args.messages):
+        sender.send(f"@recipient t={index} {body}")
+        if index % 1000 == 999:
+            await sender.writer.drain()
+    # The server answers in order, so every message is stored once this arrives
+    stored = sender.expect("Connected users")
+    sender.send("@names")
+    await stored
+
+    recipient = LoadClient("recipient", latencies)
+    started = time.perf_counter()
+    await recipient.connect("localhost", port)
+    welcome_seconds = time.perf_counter() - started
+    deadline = time.monotonic() + 10
+    while recipient.received < min(args.messages, args.mailbox_size) and time.monotonic() < deadline:
+        await asyncio.sleep(0.001)
+    delivery_seconds = time.perf_counter() - started
+    received = recipient.received
+    await recipient.close()
+    await sender.close()
+    return {"welcome_seconds": welcome_seconds, "all_mail_seconds": delivery_seconds, "mail_received": received}
+
+
+# Function to measure login with a full mailbox on each engine
+def run_mail(args):
+    runs = []
+    for engine in args.engine:
+        port = free_port()
+        process = start_server(engine, port, ["--mailbox-size", str(args.mailbox_size), "--no-rate-limits"] + args.server_args.split())
+        try:
+            runs.append(dict(asyncio.run(drive_mail(port, args)), engine=engine))
+        finally:
+            stop_server(process)
+    return {
+        "benchmark": "mail",
+        "messages": args.messages,
+        "message_bytes": args.message_size,
+        "runs": runs,
+        "ok": all(run["mail_received"] == min(args.messages, args.mailbox_size) for run in runs),
+    }
+
+
+# Client of the flood benchmark that also counts the flood reaching it
+class FloodWatcher(LoadClient):
+    def __init__(self, username, latencies):
+        super().__init__(username, latencies)
+        self.flood_received = 0
+
+    def handle(self, payload):
+        if b"]: flood " in payload:
+            self.flood_received += 1
+        else:
+            super().handle(payload)
+
+
+# Function to flood a server with broadcasts from one client, connected from
+# an address of its own, while quiet clients time the broadcasts one of them
+# sends now and then
+async def drive_flood(port, args):
+    latencies = []
+    quiet = [FloodWatcher(f"quiet{index}", latencies) for index in range(args.clients)]
+    for client in quiet:
+        await client.connect("127.0.0.1", port)
+    flooder = LoadClient("flooder", [])
+    await flooder.connect("127.0.0.1", port, local_address=("127.0.0.2", 0))
+
+    async def flood():
+        body = "flood " + "x" * args.message_size
+        for index in range(args.messages):
+            if flooder.receiver.done() or flooder.writer.transport.is_closing():
+                return index
+            flooder.send(body)
+            if index % 100 == 99:
+                try:
+                    await flooder.writer.drain()
+                except ConnectionError:
+                    return index + 1
+        return args.messages
+
+    # Slow enough to stay within the default broadcast limit
+    async def talk():
+        talked = 0
+        deadline = time.monotonic() + args.seconds
+        while time.monotonic() < deadline:
+            quiet[0].send(f"t={time.perf_counter_ns()} hello")
+            talked += 1
+            await asyncio.sleep(0.25)
+        return talked
+
+    talker = asyncio.create_task(talk())
+    started = time.perf_counter()
+    sent = await flood()
+    flood_seconds = time.perf_counter() - started
+    try:
+        await asyncio.wait_for(asyncio.shield(flooder.receiver), args.drain_seconds)
+        disconnected_after = time.perf_counter() - started
+    except ConnectionError:
+        # Reset, as the server closed with the flood still unread
+        disconnected_after = time.perf_counter() - started
+    except asyncio.TimeoutError:
+        disconnected_after = None
+    talked = await talker
+    await asyncio.sleep(args.drain_seconds)
+
+    flooder.writer.close()
+    await asyncio.gather(flooder.receiver, return_exceptions=True)
+    for client in quiet:
+        await client.close()
+    latencies.sort()
+    return {
+        "flood_sent": sent,
+        "flood_seconds": flood_seconds,
+        "flood_received_per_client": sum(client.flood_received for client in quiet[1:]) / (len(quiet) - 1),
+        "flooder_disconnected_after_seconds": disconnected_after,
+        "quiet_latency_seconds": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99)},
+        "quiet_delivered": len(latencies),
+        "quiet_expected": talked * (len(quiet) - 1),
+    }
+
+
+# Function to time the limiter's check of one message, as paid on every message
+def limiter_check_seconds(rounds=100000):
+    limits = RateLimiter({"message": (1e9, 1e9), "broadcast": (1e9, 1e9)}).connect("127.0.0.1")
+    started = time.perf_counter()
+    for _ in range(rounds):
+        limits.allow("broadcast")
+    return (time.perf_counter() - started) / rounds
+
+
+# Function to flood each engine with and without rate limits
+def run_flood(args):
+    runs = []
+    for engine in args.engine:
+        for limited in (True, False):
+            port = free_port()
+            process = start_server(engine, port, args.server_args.split() + ([] if limited else ["--no-rate-limits"]))
+            try:
+                runs.append(dict(asyncio.run(drive_flood(port, args)), engine=engine, rate_limits=limited))
+            finally:
+                stop_server(process)
+    return {
+        "benchmark": "flood",
+        "check_seconds": limiter_check_seconds(),
+        "runs": runs,
+        "ok": all(run["flooder_disconnected_after_seconds"] is not None and run["quiet_delivered"] == run["quiet_expected"]
+                  for run in runs if run["rate_limits"]),
+    }
+
+
+# Function to log in clients that then vanish without closing their
+# connections, round after round, and see the server reap them
+async def drive_churn(port, metrics_port, pid, args):
+    rounds = []
+    for round_number in range(args.rounds):
+        writers = []
+        for index in range(args.clients):
+            reader, writer = await asyncio.open_connection("localhost", port)
+            # Log in and never read or answer a ping again
+            writer.write(HELLO + encode_frame(f"churn{round_number}_{index}".encode('utf-8')))
+            writers.append(writer)
+        await asyncio.sleep(args.idle_timeout + args.wait_seconds)
+        counters = server_counters(metrics_port)
+        rounds.append({
+            "users_connected": counters["users_connected"],
+            "timers_pending": counters["timers_pending"],
+            "idle_disconnects": counters["idle_disconnects"],
+            "server_rss_bytes": process_usage(pid)[0],
+        })
+        for writer in writers:
+            writer.close()
+    return rounds
+
+
+# Function to drop a client's connection, send it messages while it is away,
+# and time how long it takes to be back: resuming its session, or logging in
+# again as clients had to before. Reports the join and exit notices the other
+# clients got, and how many of the messages reached the client.
+async def drive_resume(port, args):
+    watchers = [ResumingClient(f"watch{index}", []) for index in range(args.clients)]
+    for watcher in watchers:
+        await watcher.connect("localhost", port)
+    runs = {}
+    for mode in ("resume", "login"):
+        username = f"blip_{mode}"
+        client = ResumingClient(username, []) if mode == "resume" else LoadClient(username, [])
+        # Every watcher must have the join notice before counting starts
+        joined = [watcher.expect(f"[{username} joined]") for watcher in watchers]
+        await client.connect("localhost", port)
+        await asyncio.gather(*joined)
+        if mode == "resume":
+            await client.session
+        seen = [len(watcher.texts) for watcher in watchers]
+
+        # The network drops the connection; with no session the server logs the user out
+        exited = watchers[0].expect(f"[{username} exited]")
+        client.writer.transport.abort()
+        await asyncio.gather(client.receiver, return_exceptions=True)
+        if mode == "login":
+            await exited
+        for index in range(args.messages):
+            watchers[0].send(f"@{username} missed {index}")
+        await asyncio.sleep(0.1)
+
+        started = time.perf_counter()
+        if mode == "resume":
+            back = ResumingClient(username, [])
+            await back.resume("localhost", port, client.token, client.count)
+        else:
+            back = ResumingClient(username, [])
+            await back.connect("localhost", port)
+        reconnect_seconds = time.perf_counter() - started
+        await asyncio.sleep(args.drain_seconds)
+        since = [text for watcher, first in zip(watchers, seen) for text in watcher.texts[first:]]
+        runs[mode] = {
+            "reconnect_seconds": reconnect_seconds,
+            "join_and_exit_notices": sum(text in (f"[{username} joined]", f"[{username} exited]") for text in since),
+            "missed_messages_received": sum(" missed " in text for text in back.texts),
+            "messages_to_others": len(since),
+        }
+        await back.close()
+    for watcher in watchers:
+        await watcher.close()
+    return runs
+
+
+# Function to compare resuming with logging in again on each engine
+def run_resume(args):
+    runs = []
+    for engine in args.engine:
+        port = free_port()
+        # Every login and logout is told on its own, so the notices can be counted
+        process = start_server(engine, port, ["--no-rate-limits", "--presence-window", "0"] + args.server_args.split())
+        try:
+            runs.append(dict(asyncio.run(drive_resume(port, args)), engine=engine))
+        finally:
+            stop_server(process)
+    return {
+        "benchmark": "resume",
+        "clients": args.clients,
+        "messages_while_away": args.messages,
+        "runs": runs,
+        "ok": all(run["resume"]["missed_messages_received"] == args.messages and run["resume"]["join_and_exit_notices"] == 0
+                  for run in runs),
+    }
+
+
+# Function to log in many sessions on one event loop, with the client library
+# or with the streams the load benchmark's clients use, and measure what each
+# session costs the client. The library's sessions then time a broadcast
+# reaching all of them.
+async def drive_sessions(port, args, library):
+    usernames = [f"session{index}" for index in range(args.clients)]
+    received = collections.Counter()
+
+    def on_message(client, text):
+        if text.startswith("[session0]: "):
+            received["broadcast"] += 1
+            if received["broadcast"] == len(usernames) - 1:
+                everyone.set_result(time.perf_counter())
+
+    everyone = asyncio.get_running_loop().create_future()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    if library:
+        clients = await connect_many("localhost", port, usernames, on_message)
+    else:
+        clients = [LoadClient(username, []) for username in usernames]
+        for client in clients:
+            await client.connect("localhost", port)
+    connect_seconds = time.perf_counter() - started
+    await asyncio.sleep(args.drain_seconds)  # The join messages arrive
+    bytes_per_session = (tracemalloc.get_traced_memory()[0] - before) / len(usernames)
+    tracemalloc.stop()
+    run = {
+        "client": "library" if library else "streams",
+        "connect_seconds": connect_seconds,
+        "client_bytes_per_session": bytes_per_session,
+    }
+    if library:
+        started = time.perf_counter()
+        clients[0].broadcast("hello")
+        run["broadcast_to_all_seconds"] = await asyncio.wait_for(everyone, 30) - started
+    for client in clients:
+        if library:
+            client.close()
+        else:
+            await client.close()
+    return run
+
+
+# Function to compare the client library with plain streams
+def run_sessions(args):
+    runs = []
+    for library in (True, False):
+        port = free_port()
+        process = start_server(args.engine, port, ["--no-rate-limits"] + args.server_args.split())
+        try:
+            runs.append(asyncio.run(drive_sessions(port, args, library)))
+        finally:
+            stop_server(process)
+    return {
+        "benchmark": "sessions",
+        "engine": args.engine,
+        "clients": args.clients,
+        "runs": runs,
+        "ok": True,
+    }
+
+
+# Function to churn each engine with vanishing clients
+def run_churn(args):
+    runs = []
+    for engine in args.engine:
+        port = free_port()
+        metrics_port = free_port()
+        process = start_server(engine, port, ["--no-rate-limits", "--metrics-port", str(metrics_port),
+                                              "--ping-interval", str(args.idle_timeout / 3),
+                                              "--idle-timeout", str(args.idle_timeout)] + args.server_args.split())
+        try:
+            rounds = asyncio.run(drive_churn(port, metrics_port, process.pid, args))
+        finally:
+            stop_server(process)
+        runs.append({"engine": engine, "rounds": rounds})
+    return {
+        "benchmark": "churn",
+        "clients_per_round": args.clients,
+        "runs": runs,
+        "ok": all(each["users_connected"] == 0 and each["idle_disconnects"] == args.clients * (index + 1)
+                  for run in runs for index, each in enumerate(run["rounds"])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server benchmarks; results are printed as JSON")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    fanout = subparsers.add_parser("fanout", help="bytes allocated and time per broadcast")
+    fanout.add_argument("--recipients", type=int, default=1000)
+    fanout.add_argument("--message-size", type=int, default=200)
+    fanout.add_argument("--rounds", type=int, default=100)
+    fanout.set_defaults(run=run_fanout)
+
+    compression = subparsers.add_parser("compression", help="bandwidth against CPU time of compressed broadcasts")
+    compression.add_argument("--recipients", type=int, default=100)
+    compression.add_argument("--message-size", type=int, default=8192)
+    compression.add_argument("--threshold", type=int, default=COMPRESS_THRESHOLD)
+    compression.add_argument("--levels", type=int, nargs="+", choices=range(1, 10), default=[1, 6, 9], metavar="1-9")
+    compression.add_argument("--rounds", type=int, default=200)
+    compression.set_defaults(run=run_compression)
+
+    dispatch = subparsers.add_parser("dispatch", help="time to find and parse the command of a message")
+    dispatch.add_argument("--message-size", type=int, default=100)
+    dispatch.add_argument("--rounds", type=int, default=200000)
+    dispatch.set_defaults(run=run_dispatch)
+
+    present = subparsers.add_parser("presence", help="join notices during a login storm, and @names pages")
+    present.add_argument("--clients", type=int, default=5000, help="users connected, and users who then log in")
+    present.add_argument("--windows", type=float, nargs="+", default=[0, PRESENCE_WINDOW])
+    present.add_argument("--rounds", type=int, default=200)
+    present.set_defaults(run=run_presence)
+
+    provision = subparsers.add_parser("provision", help="setting up a large group, a command per member or one batch")
+    provision.add_argument("--members", type=int, default=1000)
+    provision.set_defaults(run=run_provision)
+
+    metered = subparsers.add_parser("metrics", help="time per message with metrics on and off")
+    metered.add_argument("--recipients", type=int, default=100)
+    metered.add_argument("--rounds", type=int, default=2000)
+    metered.set_defaults(run=run_metrics)
+
+    stress = subparsers.add_parser("stress", help="concurrent logins, logouts and group changes; fails on errors")
+    stress.add_argument("--threads", type=int, default=16)
+    stress.add_argument("--users", type=int, default=64, help="usernames, shared out between the threads")
+    stress.add_argument("--seconds", type=float, default=5)
+    stress.add_argument("--prompt-timeout", type=float, default=0.01,
+                        help="short, so unanswered questions time out while the threads run")
+    stress.add_argument("--nodes", type=int, default=1,
+                        help="cluster nodes to spread the threads over, joined by an in-process broker")
+    stress.add_argument("--data-dir", help="save the groups here too, and check they restore as they were")
+    stress.add_argument("--snapshot-every", type=int, default=1000)
+    stress.set_defaults(run=run_stress)
+
+    restart = subparsers.add_parser("restart", help="time to restore saved groups")
+    restart.add_argument("--groups", type=int, default=200000)
+    restart.add_argument("--members", type=int, default=10)
+    restart.add_argument("--users", type=int, default=10000)
+    restart.add_argument("--changes", type=int, default=50000, help="changes logged after the snapshot")
+    restart.set_defaults(run=run_restart)
+
+    load = subparsers.add_parser("load", help="throughput and delivery latency of a running server")
+    load.add_argument("--engine", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"],
+                      help="engines to start server.py with, one run each")
+    load.add_argument("--connect", metavar="HOST:PORT", help="load this server instead of starting one")
+    load.add_argument("--server-args", default="", help="extra options for the started server, e.g. '--queue-size 100'")
+    load.add_argument("--clients", type=int, default=100)
+    load.add_argument("--seconds", type=float, default=10)
+    load.add_argument("--rate", type=float, default=10, help="messages per second sent by each client")
+    load.add_argument("--message-size", type=int, default=100)
+    load.add_argument("--group-size", type=int, default=10)
+    load.add_argument("--broadcast-share", type=float, default=0.1)
+    load.add_argument("--personal-share", type=float, default=0.6)
+    load.add_argument("--group-share", type=float, default=0.3)
+    load.add_argument("--drain-seconds", type=float, default=1)
+    load.set_defaults(run=run_load)
+
+    mail = subparsers.add_parser("mail", help="login time of a user with a full offline mailbox")
+    mail.add_argument("--engine", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"])
+    mail.add_argument("--server-args", default="", help="extra options for the started server")
+    mail.add_argument("--messages", type=int, default=5000)
+    mail.add_argument("--message-size", type=int, default=100)
+    mail.add_argument("--mailbox-size", type=int, default=5000)
+    mail.set_defaults(run=run_mail)
+
+    flood = subparsers.add_parser("flood", help="one client flooding the server, with and without rate limits")
+    flood.add_argument("--engine", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"])
+    flood.add_argument("--server-args", default="", help="extra options for the started server, e.g. '--flood-limit 50'")
+    flood.add_argument("--clients", type=int, default=20, help="quiet clients, which connect from another address")
+    flood.add_argument("--messages", type=int, default=20000, help="broadcasts the flooding client tries to send")
+    flood.add_argument("--message-size", type=int, default=100)
+    flood.add_argument("--seconds", type=float, default=3, help="how long the quiet clients keep talking")
+    flood.add_argument("--drain-seconds", type=float, default=1)
+    flood.set_defaults(run=run_flood)
+
+    resume = subparsers.add_parser("resume", help="reconnecting with a session against logging in again")
+    resume.add_argument("--engine", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"])
+    resume.add_argument("--server-args", default="", help="extra options for the started server")
+    resume.add_argument("--clients", type=int, default=200, help="other clients, which see users join and leave")
+    resume.add_argument("--messages", type=int, default=50, help="messages sent to the client while it is away")
+    resume.add_argument("--drain-seconds", type=float, default=0.5)
+    resume.set_defaults(run=run_resume)
+
+    sessions = subparsers.add_parser("sessions", help="client memory per session, with the client library")
+    sessions.add_argument("--engine", choices=("threaded", "asyncio"), default="asyncio")
+    sessions.add_argument("--server-args", default="", help="extra options for the started server")
+    sessions.add_argument("--clients", type=int, default=500)
+    sessions.add_argument("--drain-seconds", type=float, default=1)
+    sessions.set_defaults(run=run_sessions)
+
+    churn = subparsers.add_parser("churn", help="clients that vanish without closing, reaped by idle timeouts")
+    churn.add_argument("--engine", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"])
+    churn.add_argument("--server-args", default="", help="extra options for the started server")
+    churn.add_argument("--clients", type=int, default=500, help="clients that vanish each round")
+    churn.add_argument("--rounds", type=int, default=5)
+    churn.add_argument("--idle-timeout", type=float, default=3, help="given to the server, which pings at a third of it")
+    churn.add_argument("--wait-seconds", type=float, default=3, help="extra time given to the server to reap them")
+    churn.set_defaults(run=run_churn)
+
+    args = parser.parse_args()
+    result = args.run(args)
+    print(json.dumps(result, indent=2))
+    if not result.get("ok", True):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
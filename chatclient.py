@@ -0,0 +1,420 @@
+import asyncio
+import collections
+import itertools
+
+from compression import DEFLATE, Compressor, Decompressor
+from protocol import (HELLO, KIND_ACK, KIND_COMPRESS, KIND_COMPRESSED, KIND_PING, KIND_PONG, KIND_SESSION, KIND_TEXT,
+                      FrameDecoder, encode_frame)
+
+# Headless client library, for bots, tests and load tools that need many
+# sessions at once. Each ChatClient is an asyncio protocol: received bytes
+# are decoded in the event loop's callback, with no task, thread or stream
+# buffers per session, so thousands of them share one loop cheaply.
+#
+#     async def main():
+#         bot = ChatClient("bot")
+#         await bot.connect("localhost", 12345)
+#         print(await bot.names())
+#         bot.message("alice", "hello")
+#         async for text in bot:
+#             print(text)
+#
+# Incoming messages go to the on_message callback given to the client, or if
+# there is none they are queued for "async for" and receive(). Replies that a
+# helper such as names() is waiting for go to that helper instead.
+#
+# Commands can be pipelined: pipeline() sends many in one write and returns
+# the replies to each, which the server tags so they can be told apart.
+
+# Largest message a client accepts from the server by default
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Messages received between acks to the server, for resumable sessions
+ACK_EVERY = 100
+
+# Sessions connected at once by connect_many() by default
+CONNECT_CONCURRENCY = 100
+
+
+# Function to connect and log in a client for every username on the current
+# event loop, a few at a time. Returns the clients in the same order.
+async def connect_many(host, port, usernames, on_message=None, concurrency=CONNECT_CONCURRENCY, **options):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def connect_one(username):
+        async with limit:
+            client = ChatClient(username, on_message, **options)
+            await client.connect(host, port)
+            return client
+    return await asyncio.gather(*[connect_one(username) for username in usernames])
+
+
+class ChatClient(asyncio.Protocol):
+    __slots__ = ("username", "on_message", "resumable", "decoder", "transport", "framed", "prompt", "received",
+                 "expected", "inbox", "waiter", "closed", "paused", "token", "count", "session", "compressor",
+                 "decompressor", "tags", "requests")
+
+    # on_message(client, text) is called for each message if given. A
+    # resumable client asks for a session, so it can reconnect() without
+    # logging in again. A client that compresses offers the server to
+    # compress large messages both ways.
+    def __init__(self, username, on_message=None, resumable=False, compress=False, max_frame_size=MAX_FRAME_SIZE):
+        self.username = username
+        self.on_message = on_message
+        self.resumable = resumable
+        self.decoder = FrameDecoder(max_frame_size)
+        self.compressor = None  # Set once the server agreed to compression
+        self.decompressor = Decompressor(max_frame_size) if compress else None
+        self.transport = None
+        self.framed = None     # Future resolved once the server switched to frames
+        self.prompt = b''      # Plain text received before the switch
+        self.received = None   # Bytes received before the switch
+        self.expected = []     # (prefixes, future) for replies helpers are waiting for, oldest first
+        self.inbox = collections.deque()  # Messages not taken yet, if there is no callback
+        self.waiter = None     # Future of a receive() waiting for the inbox
+        self.closed = None     # Future resolved when the connection is lost
+        self.paused = None     # Future resolved when the transport may be written again
+        self.token = None      # Token of our session, once logged in
+        self.count = 0         # Messages received in the session
+        self.session = None    # Future resolved by the next session frame
+        self.tags = itertools.count(1)  # Numbers the tags of pipelined commands
+        self.requests = {}     # tag -> (replies so far, future) of pipelined commands
+
+    # Function to connect to the server and log in; raises ConnectionError if
+    # the username is taken or the server goes away
+    async def connect(self, host, port, local_address=None):
+        await self.open(host, port, local_address)
+        reply = self.expect("[Welcome ", "[Existing Username")
+        self.send(self.username)
+        if (await self.reply(reply)).startswith("[Existing Username"):
+            self.close()
+            raise ConnectionError(f"username {self.username} is taken")
+
+    # Function to connect and switch to frames, without logging in
+    async def open(self, host, port, local_address=None):
+        loop = asyncio.get_running_loop()
+        self.framed = loop.create_future()
+        self.closed = loop.create_future()
+        self.prompt, self.received = b'', b''
+        self.decoder.buffer.clear()
+        await loop.create_connection(lambda: self, host, port, local_addr=local_address)
+        await self.framed
+        if self.resumable:
+            self.session = loop.create_future()
+
+    # Function to take the session over on a new connection after the old
+    # one dropped; raises ConnectionError if it cannot be resumed
+    async def reconnect(self, host, port, local_address=None):
+        if self.token is None:
+            raise ConnectionError("there is no session to resume")
+        if not self.closed.done():
+            self.transport.abort()
+            await self.wait_closed()
+        await self.open(host, port, local_address)
+        refused = self.expect("[Your session could not be resumed")
+        self.send(f"@resume {self.token} {self.count}")
+        await asyncio.wait([self.session, refused, self.closed], return_when=asyncio.FIRST_COMPLETED)
+        if not self.session.done():
+            self.forget(refused)
+            self.close()
+            raise ConnectionError("the session could not be resumed")
+        self.forget(refused)
+
+    # Function to close the connection; messages already sent are still written
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    # Function to wait until the connection is closed
+    async def wait_closed(self):
+        await asyncio.shield(self.closed)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.compressor = None
+        transport.write(HELLO)
+        if self.resumable:
+            transport.write(encode_frame(b'', KIND_SESSION))
+        if self.decompressor is not None:
+            transport.write(encode_frame(DEFLATE, KIND_COMPRESS))
+
+    def data_received(self, data):
+        if not self.framed.done():
+            self.received += data
+            if HELLO not in self.received:
+                return
+            index = self.received.index(HELLO)
+            self.prompt = self.received[:index]
+            data = self.received[index + len(HELLO):]
+            self.received = None
+            self.framed.set_result(True)
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError:
+            self.transport.abort()
+            return
+        for kind, payload in frames:
+            if kind == KIND_COMPRESSED and self.decompressor is not None:
+                try:
+                    kind, payload = KIND_TEXT, self.decompressor.decompress(payload)
+                except ValueError:
+                    self.transport.abort()
+                    return
+            if kind == KIND_TEXT:
+                self.count += 1
+                if self.token is not None and self.count % ACK_EVERY == 0:
+                    self.transport.write(encode_frame(str(self.count).encode('utf-8'), KIND_ACK))
+                self.deliver(payload.decode('utf-8', 'replace'))
+            elif kind == KIND_PING:
+                self.transport.write(encode_frame(payload, KIND_PONG))
+                if self.token is not None:
+                    self.transport.write(encode_frame(str(self.count).encode('utf-8'), KIND_ACK))
+            elif kind == KIND_SESSION:
+                token, count, username = payload.decode('utf-8').split(" ", 2)
+                self.token, self.count = token, int(count)
+                if self.session is not None and not self.session.done():
+                    self.session.set_result(token)
+            elif kind == KIND_COMPRESS and self.decompressor is not None:
+                offer, threshold = payload.decode('utf-8').split()
+                self.compressor = Compressor(int(threshold))
+
+    def connection_lost(self, exc):
+        error = ConnectionError("connection to the server lost")
+        for future in (self.framed, self.paused):
+            if future is not None and not future.done():
+                future.set_exception(error)
+        for prefixes, future in self.expected:
+            if not future.done():
+                future.set_exception(error)
+        self.expected.clear()
+        for replies, future in self.requests.values():
+            if not future.done():
+                future.set_exception(error)
+        self.requests.clear()
+        if not self.closed.done():
+            self.closed.set_result(True)
+        self.wake()
+
+    def pause_writing(self):
+        self.paused = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self.paused is not None and not self.paused.done():
+            self.paused.set_result(True)
+        self.paused = None
+
+    # Function to wait until the messages sent so far have been handed to the
+    # kernel, for senders that must not run ahead of a slow connection
+    async def drain(self):
+        if self.paused is not None:
+            await self.paused
+
+    # Function to pass a message to the helper waiting for it, or else to the
+    # callback or the inbox
+    def deliver(self, text):
+        if text.startswith("%") and self.requests:
+            tag, _, reply = text.partition(" ")
+            request = self.requests.get(tag)
+            if request is not None:
+                if reply == "[Done]":
+                    del self.requests[tag]
+                    if not request[1].done():
+                        request[1].set_result(request[0])
+                else:
+                    request[0].append(reply)
+                return
+        for index, (prefixes, future) in enumerate(self.expected):
+            if text.startswith(prefixes):
+                del self.expected[index]
+                if not future.done():
+                    future.set_result(text)
+                return
+        if self.on_message is not None:
+            try:
+                self.on_message(self, text)
+            except Exception as e:
+                print(f"Unexpected error: {e}")
+        else:
+            self.inbox.append(text)
+            self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(True)
+
+    # Function to get a future for the next message starting with any of the
+    # prefixes; that message is not delivered otherwise
+    def expect(self, *prefixes):
+        future = asyncio.get_running_loop().create_future()
+        self.expected.append((prefixes, future))
+        return future
+
+    # Function to stop waiting for a message
+    def forget(self, future):
+        self.expected = [entry for entry in self.expected if entry[1] is not future]
+
+    # Function to wait for an expected reply, failing if the connection is lost first
+    async def reply(self, future):
+        await asyncio.wait([future, self.closed], return_when=asyncio.FIRST_COMPLETED)
+        if not future.done():
+            self.forget(future)
+            raise ConnectionError("connection to the server lost")
+        return future.result()
+
+    # Function to wait for the next message; None once the connection is
+    # closed and every message has been taken
+    async def receive(self):
+        while not self.inbox:
+            if self.closed.done():
+                return None
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+            self.waiter = None
+        return self.inbox.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        text = await self.receive()
+        if text is None:
+            raise StopAsyncIteration
+        return text
+
+    # Function to send one message as it is, e.g. an answer to a question
+    def send(self, text):
+        self.transport.write(self.encode(text))
+
+    def encode(self, text):
+        payload = text.encode('utf-8')
+        frame = None if self.compressor is None else self.compressor.frame(payload)
+        return frame or encode_frame(payload)
+
+    # Function to send many commands in one write, without waiting for each
+    # other; returns the replies to each, in the same order
+    async def pipeline(self, commands):
+        futures = []
+        frames = []
+        for command in commands:
+            tag = f"%{next(self.tags)}"
+            future = asyncio.get_running_loop().create_future()
+            self.requests[tag] = ([], future)
+            futures.append(future)
+            frames.append(self.encode(f"{tag} {command}"))
+        self.transport.write(b''.join(frames))
+        return [await self.reply(future) for future in futures]
+
+    # Function to send one command and get its replies
+    async def request(self, command):
+        return (await self.pipeline([command]))[0]
+
+    # Function to send a message to everyone
+    def broadcast(self, text):
+        self.send(text)
+
+    # Function to send a personal message
+    def message(self, username, text):
+        self.send(f"@{username} {text}")
+
+    # Function to log out; waits until the server closed the connection
+    async def quit(self):
+        self.send("@quit")
+        await self.wait_closed()
+
+    # Function to get the usernames of the connected users, or of those whose
+    # names start with a prefix, a page at a time
+    async def names(self, prefix=""):
+        usernames = []
+        after = None
+        while True:
+            page, after = await self.names_page(prefix, after)
+            usernames += page
+            if after is None:
+                return usernames
+
+    # Function to get one page of usernames, and the name to ask for the next
+    # page after; None if it is the last
+    async def names_page(self, prefix="", after=None):
+        reply = self.expect("Connected users: ", "[No connected users start with ", "[No more connected users]")
+        self.send(" ".join(["@names", *([prefix] if prefix else []), *(["after", after] if after is not None else [])]))
+        text = await self.reply(reply)
+        if not text.startswith("Connected users: "):
+            return [], None
+        text, more, _ = text[len("Connected users: "):].partition(" [More: ")
+        page = text.split(", ")
+        return page, page[-1] if more else None
+
+    # Function to choose what the server says when users join and leave:
+    # "notices", "diffs" (see presence_diff) or "off"
+    def presence(self, mode):
+        self.send(f"@presence {mode}")
+
+    # Functions for the group commands. The server's replies, and any
+    # questions it asks, are delivered like other messages.
+    def group_set(self, group_name, members):
+        self.send(f"@group set {group_name} {', '.join(members)}")
+
+    def group_send(self, group_name, text):
+        self.send(f"@group send {group_name} {text}")
+
+    def group_delete(self, group_name):
+        self.send(f"@group delete {group_name}")
+
+    def group_leave(self, group_name):
+        self.send(f"@group leave {group_name}")
+
+    def group_add(self, group_name, members):
+        self.send(f"@group add {group_name} {', '.join(members)}")
+
+    def group_remove(self, group_name, members):
+        self.send(f"@group remove {group_name} {', '.join(members)}")
+
+    def group_authorize(self, group_name, members):
+        self.send(f"@group authorize {group_name} {', '.join(members)}")
+
+    # Function to make many changes to a group at once: changes is a list of
+    # ("set" | "add" | "remove" | "authorize", members), "set" only first.
+    # Returns the server's replies.
+    async def group_batch(self, group_name, changes):
+        return await self.request(f"@group batch {group_name} " +
+                                  "; ".join(f"{op} {', '.join(members)}" for op, members in changes))
+
+    def group_history(self, group_name, before=None, count=None):
+        if before is None and count is not None:
+            before = 2 ** 63  # After every message, so the newest page
+        words = [str(number) for number in (before, count) if number is not None]
+        self.send(" ".join(["@group history", group_name, *words]))
+
+    # Function to get the names of the groups the user is in
+    async def group_list(self):
+        reply = self.expect("[Groups you are in: ", "[You are not in any groups]")
+        self.send("@group list")
+        text = await self.reply(reply)
+        if not text.startswith("[Groups you are in: "):
+            return []
+        return text[len("[Groups you are in: "):-1].split(", ")
+
+    # Function to get the members and the admins of a group; None if there
+    # is no such group
+    async def group_members(self, group_name):
+        members = self.expect(f"[Members in {group_name} group: ", "[Group does not exist]")
+        admins = self.expect(f"[Admins in {group_name} group: ")
+        self.send(f"@group members {group_name}")
+        text = await self.reply(members)
+        if text == "[Group does not exist]":
+            self.forget(admins)
+            return None
+        admin_text = await self.reply(admins)
+        return (text[text.index(": ") + 2:-1].split(", "),
+                admin_text[admin_text.index(": ") + 2:-1].split(", "))
+
+
+# Function to read a presence diff the server sends in "diffs" mode; returns
+# the users who joined and who left, or None if the message is not a diff
+def presence_diff(text):
+    if not text.startswith("[Presence] "):
+        return None
+    joined, left = [], []
+    for change in text[len("[Presence] "):].split(", "):
+        (joined if change[0] == "+" else left).append(change[1:])
+    return joined, left
@@ -1,43 +1,176 @@
 import socket
 import threading
+import time
 
-# Function to continuously receive messages from the server
-def receive_messages(user_socket):
+from compression import DEFLATE, Compressor, Decompressor
+from protocol import (KIND_ACK, KIND_COMPRESS, KIND_COMPRESSED, KIND_PING, KIND_PONG, KIND_SESSION, KIND_TEXT,
+                      FrameDecoder, encode_frame, request_framing)
+
+# Largest message the client accepts from the server
+max_frame_size = 16 * 1024 * 1024
+
+# Messages received between acks to the server
+ack_every = 100
+
+# Seconds to wait before each attempt to reconnect; the last is repeated
+# until the server's session would have expired
+reconnect_delays = (0.1, 0.5, 1, 2, 5)
+reconnect_seconds = 60
+
+# Messages after which the server closed the connection on purpose, so there
+# is no point in reconnecting
+final_messages = ("[Disconnected", "[Server is shutting down]")
+
+# Function to connect to the server and ask for framed messages, a session
+# and compression. Returns the socket, the plain text the server sent first (the
+# username prompt) and the bytes received after it.
+def connect(host, port):
+    user_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        user_socket.connect((host, port))
+        welcome_message, received = request_framing(user_socket)
+        user_socket.sendall(encode_frame(b'', KIND_SESSION) + encode_frame(DEFLATE, KIND_COMPRESS))
+    except Exception:
+        user_socket.close()
+        raise
+    return user_socket, welcome_message, received
+
+# The connection to the server, which is swapped for a new one when it drops
+class ServerLink:
+    def __init__(self, host, port, user_socket):
+        self.host = host
+        self.port = port
+        self.user_socket = user_socket
+        self.decoder = FrameDecoder(max_frame_size)
+        # Both threads send, so whole frames go out one at a time
+        self.send_lock = threading.Lock()
+        self.token = None     # Token of our session, once logged in
+        self.username = None
+        self.received = 0     # Messages received in the session
+        self.resuming = False # Set while logging in again after a reconnect
+        self.quitting = False
+        self.last_message = ""
+        self.compressor = None  # Set once the server agreed to compression
+        self.decompressor = Decompressor(max_frame_size)
+
+    # Function to send one frame to the server; large messages are compressed
+    # if the server agreed to it
+    def send_frame(self, payload, kind=KIND_TEXT):
+        frame = None
+        if kind == KIND_TEXT and self.compressor is not None:
+            frame = self.compressor.frame(payload)
+        with self.send_lock:
+            self.user_socket.sendall(frame or encode_frame(payload, kind))
+
+    # Function to print every complete message in a chunk of received bytes,
+    # answer the server's pings and keep track of the session
+    def print_messages(self, data):
+        for kind, payload in self.decoder.feed(data):
+            if kind == KIND_COMPRESSED:
+                kind, payload = KIND_TEXT, self.decompressor.decompress(payload)
+            if kind == KIND_TEXT:
+                text = payload.decode('utf-8', 'replace')
+                self.received += 1
+                self.last_message = text
+                if self.received % ack_every == 0 and self.token is not None:
+                    self.send_frame(str(self.received).encode('utf-8'), KIND_ACK)
+                if self.resuming and text == "Enter your username: " and self.username is not None:
+                    # The session could not be resumed; log in again under the same name
+                    self.resuming = False
+                    self.send_frame(self.username.encode('utf-8'))
+                    continue
+                print(text)
+            elif kind == KIND_PING:
+                self.send_frame(payload, KIND_PONG)
+                if self.token is not None:
+                    self.send_frame(str(self.received).encode('utf-8'), KIND_ACK)
+            elif kind == KIND_SESSION:
+                token, count, username = payload.decode('utf-8').split(" ", 2)
+                self.token, self.received, self.username = token, int(count), username
+                self.resuming = False
+            elif kind == KIND_COMPRESS:
+                offer, threshold = payload.decode('utf-8').split()
+                self.compressor = Compressor(int(threshold))
+
+    # Function to connect again after the connection dropped and resume the
+    # session; False if the server cannot be reached
+    def reconnect(self):
+        print("Connection lost; reconnecting...")
+        deadline = time.monotonic() + reconnect_seconds
+        attempt = 0
+        while time.monotonic() < deadline:
+            time.sleep(reconnect_delays[min(attempt, len(reconnect_delays) - 1)])
+            attempt += 1
+            try:
+                user_socket, welcome_message, received = connect(self.host, self.port)
+            except OSError:
+                continue
+            with self.send_lock:
+                self.user_socket.close()
+                self.user_socket = user_socket
+                self.decoder = FrameDecoder(max_frame_size)
+                self.compressor = None
+            self.resuming = True
+            try:
+                if self.token is not None:
+                    self.send_frame(f"@resume {self.token} {self.received}".encode('utf-8'))
+                else:
+                    # Not logged in yet; show the prompt again
+                    print(welcome_message.decode('utf-8'))
+                self.print_messages(received)
+            except OSError:
+                continue
+            print("Reconnected.")
+            return True
+        return False
+
+# Function to continuously receive messages from the server, reconnecting
+# when the connection drops
+def receive_messages(link):
     while True:
         try:
             # Receive message from server
-            message = user_socket.recv(1024).decode('utf-8')
-            # Print received message
-            print(message)
+            data = link.user_socket.recv(4096)
+            if data:
+                # Print received messages
+                link.print_messages(data)
+                continue
+            if link.quitting or link.last_message.startswith(final_messages):
+                print("Connection was closed by the server.")
+                break
         except Exception as e:
+            if link.quitting:
+                break
             # Print error if any
             print(f"Error: {e}")
+        if not link.reconnect():
+            print("Could not reconnect to the server.")
             break
 
 # Main function for the user
 def main():
-    
+
     while True:
         try:
             # Get server configuration from user
             host = input("Enter the server IP address: ")
             port = int(input("Enter the server port number: "))
 
-            # Create a socket for the user
-            user_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # Connect to the server
-            user_socket.connect((host, port))
+            # Connect to the server and ask for framed messages
+            user_socket, welcome_message, received = connect(host, port)
             break  # If connection is successful, break the loop
         except Exception as e:
             print("Error connecting to server. Please check the server IP and port number and try again.")
             print("Error details:", e)
 
-    # Receive and print welcome message from the server
-    welcome_message = user_socket.recv(1024).decode('utf-8')
-    print(welcome_message)
+    # Print welcome message from the server
+    print(welcome_message.decode('utf-8'))
+    link = ServerLink(host, port, user_socket)
+    link.print_messages(received)
 
     # Start a thread to receive messages from the server continuously
-    thread = threading.Thread(target=receive_messages, args=(user_socket,))
+    thread = threading.Thread(target=receive_messages, args=(link,))
+    thread.daemon = True
     thread.start()
 
     # Main loop for sending messages to the server
@@ -48,20 +181,21 @@ def main():
         try:
             # Send "@quit" command to disconnect from the server
             if message == "@quit":
-                user_socket.sendall(message.encode('utf-8'))
+                link.quitting = True
+                link.send_frame(message.encode('utf-8'))
                 break
             # Send "@names" command to get list of connected users
             elif message == "@names":
-                user_socket.sendall(message.encode('utf-8'))
+                link.send_frame(message.encode('utf-8'))
             else:
                 # Send user's message to the server
-                user_socket.sendall(message.encode('utf-8'))
-        except ConnectionResetError:
-            print("Connection was closed by the server.")
-            break
+                link.send_frame(message.encode('utf-8'))
+        except OSError:
+            # The receiving thread reconnects; the message is lost
+            print("Not connected; the message was not sent.")
 
     # Close the user socket
-    user_socket.close()
+    link.user_socket.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
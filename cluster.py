@@ -0,0 +1,392 @@
+import collections
+import itertools
+import threading
+
+from connection import SharedMessage
+from history import History
+from offline import Mailboxes
+from state import GroupStore, UserRegistry
+
+# Several server processes serving one chat namespace, tied together by a
+# pub/sub backend (see pubsub.py).
+#
+# Every node keeps a full copy of the user registry and the group store.
+# Changes to either are published on the "changes" topic, which every node
+# sees in the same order, and each node applies them to its copy as they
+# arrive, so all copies stay the same and a username can only be claimed
+# once. A node that joins late asks for a snapshot of the state and applies
+# the changes that follow it. If nodes save the groups to disk, the first
+# node to join restores them and the others take them from it.
+#
+# Users of other nodes appear in the registry as RemoteConnections. Messages
+# for them are published on the topic of the node that holds them, so only
+# that node gets them.
+
+CHANGES = "changes"
+
+# Seconds to wait for a change to come back before giving up on the cluster
+REQUEST_TIMEOUT = 10
+
+
+# Raised when a change is not back from the cluster in time. The change may
+# still be made on every node later; the node takes back what nobody else
+# will (see Node.abandoned), and the rest stands.
+class ClusterTimeout(Exception):
+    pass
+
+
+# Function to get the topic of messages for a node's users
+def node_topic(node_id):
+    return f"node.{node_id}"
+
+
+# Stands in for a user held by another node; what the handlers send to it is
+# published to that node
+class RemoteConnection:
+    def __init__(self, node, node_id, username):
+        self.node = node
+        self.node_id = node_id
+        self.username = username
+        self.closed = False
+
+    def sendall(self, data):
+        self.node.deliver(self.node_id, self.username, data)
+
+    def send_shared(self, message):
+        self.node.deliver(self.node_id, self.username, message.payload, message)
+
+    def close(self):
+        pass
+
+
+# This process's membership of the cluster
+class Node:
+    def __init__(self, pubsub, node_id, log=None):
+        self.pubsub = pubsub
+        self.node_id = node_id
+        self.log = log  # The groups' on-disk log (see storage.py), if any
+        self.ids = itertools.count(1)
+        self.requests = {}  # id -> [event, result, local connection]
+        self.synced = threading.Event()
+        self.backlog = None  # Changes received while waiting for a snapshot
+        self.catching_up = threading.RLock()  # Guards the backlog
+        self.closed = False
+        self.on_command = None  # Set by the engine to run server commands sent to the node
+        # Deliveries wait here until the sender thread publishes them, so that
+        # one shared message for many users of a node goes out once
+        self.outbox = collections.deque()
+        self.batches = {}  # node id -> (queued delivery, SharedMessage) that can take more names
+        self.outbox_changed = threading.Condition()
+
+    # Function to join the cluster and wait until the local copy is up to date
+    def join(self, user_names, groups):
+        self.user_names = user_names
+        self.groups = groups
+        threading.Thread(target=self.drain_outbox, daemon=True).start()
+        self.pubsub.subscribe(node_topic(self.node_id), self.receive_direct)
+        self.backlog = []
+        if self.pubsub.subscribe(CHANGES, self.receive_change) == 0:
+            # Nobody else was here, so there is nothing to catch up on but what
+            # arrived since subscribing
+            if self.log is not None:
+                self.log.restore(groups)
+                groups.renumber()
+            self.replay_backlog(0)
+        else:
+            self.pubsub.publish(CHANGES, {"op": "sync", "node": self.node_id})
+        self.synced.wait()
+
+    # Function to make a change on every node and wait until it is made here;
+    # raises ClusterTimeout if the cluster does not answer in time
+    def request(self, change, connection=None):
+        if self.closed:
+            return None
+        request_id = next(self.ids)
+        request = self.requests[request_id] = [threading.Event(), None, connection]
+        self.pubsub.publish(CHANGES, {"op": "change", "origin": self.node_id, "id": request_id, "change": change})
+        if not request[0].wait(REQUEST_TIMEOUT):
+            if self.requests.pop(request_id, None) is not None:
+                print(f"[node {self.node_id}] No answer from the cluster for {change[0]}")
+                raise ClusterTimeout(change[0])
+            request[0].wait()  # The answer came just as we gave up
+        return request[1]
+
+    # Function to make a change on every node without waiting for it
+    def announce(self, change):
+        if not self.closed:
+            self.pubsub.publish(CHANGES, {"op": "change", "origin": self.node_id, "id": None, "change": change})
+
+    # Function to stop waiting for the pub/sub backend once it has gone away
+    def close(self):
+        print(f"[node {self.node_id}] Lost the connection to the cluster")
+        self.closed = True
+        for request in list(self.requests.values()):
+            request[0].set()
+
+    # Function to queue a message for a user held by another node
+    def deliver(self, node_id, username, data, shared=None):
+        with self.outbox_changed:
+            batch = self.batches.get(node_id)
+            if shared is not None and batch is not None and batch[1] is shared:
+                batch[0]["names"].append(username)
+                return
+            message = {"op": "deliver", "names": [username], "data": data}
+            self.batches[node_id] = (message, shared)
+            self.outbox.append((node_id, message))
+            self.outbox_changed.notify()
+
+    # Function run by the sender thread
+    def drain_outbox(self):
+        while True:
+            with self.outbox_changed:
+                while not self.outbox:
+                    self.outbox_changed.wait()
+                messages = list(self.outbox)
+                self.outbox.clear()
+                self.batches.clear()
+            for node_id, message in messages:
+                message["data"] = bytes(message["data"]).decode('utf-8', 'surrogateescape')
+                self.pubsub.publish(node_topic(node_id), message)
+
+    # Function called for messages sent to this node
+    def receive_direct(self, message):
+        op = message["op"]
+        if op == "deliver":
+            shared = SharedMessage(message["data"].encode('utf-8', 'surrogateescape'))
+            for username in message["names"]:
+                user_socket = self.user_names.connection_for(username)
+                if user_socket is not None and not isinstance(user_socket, RemoteConnection):
+                    user_socket.send_shared(shared)
+        elif op == "snapshot":
+            with self.catching_up:
+                if self.backlog is not None:
+                    self.load(message["state"])
+                    # Changes after our request were not in the snapshot
+                    self.replay_backlog(self.backlog.index(None) + 1)
+        elif op == "command" and self.on_command is not None:
+            # Commands may change state themselves, so they get their own thread
+            threading.Thread(target=self.on_command, args=(message["command"],)).start()
+
+    # Function to apply the changes held back from a point on and stop holding them
+    def replay_backlog(self, start):
+        with self.catching_up:
+            backlog = self.backlog
+            self.backlog = None
+            for message in backlog[start:]:
+                self.receive_change(message)
+        self.synced.set()
+
+    # Function called for every change, in the same order on every node
+    def receive_change(self, message):
+        with self.catching_up:
+            if self.backlog is not None:
+                # Our own request for a snapshot marks where the snapshot will be taken
+                own_sync = message["op"] == "sync" and message["node"] == self.node_id
+                self.backlog.append(None if own_sync else message)
+                return
+        if message["op"] == "sync":
+            if message["node"] != self.node_id:
+                # Every up-to-date node answers; the new node keeps the first answer
+                self.pubsub.publish(node_topic(message["node"]), {"op": "snapshot", "state": self.dump()})
+        else:
+            self.apply(message)
+
+    def apply(self, message):
+        own = message["origin"] == self.node_id
+        request = self.requests.pop(message["id"], None) if own else None
+        op, *args = message["change"]
+        if op in ("claim", "remove", "drop_node"):
+            result = self.user_names.apply(op, args, message["origin"], request[2] if request else None)
+        elif op in ("mail", "take_mail"):
+            result = self.user_names.mailboxes.apply(op, args)
+        else:
+            result = self.groups.apply(op, args)
+        if request is not None:
+            request[1] = result
+            request[0].set()
+        elif own and message["id"] is not None:
+            self.abandoned(op, args, result)
+
+    # Function to take back a change whoever asked for it gave up waiting on:
+    # a name claimed for a login that was turned away is let go again, and
+    # mail taken for a user who never got it is sent again
+    def abandoned(self, op, args, result):
+        if op == "claim" and result:
+            self.announce(["remove", args[0]])
+        elif op == "take_mail":
+            for data in result:
+                self.user_names.mailboxes.put([args[0]], data)
+
+    # Function to describe the state for a node that is joining
+    def dump(self):
+        return {
+            "users": sorted([username, connection.node_id if isinstance(connection, RemoteConnection) else self.node_id]
+                            for connection, username in self.user_names.items()),
+            "groups": sorted([group.name, group.generation, sorted(group.members), sorted(group.admins),
+                              self.groups.dump_history(group)]
+                             for group in list(self.groups.groups.values())),
+            "created": self.groups.created,
+            "mail": self.user_names.mailboxes.dump(),
+        }
+
+    # Function to take on the state another node described
+    def load(self, state):
+        for username, node_id in state["users"]:
+            UserRegistry.claim(self.user_names, username, RemoteConnection(self, node_id, username))
+        groups = self.groups.load_all((name, members, admins) for name, generation, members, admins, history in state["groups"])
+        for group, (name, generation, members, admins, history) in zip(groups, state["groups"]):
+            group.generation = generation
+            if history is not None:
+                group.history = History(self.groups.history_size, self.groups.history_bytes)
+                group.history.load(history)
+        self.groups.created = state["created"]
+        self.user_names.mailboxes.load(state["mail"])
+        if self.log is not None:
+            # What the cluster has replaces whatever this node saved
+            self.log.reset(self.groups)
+
+
+# User registry whose changes are made on every node at once
+class SharedUserRegistry(UserRegistry):
+    def __init__(self, node):
+        super().__init__()
+        self.node = node
+
+    def claim(self, username, connection):
+        return self.node.request(["claim", username], connection)
+
+    # Function to forget one of this node's connections
+    def remove(self, connection):
+        username = self.names.get(connection)
+        if username is None or isinstance(connection, RemoteConnection):
+            return None
+        return self.node.request(["remove", username])
+
+    def local_connections(self):
+        return [connection for connection in self.all_connections() if not isinstance(connection, RemoteConnection)]
+
+    # Function to make a change that came from the cluster
+    def apply(self, op, args, origin, connection):
+        if op == "claim":
+            username = args[0]
+            if connection is None:
+                connection = RemoteConnection(self.node, origin, username)
+            return UserRegistry.claim(self, username, connection)
+        if op == "remove":
+            return UserRegistry.remove(self, self.connection_for(args[0]))
+        # drop_node: the node went away, and its users with it
+        for connection, username in self.items():
+            if isinstance(connection, RemoteConnection) and connection.node_id == args[0]:
+                UserRegistry.remove(self, connection)
+
+
+# Group store whose changes are made on every node at once. Changes name a
+# group by name and generation, so a change meant for a group that was
+# deleted never lands on a new group with the same name.
+class SharedGroupStore(GroupStore):
+    def __init__(self, node, **options):
+        super().__init__(**options)
+        self.node = node
+        self.created = 0  # Groups created so far; numbers their generations
+
+    def create(self, name, admin, members, admins=()):
+        return self.node.request(["create", name, admin, list(members), list(admins)])
+
+    def delete(self, group):
+        return self.node.request(["delete", group.name, group.generation])
+
+    def add_members(self, group, usernames):
+        return self.node.request(["add_members", group.name, group.generation, list(usernames)])
+
+    def remove_members(self, group, usernames):
+        return self.node.request(["remove_members", group.name, group.generation, list(usernames)])
+
+    def promote(self, group, username):
+        return self.node.request(["promote", group.name, group.generation, username])
+
+    def change_members(self, group, added, removed, promoted):
+        return self.node.request(["change_members", group.name, group.generation, list(added), list(removed),
+                                  list(promoted)]) or ([], [], [])
+
+    # Every node keeps the history, so message ids are the same everywhere
+    def add_history(self, group, message):
+        if self.history_size:
+            self.node.announce(["add_history", group.name, group.generation,
+                                bytes(message).decode('utf-8', 'surrogateescape')])
+
+    def dump_history(self, group):
+        with group.lock:
+            return None if group.history is None else group.history.dump()
+
+    # Function to make a change that came from the cluster
+    def apply(self, op, args):
+        if op == "create":
+            group = GroupStore.create(self, *args)
+            if group is not None:
+                self.created += 1
+                group.generation = self.created
+            return group
+        name, generation, *args = args
+        group = self.groups.get(name)
+        if group is None or group.generation != generation:
+            if op == "change_members":
+                return [], [], []
+            return False if op in ("delete", "promote") else []
+        if op == "add_history":
+            args = [args[0].encode('utf-8', 'surrogateescape')]
+        return getattr(GroupStore, op)(self, group, *args)
+
+    # Function to number the groups restored from disk as if just created
+    def renumber(self):
+        for group in self.groups.values():
+            self.created += 1
+            group.generation = self.created
+
+
+# Mailboxes kept the same on every node, so users find their mail on
+# whichever node they log in to. Mail and logins are changes like any other;
+# as every node sees them in the same order, each node stores a message
+# unless its user has logged in by then.
+class SharedMailboxes(Mailboxes):
+    def __init__(self, node, user_names, **options):
+        super().__init__(user_names, **options)
+        self.node = node
+
+    def put(self, usernames, data):
+        self.node.announce(["mail", list(usernames), bytes(data).decode('utf-8', 'surrogateescape')])
+
+    # Mail the cluster is slow to hand over is sent again once it does
+    def take(self, username):
+        try:
+            return self.node.request(["take_mail", username]) or []
+        except ClusterTimeout:
+            return []
+
+    # Users of other nodes get the message from their own node
+    def deliver_now(self, connection, data):
+        if not isinstance(connection, RemoteConnection):
+            connection.sendall(data)
+
+    # Function to make a change that came from the cluster
+    def apply(self, op, args):
+        if op == "mail":
+            return Mailboxes.put(self, args[0], args[1].encode('utf-8', 'surrogateescape'))
+        return Mailboxes.take(self, args[0])
+
+
+# Function to get the will a node's pub/sub client leaves with the broker, so
+# the other nodes forget the node's users if it goes away
+def node_will(node_id):
+    return CHANGES, {"op": "change", "origin": None, "id": None, "change": ["drop_node", node_id]}
+
+
+# Function to join a cluster through a pub/sub client; returns the node and
+# the shared registry and group store to serve with
+def join_cluster(pubsub, node_id, log=None, mailbox_options=None, group_options=None):
+    node = Node(pubsub, node_id, log)
+    pubsub.on_close = node.close
+    user_names = SharedUserRegistry(node)
+    user_names.mailboxes = SharedMailboxes(node, user_names, **(mailbox_options or {}))
+    groups = SharedGroupStore(node, **(group_options or {}))
+    node.join(user_names, groups)
+    return node, user_names, groups
@@ -0,0 +1,83 @@
+import time
+import zlib
+
+from metrics import metrics
+from protocol import KIND_COMPRESSED, ProtocolError, encode_frame
+
+# Optional compression of large messages. A framed client that can inflate
+# messages offers it when it connects; if the server compresses (it does
+# unless --compress-threshold is 0) it answers with its threshold. From then
+# on text messages of at least that many bytes go out as compressed frames:
+# raw deflate, primed with a dictionary of text chat messages share, so the
+# frames do not depend on anything sent before them. That is what lets a
+# group or broadcast message be compressed once and the same frame go to
+# every recipient. A fresh zlib stream per message costs less than copying a
+# primed one, and keeps nothing in memory per connection between messages.
+
+# Smallest message compressed by default, in bytes; smaller ones gain little
+COMPRESS_THRESHOLD = 1024
+
+# zlib level by default: 1 is fastest, 9 compresses best
+COMPRESS_LEVEL = 6
+
+# What a compress frame offers or accepts
+DEFLATE = b"deflate"
+
+# Strings common in chat messages, the most common last, where deflate finds
+# them cheapest
+DICTIONARY = (
+    b" the and that have for not with you this but his from they say her she will one all would there their what"
+    b" about which when make can like time just him know take people into year your good some could them see"
+    b" other than then now look only come its over think also back after use two how our work first well way"
+    b" even new want because any these give day most ERROR WARNING INFO DEBUG Traceback (most recent call last):"
+    b" File line in https:// http:// .com .org @group send @group set [Personal Message from [myself (group "
+    b" (group )]: "
+)
+
+
+# Function to make the compressor the command-line options ask for; None if
+# the server does not compress
+def compressors(args):
+    if not args.compress_threshold:
+        return None
+    return Compressor(args.compress_threshold, args.compress_level)
+
+
+class Compressor:
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.level = level
+
+    # Function to build the compressed frame for a payload; None if it is
+    # below the threshold or does not get any smaller
+    def frame(self, payload):
+        if len(payload) < self.threshold:
+            return None
+        started = time.perf_counter() if metrics.enabled else None
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=DICTIONARY)
+        data = compressor.compress(payload) + compressor.flush()
+        if started is not None:
+            metrics.observe("compression_seconds", time.perf_counter() - started)
+        if len(data) >= len(payload):
+            metrics.incr("compression_skipped")
+            return None
+        metrics.incr("messages_compressed")
+        return encode_frame(data, KIND_COMPRESSED)
+
+
+class Decompressor:
+    def __init__(self, max_size):
+        self.max_size = max_size  # Largest message inflated, 0 for no limit; a bigger one is refused
+
+    # Function to get a compressed frame's payload back
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DICTIONARY)
+        try:
+            payload = decompressor.decompress(data, self.max_size)
+        except zlib.error as e:
+            raise ProtocolError(f"compressed message is corrupt: {e}")
+        if decompressor.unconsumed_tail:
+            raise ProtocolError(f"compressed message inflates past the {self.max_size} byte limit")
+        if not decompressor.eof:
+            raise ProtocolError("compressed message is truncated")
+        return payload
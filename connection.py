@@ -0,0 +1,600 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import socket
+import threading
+import time
+import weakref
+
+from compression import DEFLATE, Decompressor
+from metrics import metrics, size_buckets
+from protocol import (HELLO, KIND_ACK, KIND_COMPRESS, KIND_COMPRESSED, KIND_PING, KIND_PONG, KIND_SESSION, KIND_TEXT,
+                      MAX_FRAME_SIZE, FrameDecoder, TextDecoder, encode_frame, frame_header)
+
+# What to do when a user's outbound queue is full
+DROP_OLDEST = "drop-oldest"   # Throw away the oldest queued message
+DISCONNECT = "disconnect"     # Disconnect the slow user
+BLOCK = "block"               # Make the sender wait until there is room
+overflow_policies = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# Messages a user may have waiting to be written by default
+QUEUE_SIZE = 1000
+
+# Seconds a user has to answer a question by default
+PROMPT_TIMEOUT = 60
+
+# Seconds a writer waits for more messages before writing, and the bytes it
+# writes at most at a time, by default. Whatever is queued when the writer
+# is ready goes out in one write, waiting or not.
+FLUSH_INTERVAL = 0
+FLUSH_BYTES = 64 * 1024
+
+# Most messages in one vectored write (IOV_MAX on Linux)
+MAX_BATCH = 1024
+
+# How the kernel sends what is written
+NODELAY = "nodelay"  # Send every write at once
+NAGLE = "nagle"      # Hold small writes back while earlier data is unacknowledged
+CORK = "cork"        # Hold partial packets back until the whole batch is written (Linux)
+tcp_modes = (NODELAY, NAGLE, CORK) if hasattr(socket, "TCP_CORK") else (NODELAY, NAGLE)
+
+
+# The connection whose tagged command is being handled, and the tag its
+# replies start with (see tagged_replies). A context variable, so only what
+# the handler sends is tagged, not what other threads send meanwhile.
+replying = contextvars.ContextVar("replying", default=None)
+
+
+# Function to set a user's socket up for the chosen TCP mode
+def tune_socket(sock, tcp_mode):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0 if tcp_mode == NAGLE else 1)
+    except OSError:
+        pass  # Not a TCP socket
+
+
+# Message encoded once and handed to every recipient of a fan-out. Framed and
+# plain text recipients share one buffer: the text payload is a view into the
+# frame. Recipients that take compressed messages share one compressed frame.
+class SharedMessage:
+    __slots__ = ("frame", "payload", "compressed")
+
+    def __init__(self, payload):
+        self.frame = encode_frame(payload)
+        self.payload = memoryview(self.frame)[frame_header.size:]
+        self.compressed = None  # The frame compressed recipients get, once made
+
+    # Function to get the frame for recipients that take compressed messages.
+    # It is made for the first of them; if two threads race to make it, both
+    # make the same frame.
+    def compressed_frame(self, compressor):
+        frame = self.compressed
+        if frame is None:
+            frame = self.compressed = compressor.frame(self.payload) or self.frame
+        return frame
+
+
+# Question a command asked the user. The user's next message that is not a
+# command answers it; if none comes in time, or the user leaves, on_timeout
+# runs instead.
+class Prompt:
+    __slots__ = ("on_answer", "on_timeout", "timer")
+
+    def __init__(self, on_answer, on_timeout):
+        self.on_answer = on_answer
+        self.on_timeout = on_timeout
+        self.timer = None
+
+
+# Every connection not yet garbage, for the outbound_queued gauge; summing
+# their queues when the metrics are read keeps the lock off every message
+live_connections = weakref.WeakSet()
+live_connections_lock = threading.Lock()
+
+
+# Function to count the messages waiting in every queue
+def queued_messages():
+    with live_connections_lock:
+        return sum(len(connection.outbox) for connection in live_connections)
+
+
+metrics.sample("outbound_queued", queued_messages)
+
+
+# Behaviour shared by the connections of every engine. The command handlers
+# only ever call sendall(), ask() and close(), much as they would on a socket;
+# the connection takes care of framing when the client negotiated it and
+# queues outgoing messages so a slow user never stalls the sender.
+class Connection:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, queue_size=QUEUE_SIZE, overflow_policy=DROP_OLDEST,
+                 prompt_timeout=PROMPT_TIMEOUT, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES, tcp_mode=NODELAY):
+        self.max_frame_size = max_frame_size
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.prompt_timeout = prompt_timeout
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.cork = tcp_mode == CORK
+        self.prompt = None  # The question waiting for an answer, if any
+        self.prompt_lock = threading.Lock()
+        self.outbox = collections.deque()
+        self.outbox_bytes = 0
+        self.decoder = None  # Chosen once we know which protocol the client speaks
+        self.pending = b''   # Bytes received before the protocol is known
+        self.framed = False
+        self.closed = False
+        self.limits = None   # The user's rate limits, once logged in, if the server has any
+        self.last_received = time.monotonic()  # When the user last sent anything
+        self.partial_since = None  # When the message still arriving started, if any
+        self.pinged = 0.0    # When the user was last pinged
+        self.resumable = False  # Whether the client asked for a session, and may still resume it
+        self.session = None  # The user's resumable session, if they have one
+        self.compressor = None  # Compression the server offers, if any; set by the server
+        self.decompressor = None  # Set once the client agreed to compression
+        with live_connections_lock:
+            live_connections.add(self)
+
+    # Function to queue raw bytes for the connection's writer, provided by each engine
+    def write(self, data):
+        raise NotImplementedError
+
+    # Function for writes that come after the connection closed. They are
+    # lost, unless the user's session is waiting to be resumed.
+    def write_closed(self, data):
+        session = self.session
+        if session is not None:
+            session.hold(data)
+
+    # Function to send one message to the user
+    def sendall(self, data):
+        tagged = replying.get()
+        if tagged is not None and tagged[0] is self:
+            data = tagged[1] + data
+        if self.decompressor is not None:
+            data = self.compressor.frame(data) or encode_frame(data)
+        elif self.framed:
+            data = encode_frame(data)
+        self.write(data)
+
+    # Function to send a message that was encoded once for many recipients
+    def send_shared(self, message):
+        if self.decompressor is not None:
+            self.write(message.compressed_frame(self.compressor))
+        else:
+            self.write(message.frame if self.framed else message.payload)
+
+    # Function to send many messages with one write, taking one place in the
+    # outbound queue; plain text clients get them a line each
+    def send_batch(self, messages):
+        tagged = replying.get()
+        if tagged is not None and tagged[0] is self:
+            messages = [tagged[1] + data for data in messages]
+        if self.decompressor is not None:
+            self.write(b''.join(self.compressor.frame(data) or encode_frame(data) for data in messages))
+        elif self.framed:
+            self.write(b''.join(encode_frame(data) for data in messages))
+        else:
+            self.write(b''.join(bytes(data) + b'\n' for data in messages))
+
+    # Function to tag every reply sent to the user while a command of theirs
+    # runs in the with block
+    @contextlib.contextmanager
+    def tagged_replies(self, tag):
+        token = replying.set((self, f"{tag} ".encode('utf-8')))
+        try:
+            yield
+        finally:
+            replying.reset(token)
+
+    # Function to ask the user a question without waiting for the answer. A
+    # question that is still open is given up on first.
+    def ask(self, question, on_answer, on_timeout):
+        prompt = Prompt(on_answer, on_timeout)
+        with self.prompt_lock:
+            previous, self.prompt = self.prompt, prompt
+        if previous is not None:
+            self.give_up(previous)
+        self.sendall(question)
+        prompt.timer = self.call_later(self.prompt_timeout, self.expire, prompt)
+
+    # Function to take the open question so nobody else can answer it; None if
+    # there is none, or if it is not the given one any more
+    def take_prompt(self, prompt=None):
+        with self.prompt_lock:
+            current = self.prompt
+            if current is None or (prompt is not None and current is not prompt):
+                return None
+            self.prompt = None
+        if current.timer is not None:
+            current.timer.cancel()
+        return current
+
+    # Function run by a question's timer
+    def expire(self, prompt):
+        if self.take_prompt(prompt) is not None:
+            self.give_up(prompt)
+
+    # Function to run the timeout action of a question that was taken
+    def give_up(self, prompt):
+        if prompt.timer is not None:
+            prompt.timer.cancel()
+        try:
+            prompt.on_timeout()
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+    # Function to run a callback after a delay; returns something with cancel()
+    def call_later(self, delay, callback, *args):
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    # Function to make room in a full outbound queue; False if the message must not be queued
+    def overflow(self):
+        if self.overflow_policy == DROP_OLDEST:
+            self.outbox_bytes -= len(self.outbox.popleft())
+            metrics.incr("outbound_dropped")
+            return True
+        metrics.incr("outbound_overflow_disconnects")
+        self.abort()
+        return False
+
+    # Function to queue a message for the writer
+    def enqueue(self, data):
+        self.outbox.append(data)
+        self.outbox_bytes += len(data)
+
+    # Function to take the queued messages for one write, up to flush_bytes
+    def take_batch(self):
+        metrics.observe("outbound_queue_depth", len(self.outbox), size_buckets)
+        data = self.outbox.popleft()
+        batch = [data]
+        size = len(data)
+        while self.outbox and size < self.flush_bytes and len(batch) < MAX_BATCH:
+            data = self.outbox.popleft()
+            batch.append(data)
+            size += len(data)
+        self.outbox_bytes -= size
+        if self.session is not None:
+            self.session.taken(batch)
+        if not self.framed and len(batch) > 1:
+            # Plain text has no frames to tell messages apart, so messages
+            # that go out in one write get a line each, as in send_batch
+            batch = [data if data[-1:] == b'\n' else bytes(data) + b'\n' for data in batch[:-1]] + batch[-1:]
+        return batch
+
+    # Function to drop every queued message; a session keeps them for its
+    # user to resume
+    def clear_outbox(self):
+        session = self.session
+        if session is not None and self.outbox:
+            session.unsent(self.outbox)
+        self.outbox.clear()
+        self.outbox_bytes = 0
+
+    # Function to record one write of a batch to the socket
+    def wrote(self, batch, writes, started):
+        if started is not None:
+            metrics.observe("socket_write_seconds", time.perf_counter() - started)
+            metrics.incr("socket_writes", writes)
+            metrics.incr("socket_messages", len(batch))
+            metrics.observe("write_batch_messages", len(batch), size_buckets)
+
+    # Function to cork the socket before a batch or uncork it after, so the
+    # batch leaves in full packets
+    def set_cork(self, sock, on):
+        if self.cork:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+            except OSError:
+                pass
+
+    # Function to turn received bytes into complete messages
+    def unpack(self, data):
+        self.last_received = now = time.monotonic()
+        messages = self.decode(data)
+        if self.pending or (self.framed and self.decoder.buffer):
+            if self.partial_since is None:
+                self.partial_since = now
+        else:
+            self.partial_since = None
+        return messages
+
+    def decode(self, data):
+        if self.decoder is None:
+            data = self.pending + data
+            if data.startswith(HELLO):
+                # The client asked for frames; acknowledge and switch over
+                self.framed = True
+                self.decoder = FrameDecoder(self.max_frame_size)
+                self.write(HELLO)
+                data = data[len(HELLO):]
+            elif HELLO.startswith(data):
+                # Could still be the start of HELLO, wait for more bytes
+                self.pending = data
+                return []
+            else:
+                self.decoder = TextDecoder()
+            self.pending = b''
+
+        if self.framed:
+            messages = []
+            for kind, payload in self.decoder.feed(data):
+                if kind == KIND_TEXT:
+                    messages.append(payload.decode('utf-8', 'replace'))
+                elif kind == KIND_COMPRESSED and self.decompressor is not None:
+                    messages.append(self.decompressor.decompress(payload).decode('utf-8', 'replace'))
+                elif kind == KIND_PING:
+                    self.write(encode_frame(payload, KIND_PONG))
+                elif kind == KIND_PONG:
+                    self.pong(payload)
+                elif kind == KIND_SESSION:
+                    self.resumable = True
+                elif kind == KIND_ACK and self.session is not None and payload.isdigit():
+                    self.session.ack(int(payload))
+                elif kind == KIND_COMPRESS and payload == DEFLATE and self.compressor is not None:
+                    self.decompressor = Decompressor(self.max_frame_size)
+                    self.write(encode_frame(DEFLATE + f" {self.compressor.threshold}".encode('utf-8'), KIND_COMPRESS))
+            return messages
+        return self.decoder.feed(data)
+
+    # Function to time the round trip of a ping the user answered
+    def pong(self, payload):
+        try:
+            sent = int(payload)
+        except ValueError:
+            return
+        metrics.observe("ping_round_trip_seconds", (time.monotonic_ns() - sent) / 1e9)
+
+
+# Connection of the threaded engine. The user's thread reads; a second thread
+# per connection drains the outbound queue.
+class UserConnection(Connection):
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE, queue_size=QUEUE_SIZE, overflow_policy=DROP_OLDEST,
+                 prompt_timeout=PROMPT_TIMEOUT, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES, tcp_mode=NODELAY):
+        super().__init__(max_frame_size, queue_size, overflow_policy, prompt_timeout, flush_interval, flush_bytes, tcp_mode)
+        self.sock = sock
+        tune_socket(sock, tcp_mode)
+        self.received = collections.deque()
+        self.outbox_changed = threading.Condition()
+        self.writer = threading.Thread(target=self.drain_outbox, daemon=True)
+        self.writer.start()
+
+    def write(self, data):
+        with self.outbox_changed:
+            if self.closed:
+                self.write_closed(data)
+                return
+            if len(self.outbox) >= self.queue_size:
+                if self.overflow_policy == BLOCK:
+                    while len(self.outbox) >= self.queue_size and not self.closed:
+                        self.outbox_changed.wait()
+                    if self.closed:
+                        return
+                elif not self.overflow():
+                    return
+            self.enqueue(data)
+            self.outbox_changed.notify_all()
+
+    # Function run by the writer thread until the connection is closed and
+    # flushed. Everything queued by the time it is ready goes out in one write.
+    def drain_outbox(self):
+        while True:
+            with self.outbox_changed:
+                while not self.outbox and not self.closed:
+                    self.outbox_changed.wait()
+                if self.flush_interval:
+                    # Let more messages pile up, for up to the interval
+                    deadline = time.monotonic() + self.flush_interval
+                    while not self.closed and self.outbox_bytes < self.flush_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.outbox_changed.wait(remaining)
+                if not self.outbox:
+                    break
+                batch = self.take_batch()
+                # Wake senders waiting for room
+                self.outbox_changed.notify_all()
+            try:
+                self.send_batch_now(batch)
+            except OSError:
+                self.abort()
+                break
+        self.sock.close()
+
+    # Function to write a batch with as few system calls as the platform allows
+    def send_batch_now(self, batch):
+        started = time.perf_counter() if metrics.enabled else None
+        writes = 1
+        self.set_cork(self.sock, True)
+        if len(batch) == 1:
+            self.sock.sendall(batch[0])
+        elif hasattr(self.sock, "sendmsg"):
+            # One vectored write, repeated for whatever did not fit
+            unsent = batch
+            while True:
+                sent = self.sock.sendmsg(unsent)
+                while unsent and sent >= len(unsent[0]):
+                    sent -= len(unsent[0])
+                    unsent = unsent[1:]
+                if not unsent:
+                    break
+                unsent[0] = memoryview(unsent[0])[sent:]
+                writes += 1
+        else:
+            self.sock.sendall(b''.join(batch))
+        self.set_cork(self.sock, False)
+        self.wrote(batch, writes, started)
+
+    # Function to wait for the next complete message; None once the user disconnects
+    def recv_message(self):
+        while not self.received:
+            if self.closed:
+                return None
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.received.extend(self.unpack(data))
+        return self.received.popleft()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    # Function to stop reading now and close once queued messages are written
+    def close(self):
+        # Shut down before waking the writer, which closes the socket once
+        # the queue is empty
+        self.shutdown(socket.SHUT_RD)
+        with self.outbox_changed:
+            self.closed = True
+            self.outbox_changed.notify_all()
+
+    # Function to close straight away, discarding queued messages
+    def abort(self):
+        self.shutdown(socket.SHUT_RDWR)
+        with self.outbox_changed:
+            self.closed = True
+            self.clear_outbox()
+            self.outbox_changed.notify_all()
+
+    def shutdown(self, how):
+        # Wakes up the user's thread if it is blocked in recv()
+        try:
+            self.sock.shutdown(how)
+        except OSError:
+            pass
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+
+# Async connections that went over their queue size under the block policy;
+# handle_user_async waits for them before reading the sender's next message
+congested = set()
+
+
+# Function to wait until every congested connection has room again
+async def wait_for_room():
+    while congested:
+        await congested.pop().has_room.wait()
+
+
+# Connection of the asyncio engine. A writer task drains the outbound queue
+# into the stream; writes from other threads (server commands) are handed
+# over to the loop.
+class AsyncUserConnection(Connection):
+    def __init__(self, reader, writer, max_frame_size=MAX_FRAME_SIZE, queue_size=QUEUE_SIZE, overflow_policy=DROP_OLDEST,
+                 prompt_timeout=PROMPT_TIMEOUT, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES, tcp_mode=NODELAY):
+        super().__init__(max_frame_size, queue_size, overflow_policy, prompt_timeout, flush_interval, flush_bytes, tcp_mode)
+        self.reader = reader
+        self.writer = writer
+        # asyncio turns Nagle off on its own; turn it back on if asked to
+        if tcp_mode == NAGLE:
+            tune_socket(writer.get_extra_info('socket'), tcp_mode)
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.received = collections.deque()
+        self.outbox_ready = asyncio.Event()
+        self.flush_timer = None  # Sets outbox_ready once the flush interval is up
+        self.has_room = asyncio.Event()
+        self.has_room.set()
+        self.writer_task = self.loop.create_task(self.drain_outbox())
+
+    def write(self, data):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.write, data)
+            return
+        if self.closed:
+            self.write_closed(data)
+            return
+        if len(self.outbox) >= self.queue_size:
+            if self.overflow_policy == BLOCK:
+                # The loop cannot block, so queue anyway and hold back the sender instead
+                self.has_room.clear()
+                congested.add(self)
+            elif not self.overflow():
+                return
+        self.enqueue(data)
+        if not self.flush_interval or self.outbox_bytes >= self.flush_bytes:
+            self.outbox_ready.set()
+        elif self.flush_timer is None:
+            # Let more messages pile up, for up to the interval
+            self.flush_timer = self.loop.call_later(self.flush_interval, self.outbox_ready.set)
+
+    # Function run by the writer task until the connection is closed and flushed
+    async def drain_outbox(self):
+        try:
+            while True:
+                # Wait for messages, and for the flush interval if there is one;
+                # once closed, whatever is left goes out straight away
+                while not self.outbox or not self.outbox_ready.is_set():
+                    if self.closed:
+                        if not self.outbox:
+                            return
+                        break
+                    self.outbox_ready.clear()
+                    await self.outbox_ready.wait()
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+                batch = self.take_batch()
+                started = time.perf_counter() if metrics.enabled else None
+                sock = self.writer.get_extra_info('socket')
+                self.set_cork(sock, True)
+                # The transport joins the batch and writes it with one call
+                self.writer.writelines(batch)
+                self.set_cork(sock, False)
+                await self.writer.drain()
+                self.wrote(batch, 1, started)
+                if len(self.outbox) < self.queue_size:
+                    self.has_room.set()
+        except (ConnectionError, OSError):
+            self.abort()
+        finally:
+            self.has_room.set()
+            self.writer.close()
+
+    # Function to wait for the next complete message; None once the user disconnects
+    async def recv_message(self):
+        while not self.received:
+            if self.closed:
+                return None
+            data = await self.reader.read(4096)
+            if not data:
+                return None
+            self.received.extend(self.unpack(data))
+        return self.received.popleft()
+
+    # Questions asked from the loop have their timers run on it too, in a
+    # fresh context so that a question asked while replying to a tagged
+    # command does not tag what its timeout sends. Handlers that run on a
+    # thread (in a cluster) get a timer thread, as on the threaded engine.
+    def call_later(self, delay, callback, *args):
+        if threading.get_ident() != self.loop_thread:
+            return super().call_later(delay, callback, *args)
+        return self.loop.call_later(delay, callback, *args, context=contextvars.Context())
+
+    # Function to close once queued messages are written
+    def close(self):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.close)
+            return
+        self.closed = True
+        self.outbox_ready.set()
+
+    # Function to close straight away, discarding queued messages
+    def abort(self):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.abort)
+            return
+        self.closed = True
+        self.clear_outbox()
+        self.outbox_ready.set()
+        self.has_room.set()
+        self.writer.transport.abort()
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
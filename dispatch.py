@@ -0,0 +1,127 @@
+# Table-driven command dispatch. The command table is turned into a trie of
+# words once, at startup; a message walks it a word at a time and stops at
+# the first word that is not part of a command, so it is scanned once however
+# many commands there are. Each command parses its own arguments with one of
+# the parsers below before its handler runs, so handlers get ready-made
+# values instead of splitting the message again.
+
+
+# A command the server understands
+class Command:
+    __slots__ = ("handler", "parse", "usage", "limit", "name")
+
+    def __init__(self, handler, parse=None, usage=None, limit=None):
+        self.handler = handler
+        self.parse = parse or no_arguments  # Turns the rest of the message into the handler's arguments; None if invalid
+        self.usage = usage  # Sent back when the arguments are missing or invalid
+        self.limit = limit  # Rate limit the command counts against, besides the one on every message
+        self.name = None    # Name for metrics, set from the command's words
+
+
+# Function for commands that take no arguments; anything after them is ignored
+def no_arguments(rest):
+    return ()
+
+
+# Function to parse "<group_name>"
+def name_only(rest):
+    words = rest.split(None, 1)
+    return (words[0],) if words else None
+
+
+# Function to parse "<group_name> <text>", keeping the text as it was typed
+def name_and_text(rest):
+    words = rest.split(None, 1)
+    return tuple(words) if len(words) == 2 else None
+
+
+# Function to parse "<group_name> <user>, <user>, ..."; spaces in the list
+# are ignored
+def name_and_list(rest):
+    words = rest.split(None, 1)
+    if len(words) < 2:
+        return None
+    return words[0], "".join(words[1].split()).split(",")
+
+
+# Function to parse "<group_name> [number] [number]" with numbers from 1 up;
+# missing numbers are None
+def name_and_numbers(rest):
+    words = rest.split()[:3]
+    if not words or not all(word.isdigit() and int(word) > 0 for word in words[1:]):
+        return None
+    numbers = [int(word) for word in words[1:]]
+    return (words[0], *numbers, *[None] * (2 - len(numbers)))
+
+
+# Function to parse "<group_name> <change> <user>, <user>, ...; <change> ..."
+# into the name and a list of (change, usernames); "set" may only come first
+def name_and_changes(rest):
+    words = rest.split(None, 1)
+    if len(words) < 2:
+        return None
+    changes = []
+    for part in words[1].split(";"):
+        op, _, usernames = part.strip().partition(" ")
+        usernames = [username for username in "".join(usernames.split()).split(",") if username]
+        if op not in ("set", "add", "remove", "authorize") or not usernames or (op == "set" and changes):
+            return None
+        changes.append((op, usernames))
+    return words[0], changes
+
+
+# Function to parse "[prefix] [after <username>]"; missing parts are "" and None
+def names_query(rest):
+    words = rest.split()
+    if len(words) > 1 and words[-2] == "after":
+        prefix, after = words[:-2], words[-1]
+    else:
+        prefix, after = words, None
+    if len(prefix) > 1:
+        return None
+    return (prefix[0] if prefix else "", after)
+
+
+# Function to make a parser for one word out of a few choices
+def one_of(*choices):
+    def parse(rest):
+        words = rest.split()
+        return (words[0],) if len(words) == 1 and words[0] in choices else None
+    return parse
+
+
+class CommandTable:
+    def __init__(self, commands):
+        root = {}
+        for key, command in commands.items():
+            command.name = key[1:].replace(" ", "_")
+            node = root
+            for word in key.split():
+                node = node.setdefault(word, {})
+            node[None] = command  # The command whose words end here
+        self.root = self.compact(root)
+
+    # Function to replace the nodes that hold only a command with the command
+    # itself, so lookups stop a step sooner
+    def compact(self, node):
+        if list(node) == [None]:
+            return node[None]
+        return {word: child if word is None else self.compact(child) for word, child in node.items()}
+
+    # Function to find the command a message invokes. Returns the command and
+    # the rest of the message; the command is None if there is none, and
+    # then the flag says whether the message started like one (as
+    # "@group bogus" does) rather than not at all.
+    def lookup(self, message):
+        node = self.root
+        rest = message
+        while True:
+            word, _, remainder = rest.partition(" ")
+            child = node.get(word)
+            if child is None:
+                command = node.get(None)
+                return command, rest, command is None and node is not self.root
+            if child.__class__ is Command:
+                return child, remainder.lstrip(), False
+            node = child
+            rest = remainder.lstrip()
@@ -0,0 +1,166 @@
+import socket
+import threading
+import time
+
+from metrics import metrics
+from protocol import KIND_PING, encode_frame
+
+# Finding users who are gone without having said so. A client that vanished
+# (power loss, a dropped network) leaves a half-open connection that is only
+# noticed when a write to it fails, which may be never. So the server pings
+# framed users who have been quiet for --ping-interval seconds and
+# disconnects users who stay silent for --idle-timeout seconds, not even
+# answering a ping. A message that starts arriving must also be complete
+# within --read-timeout seconds. TCP keepalive (--keepalive) catches the
+# peers that are gone at the network level as well.
+#
+# Rather than a timer per connection, every connection has one entry in a
+# timer wheel, a ring of slots ticked over by a single thread. Receiving a
+# message only stores the time; when a connection's slot comes round its
+# deadlines are checked and, if it is still alive, it goes back in the wheel
+# for the next one.
+
+# Seconds of silence before a framed user is pinged, by default
+PING_INTERVAL = 30
+
+# Seconds of silence before a user is disconnected, by default. Plain text
+# users cannot be pinged, so they are only disconnected if asked for.
+IDLE_TIMEOUT = 90
+PLAIN_IDLE_TIMEOUT = 0
+
+# Seconds a message may take to arrive once it has started, by default
+READ_TIMEOUT = 30
+
+# Seconds a disconnected user's last messages get to be written
+CLOSE_GRACE = 1
+
+# Seconds of silence before the kernel probes a connection, by default
+KEEPALIVE = 60
+
+# Seconds per slot of the timer wheel, and slots in it. Timers due further
+# ahead than the wheel reaches fire early and are put back.
+WHEEL_TICK = 0.5
+WHEEL_SLOTS = 256
+
+
+# Function to make the heartbeat the command-line options ask for; None if
+# nothing needs watching
+def heartbeats(args):
+    if not (args.ping_interval or args.idle_timeout or args.plain_idle_timeout or args.read_timeout):
+        return None
+    return Heartbeat(TimerWheel(), args.ping_interval, args.idle_timeout, args.plain_idle_timeout, args.read_timeout)
+
+
+# Function to have the kernel probe a connection that has been silent for
+# the given seconds, and give up on it after three unanswered probes
+def set_keepalive(sock, seconds):
+    if not seconds:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(seconds)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(seconds) // 3))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    except OSError:
+        pass  # Not a TCP socket
+
+
+# Function to build the ping sent to a framed user; it carries the time it was
+# sent, which the pong sends back
+def ping_frame():
+    return encode_frame(str(time.monotonic_ns()).encode('utf-8'), KIND_PING)
+
+
+class TimerWheel:
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0  # Slot the next tick runs
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Function to run callback(*args) on the wheel's thread after about delay
+    # seconds, give or take a tick
+    def schedule(self, delay, callback, *args):
+        ticks = min(max(1, int(delay / self.tick) + 1), len(self.slots) - 1)
+        with self.lock:
+            self.slots[(self.position + ticks) % len(self.slots)].append((callback, args))
+        metrics.incr("timers_pending")
+
+    # Function run by the wheel's thread, one slot per tick
+    def run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                due = self.slots[self.position]
+                self.slots[self.position] = []
+                self.position = (self.position + 1) % len(self.slots)
+            metrics.incr("timers_pending", -len(due))
+            for callback, args in due:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f"Unexpected error: {e}")
+
+
+class Heartbeat:
+    def __init__(self, wheel, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 plain_idle_timeout=PLAIN_IDLE_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.wheel = wheel
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.plain_idle_timeout = plain_idle_timeout
+        self.read_timeout = read_timeout
+
+    # Function to start watching a user who just logged in
+    def watch(self, connection):
+        self.check(connection)
+
+    # Function run when a connection's slot comes round: ping or disconnect it
+    # if it is overdue, then put it back in the wheel for its next deadline.
+    # Connections that closed drop out here.
+    def check(self, connection):
+        if connection.closed:
+            return
+        now = time.monotonic()
+        idle_timeout = self.idle_timeout if connection.framed else self.plain_idle_timeout
+        partial_since = connection.partial_since
+        if self.read_timeout and partial_since is not None and now - partial_since >= self.read_timeout:
+            self.disconnect(connection, "read_timeouts", "a message took too long to arrive")
+            return
+        if idle_timeout and now - connection.last_received >= idle_timeout:
+            self.disconnect(connection, "idle_disconnects", "idle for too long")
+            return
+
+        deadlines = []
+        if idle_timeout:
+            deadlines.append(connection.last_received + idle_timeout)
+        if self.read_timeout:
+            # A message may start arriving at any time
+            deadlines.append((partial_since or now) + self.read_timeout)
+        if connection.framed and self.ping_interval:
+            quiet_since = max(connection.last_received, connection.pinged)
+            if now - quiet_since >= self.ping_interval:
+                connection.pinged = now
+                connection.write(ping_frame())
+                metrics.incr("pings_sent")
+                quiet_since = now
+            deadlines.append(quiet_since + self.ping_interval)
+        if deadlines:
+            self.wheel.schedule(min(deadlines) - now, self.check, connection)
+
+    # Function to tell a user why they are disconnected and disconnect them.
+    # A peer that is gone never reads the notice, so the connection is
+    # aborted if it has not closed by the next slot or two.
+    def disconnect(self, connection, counter, reason):
+        metrics.incr(counter)
+        print(f"A user was disconnected: {reason}")
+        connection.sendall(f"[Disconnected: {reason}]".encode('utf-8'))
+        connection.close()
+        self.wheel.schedule(CLOSE_GRACE, connection.abort)
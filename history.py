@@ -0,0 +1,91 @@
+import array
+
+# Recent messages of a group, for @group history. A group keeps its last
+# --history-size messages in a ring: the bytes of all of them share one
+# buffer of --history-bytes bytes, and where each one starts and how long it
+# is sit in two arrays, so a group's history is three objects however many
+# messages it holds. Messages are numbered from 1 in the order they were
+# sent; the oldest make way for new ones when either limit is reached.
+
+# Messages kept per group by default
+HISTORY_SIZE = 200
+
+# Bytes of messages kept per group by default
+HISTORY_BYTES = 64 * 1024
+
+# Messages returned by @group history when no count is given, and at most
+HISTORY_PAGE = 20
+HISTORY_PAGE_MAX = 100
+
+
+# Function to get the history options given on the command line
+def history_options(args):
+    return {"history_size": args.history_size, "history_bytes": args.history_bytes}
+
+
+class History:
+    __slots__ = ("data", "starts", "lengths", "first_id", "next_id", "write_at", "used")
+
+    def __init__(self, size=HISTORY_SIZE, capacity=HISTORY_BYTES):
+        self.data = bytearray(capacity)
+        self.starts = array.array('L', bytes(array.array('L').itemsize * size))
+        self.lengths = array.array('L', bytes(array.array('L').itemsize * size))
+        self.first_id = 1  # Id of the oldest message kept
+        self.next_id = 1   # Id the next message gets
+        self.write_at = 0  # Where in data the next message goes
+        self.used = 0      # Bytes of data taken by the messages kept
+
+    def __len__(self):
+        return self.next_id - self.first_id
+
+    # Function to add a message; returns its id. A message larger than the
+    # whole buffer is cut short.
+    def append(self, message):
+        message = bytes(message[:len(self.data)])
+        # Drop the oldest messages until there is a free slot and room
+        while len(self) == len(self.starts) or self.used + len(message) > len(self.data):
+            self.used -= self.lengths[self.first_id % len(self.starts)]
+            self.first_id += 1
+
+        slot = self.next_id % len(self.starts)
+        self.starts[slot] = self.write_at
+        self.lengths[slot] = len(message)
+        end = self.write_at + len(message)
+        if end <= len(self.data):
+            self.data[self.write_at:end] = message
+        else:
+            # Wraps around the end of the buffer
+            split = len(self.data) - self.write_at
+            self.data[self.write_at:] = message[:split]
+            self.data[:end - len(self.data)] = message[split:]
+        self.write_at = end % len(self.data)
+        self.used += len(message)
+        self.next_id += 1
+        return self.next_id - 1
+
+    # Function to copy out one message
+    def get(self, message_id):
+        slot = message_id % len(self.starts)
+        start = self.starts[slot]
+        end = start + self.lengths[slot]
+        if end <= len(self.data):
+            return bytes(self.data[start:end])
+        return bytes(self.data[start:]) + bytes(self.data[:end - len(self.data)])
+
+    # Function to get up to count messages sent before before_id (or the
+    # newest ones), oldest first, as (id, message) pairs
+    def page(self, before_id=None, count=HISTORY_PAGE):
+        end = self.next_id if before_id is None else max(self.first_id, min(before_id, self.next_id))
+        start = max(self.first_id, end - count)
+        return [(message_id, self.get(message_id)) for message_id in range(start, end)]
+
+    # Function to describe the history for a node that is joining a cluster
+    def dump(self):
+        return [self.first_id, [message.decode('utf-8', 'surrogateescape') for message_id, message in self.page(count=len(self))]]
+
+    # Function to take on a history another node described
+    def load(self, state):
+        first_id, messages = state
+        self.first_id = self.next_id = first_id
+        for message in messages:
+            self.append(message.encode('utf-8', 'surrogateescape'))
@@ -0,0 +1,204 @@
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+
+# Counters, gauges and histograms for the server's hot paths. They are shown
+# by @stats and, when asked for, served over HTTP in the Prometheus text
+# format (--metrics-port) or written to a JSON file (--metrics-file). With
+# --no-metrics nothing is recorded: every update returns straight away, and
+# the few places that time things check metrics.enabled first.
+
+# Upper bounds (in seconds) of the latency histogram buckets
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Upper bounds of the buckets for sizes and counts (queue depths, fan-out)
+size_buckets = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+# Counters that go down as well as up
+gauges = ("outbound_queued", "timers_pending", "users_connected")
+
+# Seconds between writes of --metrics-file by default
+METRICS_INTERVAL = 10
+
+
+# Histogram with fixed buckets, cheap enough to update on every message
+class Histogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot counts values above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Estimate a percentile as the upper bound of the bucket it falls in
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "buckets": list(zip(self.buckets, self.counts)),
+        }
+
+
+# Counters and histograms shared by every part of the server
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.sampled = {}  # Gauge name -> function giving its value, called for each snapshot
+
+    # Updates run for every message and recipient; acquire() and release()
+    # cost less than a with block
+    def incr(self, name, value=1):
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, buckets=latency_buckets):
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+        finally:
+            self.lock.release()
+
+    # Function to have a gauge worked out when the metrics are read, for
+    # values too hot to count as they change
+    def sample(self, name, function):
+        self.sampled[name] = function
+
+    def snapshot(self):
+        sampled = {name: function() for name, function in self.sampled.items()}
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "counters": {**self.counters, **sampled},
+                "histograms": {name: histogram.summary() for name, histogram in self.histograms.items()},
+            }
+
+
+# Function to render a snapshot as text for the server console
+def format_snapshot(snapshot):
+    lines = [f"uptime {snapshot['uptime']:.0f}s"]
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f"{name} {value}")
+    for name, summary in sorted(snapshot["histograms"].items()):
+        lines.append(f"{name} count={summary['count']} p50<={summary['p50']} p99<={summary['p99']}")
+    return "\n".join(lines)
+
+
+# Function to render a snapshot in the Prometheus text format
+def format_prometheus(snapshot):
+    lines = ["# TYPE chat_uptime_seconds gauge", f"chat_uptime_seconds {snapshot['uptime']}"]
+    for name, value in sorted(snapshot["counters"].items()):
+        kind = "gauge" if name in gauges else "counter"
+        lines.append(f"# TYPE chat_{name} {kind}")
+        lines.append(f"chat_{name} {value}")
+    for name, summary in sorted(snapshot["histograms"].items()):
+        lines.append(f"# TYPE chat_{name} histogram")
+        seen = 0
+        for bound, count in summary["buckets"]:
+            seen += count
+            lines.append(f'chat_{name}_bucket{{le="{bound}"}} {seen}')
+        lines.append(f'chat_{name}_bucket{{le="+Inf"}} {summary["count"]}')
+        lines.append(f"chat_{name}_sum {summary['sum']}")
+        lines.append(f"chat_{name}_count {summary['count']}")
+    return "\n".join(lines) + "\n"
+
+
+# Serves GET /metrics (Prometheus text) and GET /metrics.json
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = format_prometheus(metrics.snapshot()).encode('utf-8')
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(metrics.snapshot()).encode('utf-8')
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not worth a line on the console each
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to serve the metrics over HTTP on a thread of its own
+def start_http_exporter(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Function to write the metrics to a JSON file every interval seconds,
+# replacing it whole so readers never see half of it
+def start_file_exporter(path, interval=METRICS_INTERVAL):
+    def write_every_interval():
+        while True:
+            time.sleep(interval)
+            temporary = path + ".tmp"
+            try:
+                with open(temporary, "w", encoding='utf-8') as f:
+                    json.dump(metrics.snapshot(), f)
+                os.replace(temporary, path)
+            except OSError as e:
+                print(f"Error writing metrics: {e}")
+
+    threading.Thread(target=write_every_interval, daemon=True).start()
+
+
+# Function to set up metrics as the command-line options ask. Each worker of
+# a multi-process server has metrics of its own, served on the port after
+# the previous worker's and written to the file name followed by its number.
+def start_metrics(args, worker=None):
+    if args.no_metrics:
+        metrics.enabled = False
+        return
+    if args.metrics_port is not None:
+        port = args.metrics_port + (worker or 0)
+        try:
+            start_http_exporter(args.metrics_host, port)
+        except OSError as e:
+            print(f"Error serving metrics on port {port}: {e}")
+    if args.metrics_file is not None:
+        start_file_exporter(args.metrics_file if worker is None else f"{args.metrics_file}.{worker}", args.metrics_interval)
+
+
+metrics = Metrics()
@@ -0,0 +1,205 @@
+import collections
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+
+from metrics import metrics
+
+# Mailboxes for users who are offline. Personal and group messages for a user
+# who has logged in before but is not connected now wait in the user's
+# mailbox and are delivered, in batches, when they log in again. A mailbox
+# holds at most --mailbox-size messages (the oldest go first) for at most
+# --mailbox-ttl seconds. With --data-dir, all but the newest --mailbox-memory
+# messages of a mailbox are spilled to a file instead of kept in memory.
+
+# Messages a user may have waiting by default
+MAILBOX_SIZE = 1000
+
+# Seconds a message waits for its user by default
+MAILBOX_TTL = 3600
+
+# Messages per mailbox kept in memory when there is a place to spill the rest
+MAILBOX_MEMORY = 100
+
+# Messages sent to a returning user per write
+MAIL_BATCH = 100
+
+# Messages stored between sweeps for mailboxes whose messages all expired
+SWEEP_EVERY = 1024
+
+
+# Function to get the mailbox options given on the command line; mail is
+# spilled under data_dir, if there is one
+def mailbox_options(args, data_dir):
+    return {
+        "size": args.mailbox_size,
+        "ttl": args.mailbox_ttl,
+        "memory": args.mailbox_memory,
+        "directory": None if data_dir is None else os.path.join(data_dir, "mailboxes"),
+    }
+
+
+class Mailbox:
+    __slots__ = ("messages", "path", "spilled", "dropped", "expires")
+
+    def __init__(self):
+        self.messages = collections.deque()  # (expiry time, data) of the newest messages, oldest first
+        self.path = None   # Spill file holding the older messages, if any
+        self.spilled = 0   # Messages in the spill file
+        self.dropped = 0   # Messages at the start of the spill file dropped to make room
+        self.expires = 0   # When the newest message expires
+
+    def __len__(self):
+        return self.spilled - self.dropped + len(self.messages)
+
+
+class Mailboxes:
+    def __init__(self, user_names, size=MAILBOX_SIZE, ttl=MAILBOX_TTL, memory=MAILBOX_MEMORY, directory=None):
+        self.user_names = user_names
+        self.size = size
+        self.ttl = ttl
+        self.memory = memory
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.boxes = {}     # lowercased username -> Mailbox
+        self.known = set()  # Lowercased usernames of everyone who logged in, who can be sent mail
+        self.files = 0      # Spill files made so far; numbers the next one
+        self.stored = 0     # Messages stored so far; decides when to sweep
+        if directory is not None:
+            # Spilled mail is only kept for this run of the server
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+
+    # Function to tell whether a user can be sent mail
+    def knows(self, username):
+        return username.lower() in self.known
+
+    # Function to deliver a message to users now, or keep it for the ones
+    # who are offline
+    def put(self, usernames, data):
+        now = time.monotonic()
+        online = []
+        with self.lock:
+            for username in usernames:
+                # Checked under the lock, so a user logging in either gets
+                # the message now or finds it in their mailbox
+                connection = self.user_names.connection_for(username)
+                if connection is not None:
+                    online.append(connection)
+                    continue
+                box = self.boxes.get(username.lower())
+                if box is None:
+                    box = self.boxes[username.lower()] = Mailbox()
+                box.messages.append((now + self.ttl, data))
+                box.expires = now + self.ttl
+                metrics.incr("mail_stored")
+                if len(box) > self.size:
+                    if box.spilled > box.dropped:
+                        box.dropped += 1
+                    else:
+                        box.messages.popleft()
+                    metrics.incr("mail_dropped")
+                if self.directory is not None and len(box.messages) > self.memory:
+                    self.spill(box)
+                self.stored += 1
+                if self.stored % SWEEP_EVERY == 0:
+                    self.sweep(now)
+        # Sent once the lock is let go, so one slow user does not hold up
+        # mail for everyone else
+        for connection in online:
+            self.deliver_now(connection, data)
+
+    # Function to send a message to a connected user
+    def deliver_now(self, connection, data):
+        connection.sendall(data)
+
+    # Function to take the mail of a user who just logged in, oldest first
+    def take(self, username):
+        with self.lock:
+            self.known.add(username.lower())
+            box = self.boxes.pop(username.lower(), None)
+        if box is None:
+            return []
+        now = time.monotonic()
+        try:
+            mail = [data for expires, data in self.read(box) if expires > now]
+        except OSError as e:
+            print(f"Error reading spilled mail: {e}")
+            mail = [data for expires, data in box.messages if expires > now]
+        self.discard(box)
+        metrics.incr("mail_expired", len(box) - len(mail))
+        return mail
+
+    # Function to move all but the newest --mailbox-memory messages of a
+    # mailbox from memory to its spill file
+    def spill(self, box):
+        count = len(box.messages) - self.memory
+        if box.path is None:
+            self.files += 1
+            box.path = os.path.join(self.directory, f"{self.files}.mail")
+        try:
+            with open(box.path, "a", encoding='utf-8') as f:
+                f.write("".join(json.dumps([expires, data.decode('utf-8', 'surrogateescape')]) + "\n"
+                                for expires, data in itertools.islice(box.messages, count)))
+        except OSError as e:
+            print(f"Error spilling mail to disk: {e}")
+            return
+        box.spilled += count
+        for _ in range(count):
+            box.messages.popleft()
+
+    # Function to get every message of a mailbox, oldest first
+    def read(self, box):
+        messages = []
+        if box.path is not None:
+            with open(box.path, encoding='utf-8') as f:
+                for index, line in enumerate(f):
+                    if index >= box.dropped:
+                        expires, data = json.loads(line)
+                        messages.append((expires, data.encode('utf-8', 'surrogateescape')))
+        messages.extend(box.messages)
+        return messages
+
+    # Function to remove the spill file of a mailbox that was dropped
+    def discard(self, box):
+        if box.path is not None:
+            try:
+                os.remove(box.path)
+            except OSError:
+                pass
+
+    # Function to drop the mailboxes whose messages have all expired; the
+    # caller holds the lock
+    def sweep(self, now):
+        for username, box in list(self.boxes.items()):
+            if box.expires <= now:
+                del self.boxes[username]
+                metrics.incr("mail_expired", len(box))
+                self.discard(box)
+
+    # Function to describe the mailboxes for a node that is joining a cluster
+    def dump(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "known": sorted(self.known),
+                "boxes": [[username, [[expires - now, data.decode('utf-8', 'surrogateescape')]
+                                      for expires, data in self.read(box)]]
+                          for username, box in self.boxes.items()],
+            }
+
+    # Function to take on the mailboxes another node described
+    def load(self, state):
+        now = time.monotonic()
+        with self.lock:
+            self.known.update(state["known"])
+            for username, messages in state["boxes"]:
+                box = self.boxes[username] = Mailbox()
+                for seconds_left, data in messages:
+                    box.messages.append((now + seconds_left, data.encode('utf-8', 'surrogateescape')))
+                    box.expires = now + seconds_left
+                if self.directory is not None and len(box.messages) > self.memory:
+                    self.spill(box)
@@ -0,0 +1,129 @@
+import threading
+import time
+
+from connection import SharedMessage
+from metrics import metrics, size_buckets
+
+# Telling users who joined and who left. Rather than a message to everyone
+# for every login and logout, changes are gathered for --presence-window
+# seconds and sent as one message per window. A user who joins and leaves
+# within a window is never mentioned. Each user picks what they get with
+# @presence:
+#
+#   notices  "[alice joined]", "[alice, bob joined]", "[carol exited]"
+#   diffs    "[Presence] +alice, +bob, -carol", for clients that keep a list
+#            of who is connected: one @names listing, then the diffs
+#   off      nothing
+#
+# Users get the --presence-default mode (notices unless asked otherwise)
+# until they pick one. In a cluster every node sees every login and logout,
+# so each node tells its own users.
+
+# Seconds changes are gathered for before they are sent, by default
+PRESENCE_WINDOW = 0.5
+
+# What users get until they ask for something else
+NOTICES = "notices"
+DIFFS = "diffs"
+OFF = "off"
+presence_modes = (NOTICES, DIFFS, OFF)
+
+# Usernames named in a notice; the rest are counted
+NOTICE_NAMES = 20
+
+# Changes in one diff message; a window with more is sent in several
+DIFF_CHANGES = 100
+
+
+# Function to make the presence feed the command-line options ask for
+def presence_feed(args, user_names):
+    return Presence(user_names, args.presence_window, args.presence_default)
+
+
+class Presence:
+    def __init__(self, user_names, window=PRESENCE_WINDOW, default=NOTICES):
+        self.user_names = user_names
+        self.window = window
+        self.default = default
+        self.modes = {}    # lowercased username -> mode, for users who picked one
+        self.pending = {}  # lowercased username -> (username, True if joined), in order
+        self.changes = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Function called by the registry when a user logs in or out
+    def changed(self, username, joined):
+        key = username.lower()
+        with self.changes:
+            if not joined:
+                self.modes.pop(key, None)
+            previous = self.pending.pop(key, None)
+            if previous is not None and previous[1] != joined:
+                return  # Undoes the change earlier in the window, so there is nothing to tell
+            self.pending[key] = (username, joined)
+            self.changes.notify()
+
+    # Function to set what a user gets
+    def choose(self, username, mode):
+        with self.changes:
+            self.modes[username.lower()] = mode
+
+    # Function run by the feed's thread: waits for a change, gives the window
+    # time to gather more, then sends them
+    def run(self):
+        while True:
+            with self.changes:
+                while not self.pending:
+                    self.changes.wait()
+            if self.window:
+                time.sleep(self.window)
+            with self.changes:
+                pending, self.pending = self.pending, {}
+            try:
+                self.send(pending)
+            except Exception as e:
+                print(f"Unexpected error: {e}")
+
+    # Function to send one window's changes to the users of this process
+    def send(self, pending):
+        joined = [username for username, has_joined in pending.values() if has_joined]
+        left = [username for username, has_joined in pending.values() if not has_joined]
+        notices = [SharedMessage(notice.encode('utf-8')) for notice in notice_texts(joined, left)]
+        diffs = [SharedMessage(diff.encode('utf-8')) for diff in diff_texts(joined, left)]
+        recipients = 0
+        for connection in self.user_names.local_connections():
+            username = self.user_names.get(connection)
+            if username is None:
+                continue
+            key = username.lower()
+            if len(pending) == 1 and key in pending:
+                continue  # Nobody to tell the user about but themselves
+            mode = self.modes.get(key, self.default)
+            if mode == NOTICES:
+                for notice in notices:
+                    connection.send_shared(notice)
+            elif mode == DIFFS:
+                for diff in diffs:
+                    connection.send_shared(diff)
+            else:
+                continue
+            recipients += 1
+        metrics.incr("presence_changes", len(pending))
+        metrics.observe("fanout_recipients", recipients, size_buckets)
+
+
+# Function to word a window's changes for people
+def notice_texts(joined, left):
+    texts = []
+    for usernames, verb in ((joined, "joined"), (left, "exited")):
+        if len(usernames) > NOTICE_NAMES:
+            texts.append(f"[{', '.join(usernames[:NOTICE_NAMES])} and {len(usernames) - NOTICE_NAMES} others {verb}]")
+        elif usernames:
+            texts.append(f"[{', '.join(usernames)} {verb}]")
+    return texts
+
+
+# Function to word a window's changes for clients that keep a user list
+def diff_texts(joined, left):
+    changes = [f"+{username}" for username in joined] + [f"-{username}" for username in left]
+    return ["[Presence] " + ", ".join(changes[start:start + DIFF_CHANGES]) for start in range(0, len(changes), DIFF_CHANGES)]
@@ -0,0 +1,103 @@
+import codecs
+import struct
+
+# Wire protocol shared by client.py and server.py.
+#
+# A client that wants framed messages sends HELLO as soon as it connects. The
+# server answers with HELLO and from then on both sides exchange frames: a
+# header holding the payload length and the frame kind, followed by the UTF-8
+# payload. Clients that never send HELLO (telnet, nc, older clients) keep the
+# plain text protocol where every recv() is one message.
+
+HELLO = b"\x00CHAT1\n"
+
+# Payload length (4 bytes, big endian) and frame kind (1 byte)
+frame_header = struct.Struct("!IB")
+
+# Frame kinds. Either side may send a ping at any time; the other answers
+# with a pong carrying the same payload.
+KIND_TEXT = 0
+KIND_PING = 1
+KIND_PONG = 2
+# Resumable sessions (see session.py). A client asks for one by sending an
+# empty session frame before logging in; the server's session frame carries
+# "<token> <count> <username>". From then on the client counts the text
+# frames it receives, starting at count, and acks the count now and then.
+KIND_SESSION = 3
+KIND_ACK = 4
+# Compression (see compression.py). A client that can inflate messages sends
+# a compress frame saying "deflate"; a server that compresses answers with
+# "deflate <threshold>". After that either side may send a text message as a
+# compressed frame instead.
+KIND_COMPRESS = 5
+KIND_COMPRESSED = 6
+
+# Largest payload a server accepts from a client by default
+MAX_FRAME_SIZE = 64 * 1024
+
+
+# Raised when the peer sends something the protocol does not allow
+class ProtocolError(ValueError):
+    pass
+
+
+# Raised when the peer announces a frame bigger than we are willing to buffer
+class FrameTooLarge(ProtocolError):
+    pass
+
+
+# Function to build a frame around an encoded payload
+def encode_frame(payload, kind=KIND_TEXT):
+    return frame_header.pack(len(payload), kind) + payload
+
+
+# Incremental frame parser with one buffer per connection
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    # Function to add received bytes and return every frame they complete
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= frame_header.size:
+            length, kind = frame_header.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameTooLarge(f"frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+            end = offset + frame_header.size + length
+            if end > len(self.buffer):
+                break
+            frames.append((kind, bytes(self.buffer[offset + frame_header.size:end])))
+            offset = end
+        # Drop consumed bytes once per feed instead of once per frame
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+# Decoder for the plain text protocol; keeps a multibyte character that was
+# cut at a recv() boundary until the rest of it arrives
+class TextDecoder:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        return [text] if text else []
+
+
+# Function used by clients to switch a freshly connected socket to frames.
+# Returns the plain text the server sent before its HELLO (the username
+# prompt) and the bytes received after it.
+def request_framing(sock):
+    sock.sendall(HELLO)
+    received = b''
+    while HELLO not in received:
+        data = sock.recv(1024)
+        if not data:
+            raise ConnectionError("server closed the connection during negotiation")
+        received += data
+    index = received.index(HELLO)
+    return received[:index], received[index + len(HELLO):]
@@ -0,0 +1,276 @@
+import argparse
+import collections
+import json
+import queue
+import socket
+import threading
+
+from protocol import FrameDecoder, encode_frame
+
+# Publish/subscribe used to tie several server processes (workers, or nodes
+# of a cluster) together. Any backend will do as long as it keeps to the
+# contract of PubSub below; two come with the server:
+#
+#   LocalBroker   every client in one process, for trying things on one box
+#   SocketBroker  a broker reached over TCP or a Unix socket by SocketPubSub
+#                 clients; run one with `python pubsub.py ADDRESS`
+
+# Largest message accepted by a socket broker or client
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+# What the server expects of a pub/sub backend. Messages are dicts that can
+# be turned into JSON.
+#
+# - All subscribers of a topic see its messages in the same order.
+# - A client sees messages in the order the broker passed them on, whatever
+#   their topic, so a message sent in reaction to another arrives after it.
+# - Callbacks run on a single thread per client, one message at a time.
+class PubSub:
+    on_close = None  # Called if the backend goes away
+
+    # Function to start receiving a topic; returns how many other clients
+    # already subscribed to it. Must not be called from a callback.
+    def subscribe(self, topic, callback):
+        raise NotImplementedError
+
+    def publish(self, topic, message):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    # Function to hand a received message to its topic's callback; a callback
+    # that fails is reported rather than stopping everything after it
+    def deliver(self, envelope):
+        try:
+            self.callbacks[envelope["topic"]](envelope["message"])
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+
+# Broker logic shared by the backends. A client is anything with a send()
+# that queues an envelope for it without blocking.
+class Broker:
+    def __init__(self):
+        self.lock = threading.Lock()  # Keeps every topic in one order for all subscribers
+        self.subscribers = collections.defaultdict(list)  # topic -> clients
+        self.wills = {}  # client -> (topic, message) published when it goes away
+
+    def subscribe(self, client, topic):
+        with self.lock:
+            others = len(self.subscribers[topic])
+            self.subscribers[topic].append(client)
+            client.send({"op": "subscribed", "topic": topic, "others": others})
+
+    def publish(self, topic, message):
+        with self.lock:
+            for client in self.subscribers.get(topic, ()):
+                client.send({"op": "message", "topic": topic, "message": message})
+
+    # Function to drop a client that went away and publish its will
+    def disconnect(self, client):
+        with self.lock:
+            for clients in self.subscribers.values():
+                if client in clients:
+                    clients.remove(client)
+            will = self.wills.pop(client, None)
+        if will is not None:
+            self.publish(*will)
+
+
+# Broker and clients living in one process
+class LocalBroker(Broker):
+    def connect(self, will=None):
+        return LocalPubSub(self, will)
+
+
+class LocalPubSub(PubSub):
+    def __init__(self, broker, will=None):
+        self.broker = broker
+        self.callbacks = {}
+        self.inbox = queue.Queue()
+        self.subscribed = queue.Queue()
+        self.closed = False
+        if will is not None:
+            broker.wills[self] = will
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def send(self, envelope):
+        if envelope["op"] == "subscribed":
+            self.subscribed.put(envelope["others"])
+        else:
+            self.inbox.put(envelope)
+
+    # Function run by the client's thread, calling back for each message
+    def dispatch(self):
+        while True:
+            envelope = self.inbox.get()
+            if envelope is None:
+                break
+            self.deliver(envelope)
+
+    def subscribe(self, topic, callback):
+        self.callbacks[topic] = callback
+        self.broker.subscribe(self, topic)
+        return self.subscribed.get()
+
+    def publish(self, topic, message):
+        # Subscribers get their own copy, as they would over a socket
+        self.broker.publish(topic, json.loads(json.dumps(message)))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.disconnect(self)
+            self.inbox.put(None)
+
+
+# Function to turn "host:port" or the path of a Unix socket into a socket
+# family and address
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+# One end of a socket between a broker and a client. Envelopes are queued
+# and written by a thread of their own, so a busy peer never stalls the
+# sender.
+class Link:
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = collections.deque()
+        self.outbox_changed = threading.Condition()
+        self.writer = threading.Thread(target=self.drain_outbox, daemon=True)
+        self.writer.start()
+
+    def send(self, envelope):
+        with self.outbox_changed:
+            self.outbox.append(envelope)
+            self.outbox_changed.notify()
+
+    # Function run by the writer thread; writes everything queued in one go
+    def drain_outbox(self):
+        while True:
+            with self.outbox_changed:
+                while not self.outbox:
+                    self.outbox_changed.wait()
+                envelopes = list(self.outbox)
+                self.outbox.clear()
+            try:
+                self.sock.sendall(b''.join(encode_frame(json.dumps(envelope).encode('utf-8')) for envelope in envelopes))
+            except OSError:
+                break
+
+    # Function to yield every envelope received until the peer goes away
+    def receive(self):
+        decoder = FrameDecoder(MAX_MESSAGE_SIZE)
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            for kind, payload in decoder.feed(data):
+                yield json.loads(payload)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# Broker serving SocketPubSub clients
+class SocketBroker(Broker):
+    def __init__(self, address):
+        super().__init__()
+        family, address = parse_address(address)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(128)
+
+    # Function to accept clients on a thread of its own
+    def start(self):
+        threading.Thread(target=self.accept_clients, daemon=True).start()
+
+    def accept_clients(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve, args=(Link(sock),), daemon=True).start()
+
+    # Function run for each client until it goes away
+    def serve(self, link):
+        for envelope in link.receive():
+            op = envelope["op"]
+            if op == "publish":
+                self.publish(envelope["topic"], envelope["message"])
+            elif op == "subscribe":
+                self.subscribe(link, envelope["topic"])
+            elif op == "will":
+                with self.lock:
+                    self.wills[link] = (envelope["topic"], envelope["message"])
+        link.close()
+        self.disconnect(link)
+
+    def close(self):
+        self.server.close()
+
+
+# Client of a SocketBroker
+class SocketPubSub(PubSub):
+    def __init__(self, address, will=None):
+        family, address = parse_address(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+        self.link = Link(sock)
+        self.callbacks = {}
+        self.subscribed = queue.Queue()
+        if will is not None:
+            self.link.send({"op": "will", "topic": will[0], "message": will[1]})
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        for envelope in self.link.receive():
+            if envelope["op"] == "subscribed":
+                self.subscribed.put(envelope["others"])
+            else:
+                self.deliver(envelope)
+        if self.on_close is not None:
+            self.on_close()
+
+    def subscribe(self, topic, callback):
+        self.callbacks[topic] = callback
+        self.link.send({"op": "subscribe", "topic": topic})
+        return self.subscribed.get()
+
+    def publish(self, topic, message):
+        self.link.send({"op": "publish", "topic": topic, "message": message})
+
+    def close(self):
+        self.link.close()
+
+
+# Function to run a broker on its own
+def main():
+    parser = argparse.ArgumentParser(description="Pub/sub broker for a cluster of chat servers")
+    parser.add_argument("address", help="host:port, or the path of a Unix socket, to listen on")
+    args = parser.parse_args()
+    broker = SocketBroker(args.address)
+    print(f"***Broker listening on {args.address}***")
+    try:
+        broker.accept_clients()
+    except KeyboardInterrupt:
+        broker.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import argparse
+import threading
+import time
+
+from metrics import metrics
+
+# Token-bucket limits on what users send, so one client cannot keep the
+# server fanning out its messages. Every message takes a token from the
+# user's bucket for "message" and from the one for its kind, and the same
+# from the buckets shared by everyone connected from the user's IP address.
+# Buckets refill at a steady rate up to their burst size; a message that
+# finds a bucket empty is not delivered. A user who goes on sending anyway
+# is disconnected: refused messages take tokens from one more bucket, and
+# emptying that one is flooding.
+
+# Messages per second and burst allowed by default, per kind of message
+DEFAULT_LIMITS = {
+    "message": (50, 100),    # Every message, commands included
+    "broadcast": (5, 20),
+    "personal": (20, 50),
+    "group_send": (20, 50),
+    "names": (1, 5),
+}
+
+# How many times a user's limits everyone from one IP address gets together
+IP_FACTOR = 4
+
+# Messages a user may have refused in FLOOD_WINDOW seconds before being disconnected
+FLOOD_LIMIT = 100
+FLOOD_WINDOW = 10
+
+# Seconds between warnings to a user whose messages are being refused
+WARN_INTERVAL = 1
+
+
+# Function to read a --rate-limit option, KIND=RATE[/BURST]
+def parse_limit(text):
+    kind, _, limit = text.partition("=")
+    if kind not in DEFAULT_LIMITS:
+        raise argparse.ArgumentTypeError(f"unknown kind {kind!r}; expected one of {', '.join(DEFAULT_LIMITS)}")
+    rate, _, burst = limit.partition("/")
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected KIND=RATE/BURST, not {text!r}")
+    if rate < 0 or (rate > 0 and burst < 1):
+        raise argparse.ArgumentTypeError(f"rate must not be negative and burst must be at least 1 in {text!r}")
+    return kind, (rate, burst)
+
+
+# Function to make the limiter the command-line options ask for; None if
+# users are not limited
+def rate_limiter(args):
+    if args.no_rate_limits:
+        return None
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(args.rate_limit or [])
+    return RateLimiter(limits, args.ip_rate_factor, args.flood_limit)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Function to take a token; False if the bucket is empty
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+# Buckets shared by the users connected from one IP address
+class AddressLimits:
+    __slots__ = ("buckets", "lock", "connections")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+# Limits of one connected user; only the user's own thread or task uses them
+class UserLimits:
+    __slots__ = ("limiter", "address", "buckets", "shared", "strikes", "flooding", "warned")
+
+    def __init__(self, limiter, address, shared):
+        self.limiter = limiter
+        self.address = address
+        self.buckets = limiter.buckets(1)
+        self.shared = shared
+        self.strikes = None  # Taken from by refused messages
+        if limiter.flood_limit > 0:
+            self.strikes = TokenBucket(limiter.flood_limit / FLOOD_WINDOW, limiter.flood_limit)
+        self.flooding = False  # Set once the user should be disconnected
+        self.warned = 0.0      # When the user was last told messages were refused
+
+    # Function to count a message of the given kind (None for only
+    # "message") against the limits; False if it must not be delivered
+    def allow(self, kind):
+        now = time.monotonic()
+        for each in ("message", kind):
+            bucket = self.buckets.get(each)
+            if bucket is not None and not bucket.take(now):
+                return self.refuse("user", each, now)
+            shared = self.shared
+            if shared is not None and each in shared.buckets:
+                with shared.lock:
+                    allowed = shared.buckets[each].take(now)
+                if not allowed:
+                    return self.refuse("address", each, now)
+        return True
+
+    def refuse(self, scope, kind, now):
+        metrics.incr(f"rate_limited_{scope}_{kind}")
+        if self.strikes is not None and not self.strikes.take(now):
+            self.flooding = True
+        return False
+
+    # Function to tell whether to warn the user that messages were refused;
+    # True at most once every WARN_INTERVAL seconds
+    def warn(self):
+        now = time.monotonic()
+        if now - self.warned < WARN_INTERVAL:
+            return False
+        self.warned = now
+        return True
+
+    # Function to give back the user's share of the address's buckets
+    def release(self):
+        self.limiter.release(self)
+
+
+class RateLimiter:
+    def __init__(self, limits=DEFAULT_LIMITS, ip_factor=IP_FACTOR, flood_limit=FLOOD_LIMIT):
+        # A rate of 0 turns a limit off
+        self.limits = {kind: limit for kind, limit in limits.items() if limit[0] > 0}
+        self.ip_factor = ip_factor
+        self.flood_limit = flood_limit
+        self.lock = threading.Lock()
+        self.addresses = {}  # IP address -> AddressLimits, while anyone is connected from it
+
+    # Function to make a fresh bucket for every limit, scaled by factor
+    def buckets(self, factor):
+        return {kind: TokenBucket(rate * factor, burst * factor) for kind, (rate, burst) in self.limits.items()}
+
+    # Function to get the limits of a user who just logged in from an address
+    def connect(self, address):
+        shared = None
+        if self.ip_factor > 0:
+            with self.lock:
+                shared = self.addresses.get(address)
+                if shared is None:
+                    shared = self.addresses[address] = AddressLimits(self.buckets(self.ip_factor))
+                shared.connections += 1
+        return UserLimits(self, address, shared)
+
+    # Function called when a user leaves; safe to call more than once
+    def release(self, limits):
+        with self.lock:
+            shared, limits.shared = limits.shared, None
+            if shared is None:
+                return
+            shared.connections -= 1
+            if shared.connections == 0:
+                del self.addresses[limits.address]
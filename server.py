@@ -1,88 +1,177 @@
+import argparse
+import asyncio
 import socket
 import threading
-
-users = []
+import time
+
+from cluster import ClusterTimeout, join_cluster, node_will
+from compression import COMPRESS_LEVEL, COMPRESS_THRESHOLD, compressors
+from dispatch import (Command, CommandTable, name_and_changes, name_and_list, name_and_numbers, name_and_text, name_only,
+                      names_query, one_of)
+from connection import (DROP_OLDEST, FLUSH_BYTES, FLUSH_INTERVAL, NODELAY, PROMPT_TIMEOUT, QUEUE_SIZE,
+                        AsyncUserConnection, SharedMessage, UserConnection, overflow_policies, tcp_modes, wait_for_room)
+from heartbeat import (IDLE_TIMEOUT, KEEPALIVE, PING_INTERVAL, PLAIN_IDLE_TIMEOUT, READ_TIMEOUT, heartbeats,
+                       set_keepalive)
+from history import HISTORY_BYTES, HISTORY_PAGE, HISTORY_PAGE_MAX, HISTORY_SIZE, history_options
+from metrics import METRICS_INTERVAL, format_snapshot, metrics, size_buckets, start_metrics
+from offline import MAIL_BATCH, MAILBOX_MEMORY, MAILBOX_SIZE, MAILBOX_TTL, Mailboxes, mailbox_options
+from presence import NOTICES, PRESENCE_WINDOW, presence_feed, presence_modes
+from protocol import MAX_FRAME_SIZE, ProtocolError
+from pubsub import SocketBroker, SocketPubSub
+from ratelimit import FLOOD_LIMIT, FLOOD_WINDOW, IP_FACTOR, parse_limit, rate_limiter
+from session import RESUME_BUFFER, RESUME_TIMEOUT, resumable_sessions
+from state import GroupStore, UserRegistry
+from storage import FSYNC_INTERVAL, SNAPSHOT_EVERY, GroupLog
+from workers import run_supervisor
 
 # Function to handle communication with a user
 def handle_user(user_socket, user_names, groups):
-    global users
-    users.append(user_socket)
-    commands = {
-        "@quit": quit_command,
-        "@names": names,
-        "@group set": create_group,
-        "@group send": send_group_message,
-        "@group delete": delete_group,
-        "@group leave": leave_group,
-        "@group add": add_group_member,
-        "@group list": list_groups,
-        "@group remove": remove_group_member,
-        "@group members": list_group_members,
-        "@group authorize": authorize_group_member,
-    }
-
     try:
         while True:
-            message = user_socket.recv(1024).decode('utf-8').strip()
+            message = user_socket.recv_message()
+            if message is None:
+                break
+            message = message.strip()
             if not message:
                 continue
 
-            # Split the message for initial command detection
-            parts = message.split(' ', 2)
-            command = parts[0]
-
-            # Handling group commands as a special case
-            if command == "@group" and len(parts) > 1:
-                # Reconstruct the group command with its specific action
-                group_command = " ".join(parts[:2])
-                if group_command in commands:
-                    commands[group_command](message, user_socket, user_names, groups)
-                else:
-                    user_socket.sendall("Invalid group command. Please check your syntax.".encode('utf-8'))
-                continue
-
-            # Handling predefined commands excluding group commands
-            if command in commands and command != "@group":
-                commands[command](message, user_socket, user_names, groups)
-                continue
-
-            # Handling private messages
-            # Handling personal messages
-            # Handling private messages
-            if message.startswith("@") and not message.startswith("@group"):
-                # Find the first space or the end of the message
-                space_index = message.find(' ')
-                if space_index == -1:
-                    space_index = len(message)
-
-                # Extract the username and the message
-                recipient_username = message[1:space_index]
-                personal_message = message[space_index:].strip()
-
-                if recipient_username in [name for socket, name in user_names.items()]:  # Check if recipient exists
-                    send_personal_message(recipient_username, personal_message, user_socket, user_names)
-                else:
-                    user_socket.sendall(f"User '{recipient_username}' does not exist.".encode('utf-8'))
-            else:
-                # For messages that are not personal or commands, broadcast to all users
-                broadcast(message, user_socket, user_names)
-
+            process_message(message, user_socket, user_names, groups)
+            if user_socket.closed:
+                break
 
     except OSError as e:
         print(f"Socket error: {e}")
+    except ProtocolError as e:
+        print(f"Protocol error: {e}")
     except Exception as e:
+        metrics.incr("handler_exceptions")
         print(f"Unexpected error: {e}")
     finally:
         cleanup_user(user_socket, user_names, groups)
 
 
+# Function to run a single message received from a user, counting and
+# timing it by kind when metrics are on
+def process_message(message, user_socket, user_names, groups):
+    if not metrics.enabled:
+        dispatch_message(message, user_socket, user_names, groups)
+        return
+    started = time.perf_counter()
+    kind = dispatch_message(message, user_socket, user_names, groups)
+    metrics.incr(f"messages_{kind}")
+    metrics.observe(f"message_seconds_{kind}", time.perf_counter() - started)
+
+
+# Function to carry out a message; returns what kind of message it was
+def dispatch_message(message, user_socket, user_names, groups):
+    # A command may be tagged "%<tag> @command", so that a client can send
+    # many at once and tell their replies apart: every reply starts with
+    # the tag, and "%<tag> [Done]" follows the last of them. The answer to
+    # an open question may be tagged the same way.
+    if message.startswith("%"):
+        tag, _, command = message.partition(" ")
+        command = command.lstrip()
+        prompt = None
+        if len(tag) > 1 and not command.startswith("@"):
+            prompt = user_socket.take_prompt()
+        if len(tag) > 1 and (command.startswith("@") or prompt is not None):
+            with user_socket.tagged_replies(tag):
+                try:
+                    if prompt is not None:
+                        carry_out(user_socket, prompt.on_answer, command)
+                        return "answer"
+                    return dispatch_message(command, user_socket, user_names, groups)
+                finally:
+                    user_socket.sendall("[Done]".encode('utf-8'))
+
+    # A message that is not a command answers the question the user was
+    # asked, or else goes straight out to everyone
+    if not message.startswith("@"):
+        prompt = user_socket.take_prompt()
+        if prompt is not None:
+            carry_out(user_socket, prompt.on_answer, message)
+            return "answer"
+        if not within_limits(user_socket, "broadcast"):
+            return "refused"
+        broadcast(message, user_socket, user_names)
+        return "broadcast"
+
+    command, rest, partial = command_table.lookup(message)
+    if command is None:
+        if not within_limits(user_socket, None if partial else "personal"):
+            return "refused"
+        if partial:
+            user_socket.sendall("Invalid group command. Please check your syntax.".encode('utf-8'))
+            return "invalid"
+
+        # Personal message: the username runs up to the first space
+        recipient_username, _, personal_message = message[1:].partition(' ')
+        personal_message = personal_message.strip()
+
+        # Check if recipient exists; users who are offline get it when they return
+        if user_names.connection_for(recipient_username) is not None or user_names.mailboxes.knows(recipient_username):
+            send_personal_message(recipient_username, personal_message, user_socket, user_names)
+        else:
+            user_socket.sendall(f"User '{recipient_username}' does not exist.".encode('utf-8'))
+        return "personal"
+
+    if not within_limits(user_socket, command.limit):
+        return "refused"
+    args = command.parse(rest)
+    if args is None:
+        user_socket.sendall(command.usage.encode('utf-8'))
+    else:
+        carry_out(user_socket, command.handler, args, user_socket, user_names, groups)
+    return command.name
+
+
+# Function to run a command; in a cluster that does not answer in time the
+# user is told it may yet take effect, since every node may still make it
+def carry_out(user_socket, action, *args):
+    try:
+        action(*args)
+    except ClusterTimeout:
+        user_socket.sendall("[The cluster did not answer in time; your command may still take effect]".encode('utf-8'))
+
+
+# Function to count a message against the user's rate limits; False if it
+# must not be delivered
+def within_limits(user_socket, kind):
+    limits = user_socket.limits
+    if limits is None or limits.allow(kind):
+        return True
+    refuse_message(user_socket, limits)
+    return False
+
+
+# Function to turn away a message over the user's rate limits, and the user
+# too if they keep sending regardless
+def refuse_message(user_socket, limits):
+    if limits.flooding:
+        metrics.incr("flood_disconnects")
+        print(f"A user from {limits.address} was disconnected for flooding.")
+        user_socket.sendall("[Disconnected for sending too many messages]".encode('utf-8'))
+        user_socket.resumable = False
+        user_socket.close()
+    elif limits.warn():
+        user_socket.sendall("[You are sending messages too fast; slow down or they will not be delivered]".encode('utf-8'))
 
 
 def cleanup_user(user_socket, user_names, groups):
-    global users
-    # Attempt to get the username; default to 'Unknown user' if not found.
-    username = user_names.get(user_socket, 'Unknown user')
+    if user_socket.limits is not None:
+        user_socket.limits.release()
     
+    # A question the user never answered gets its default answer
+    prompt = user_socket.take_prompt()
+    if prompt is not None:
+        user_socket.give_up(prompt)
+
+    # A user whose connection dropped keeps their place while they can resume
+    # their session; if they do not, this runs again when it expires
+    sessions = user_names.sessions
+    if sessions is not None and sessions.detach(user_socket, lambda: cleanup_user(user_socket, user_names, groups)):
+        return
+
     # Safely attempt to close the user socket.
     try:
         user_socket.close()
@@ -91,32 +180,27 @@ def cleanup_user(user_socket, user_names, groups):
     
     # Ensure that operations on shared resources are thread-safe.
     try:
-        if user_socket in users:
-            users.remove(user_socket)
-        if user_socket in user_names:
-            del user_names[user_socket]
-
-        # Broadcast user's exit after removing from lists to prevent sending to closed socket.
-        broadcast(f"[{username} exited]", None, user_names)  # Pass None as sender_socket since it's closed.
-        
-        # Remove the user from all groups they are a part of.
-        for group_name, group_members in groups.items():
-            if username in group_members:
-                group_members.remove(username)
-                # Optional: Broadcast to the group that the user has left, if desired.
+        # Other users hear of the exit from the presence feed
+        try:
+            removed = user_names.remove(user_socket) is not None
+        except ClusterTimeout:
+            removed = True  # The cluster forgets the user when it gets to it
+        if removed:
+            metrics.incr("users_connected", -1)
+
+        # Group membership belongs to the username and outlives the connection,
+        # so the user is still in their groups when they come back.
     except Exception as e:
         print(f"Error during cleanup: {e}")
 
 
 
-def quit_command(message, user_socket, user_names, groups):
+def quit_command(args, user_socket, user_names, groups):
     # Retrieve the username of the user who is quitting
     username = user_names.get(user_socket, 'Unknown user')
 
-    # Broadcast the user's exit message to all other users, using is_join_message=True to avoid prefix
-    broadcast(f"[{username} exited]", sender_socket=user_socket, user_names=user_names, is_join_message=True)
-
-    # Perform cleanup for the user who is quitting
+    # Perform cleanup for the user who is quitting; others hear of the exit from the presence feed
+    user_socket.resumable = False
     cleanup_user(user_socket, user_names, groups)
 
     # Close the user's socket
@@ -129,22 +213,33 @@ def quit_command(message, user_socket, user_names, groups):
 
 
 
-def names(message, user_socket, user_names, groups):
-    # Create a list of all connected users
-    connected_users = [username for username in user_names.values()]
-    # Send the list to the user
-    user_socket.sendall(f"Connected users: {', '.join(connected_users)}".encode('utf-8'))
+def names(args, user_socket, user_names, groups):
+    prefix, after = args
+    # One page of the connected users, in order
+    connected_users, more = user_names.page(prefix, after)
+    if not connected_users:
+        if after is not None:
+            user_socket.sendall("[No more connected users]".encode('utf-8'))
+        else:
+            user_socket.sendall(f"[No connected users start with '{prefix}']".encode('utf-8'))
+        return
+    reply = f"Connected users: {', '.join(connected_users)}"
+    if more:
+        # Tell the user how to get the next page
+        reply += f" [More: @names {prefix + ' ' if prefix else ''}after {connected_users[-1]}]"
+    user_socket.sendall(reply.encode('utf-8'))
+
+
+# Function to choose what the user is told when others join and leave
+def presence(args, user_socket, user_names, groups):
+    mode = args[0]
+    if user_names.presence is not None:
+        user_names.presence.choose(user_names[user_socket], mode)
+    user_socket.sendall(f"[Presence: {mode}]".encode('utf-8'))
 
 # Function to create a group
-def create_group(message, user_socket, user_names, groups):
-    # Parse group name and members
-    parts = message.split()[2:]
-    if len(parts) < 2:
-        user_socket.sendall("[Invalid input. Please provide a group name and at least one member.]".encode('utf-8'))
-        return
-    
-    group_name = parts[0]
-    group_members = [member.strip() for member in ''.join(parts[1:]).split(',')]
+def create_group(args, user_socket, user_names, groups):
+    group_name, group_members = args
 
     # Check if group name is alphanumeric
     if not group_name.isalnum():
@@ -158,535 +253,1023 @@ def create_group(message, user_socket, user_names, groups):
 
     # Check if all members are valid
     for member in group_members:
-        if member not in user_names.values():
+        if user_names.connection_for(member) is None:
             user_socket.sendall(f"[User '{member}' does not exist]".encode('utf-8'))
             return
 
-    
+    # Use the spelling each member registered with
+    group_members = list(dict.fromkeys(user_names.canonical(member) for member in group_members))
+
     # Create the group with members and admins
     creator_username = user_names[user_socket]
-    groups[group_name] = {'members': [member for member in group_members if member != creator_username], 'admins': [creator_username]}
+    if groups.create(group_name, creator_username, group_members) is None:
+        # Another user took the name while we were checking the members
+        user_socket.sendall("[Group name already exists]".encode('utf-8'))
+        return
 
     # Inform members about group creation
     if len(group_members) == 1 and group_members[0] == creator_username:
         user_socket.sendall(f"[You created the {group_name} group]".encode('utf-8'))
     else:
         for member in group_members:
-            for socket, username in user_names.items():
-                if username == member:
-                    if member != creator_username:
-                        socket.sendall(f"[You are enrolled into the {group_name} group by {creator_username}]".encode('utf-8'))
-                    else:
-                        socket.sendall(f"[You created the {group_name} group and added {', '.join(group_members)}]".encode('utf-8'))
+            member_socket = user_names.connection_for(member)
+            if member_socket is None:
+                continue
+            if member != creator_username:
+                member_socket.sendall(f"[You are enrolled into the {group_name} group by {creator_username}]".encode('utf-8'))
+            else:
+                member_socket.sendall(f"[You created the {group_name} group and added {', '.join(group_members)}]".encode('utf-8'))
 
 
 # Function to send a message to a group
-def send_group_message(message, user_socket, user_names, groups):
-    # Parse group name and message
-    parts = message.split()[2:]
-    
-    # Check if the necessary parameters are present
-    if len(parts) < 2:
-        user_socket.sendall("[Invalid input. Please provide a group name and a message.]".encode('utf-8'))
-        return
-    
-    group_name = parts[0]
-    group_message = ' '.join(parts[1:])
+def send_group_message(args, user_socket, user_names, groups):
+    group_name, group_message = args
 
-     # Check if group exists
-    if group_name not in groups:
+    # Check if group exists
+    group = groups.get(group_name)
+    if group is None:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
 
     # Check if user is a member of the group
     sender_username = user_names[user_socket]
-    if sender_username not in groups[group_name]['members'] and sender_username not in groups[group_name]['admins']:
+    if sender_username not in group:
         user_socket.sendall("[You are not a member of this group]".encode('utf-8'))
         return
 
-    # Send message to group members
-    for member_socket, member_username in user_names.items():
-        if member_username in groups[group_name]['members']:
-            if member_username == sender_username:
-                member_socket.sendall(f"[myself (group {group_name})]: {group_message}".encode('utf-8'))
-            else:
-                member_socket.sendall(f"[{sender_username} (group {group_name})]: {group_message}".encode('utf-8'))
-    
-     # Send message to group members
-    for member_socket, member_username in user_names.items():
-        if member_username in groups[group_name]['admins']:
-            if member_username == sender_username:
-                member_socket.sendall(f"[myself (group {group_name})]: {group_message}".encode('utf-8'))
-            else:
-                member_socket.sendall(f"[{sender_username} (group {group_name})]: {group_message}".encode('utf-8'))
-
-# Function to handle a user leaving a group
-def leave_group(message, user_socket, user_names, groups):
-    parts = message.split(maxsplit=3)
-
-    # Validate the command structure
-    if len(parts) < 3:
-        user_socket.sendall("[Invalid input. Please provide a group name.]".encode('utf-8'))
+    # Encode once for every member; only the sender's echo differs
+    shared = SharedMessage(f"[{sender_username} (group {group_name})]: {group_message}".encode('utf-8'))
+    echo = f"[myself (group {group_name})]: {group_message}".encode('utf-8')
+
+    # Send message to the group's members and admins who are connected, and
+    # keep it for those who are not
+    offline = []
+    everyone = group.everyone()
+    for member in everyone:
+        member_socket = user_names.connection_for(member)
+        if member_socket is None:
+            offline.append(member)
+        elif member == sender_username:
+            member_socket.sendall(echo)
+        else:
+            member_socket.send_shared(shared)
+    if offline:
+        user_names.mailboxes.put(offline, bytes(shared.payload))
+    metrics.observe("fanout_recipients", len(everyone) - 1, size_buckets)
+
+    groups.add_history(group, shared.payload)
+
+# Function to make a remaining member admin when nobody was chosen
+def auto_assign_admin(group, user_names, groups):
+    # Somebody may have become admin while the leaving user was being asked
+    if group.deleted or group.admins or not group.members:
         return
+    auto_assigned_admin = min(group.members)
+    if not groups.promote(group, auto_assigned_admin):
+        return
+    send_to_user(auto_assigned_admin, f"[You have been auto-assigned as an admin of the {group.name} group]".encode('utf-8'), user_names)
+    # Send notification to other members
+    send_to_users(group.members, f"[{auto_assigned_admin} has been auto-assigned as an admin of the {group.name} group]".encode('utf-8'), user_names)
 
-    group_name = parts[2]
+# Function to handle a user leaving a group
+def leave_group(args, user_socket, user_names, groups):
+    group_name = args[0]
     # Check if group exists
-    if group_name not in groups:
+    group = groups.get(group_name)
+    if group is None:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
 
     # Check if user is a member of the group
     leaving_member = user_names[user_socket]
-    if leaving_member not in groups[group_name]['members'] and leaving_member not in groups[group_name]['admins']:
+    if leaving_member not in group:
         user_socket.sendall("[You are not a member of this group]".encode('utf-8'))
         return
 
-    # Remove user from the group if the user is in the group
-    if leaving_member in groups[group_name]['members']:
-        groups[group_name]['members'].remove(leaving_member)
-    if leaving_member in groups[group_name]['admins']:
-        groups[group_name]['admins'].remove(leaving_member)
+    # Remove user from the group
+    if not groups.remove_members(group, [leaving_member]):
+        user_socket.sendall("[You are not a member of this group]".encode('utf-8'))
+        return
 
     # Check if the group still exists after the member leaves
-    if not groups[group_name]['members'] and not groups[group_name]['admins']:
-        del groups[group_name]
+    if not group.everyone():
+        groups.delete(group)
         user_socket.sendall(f"[The {group_name} group has been deleted because all members have left]".encode('utf-8'))
         return
     
-    # If the leaving member is the last admin
-    if not groups[group_name]['admins'] and groups[group_name]['members']:
-        
-        if len(groups[group_name]['members']) == 1:  # If only one member left
-            new_admin = groups[group_name]['members'][0]
-            groups[group_name]['admins'].append(new_admin)
-            groups[group_name]['members'].remove(new_admin)
-            for member_socket, member_username in user_names.items():
-                if member_username == new_admin:
-                    member_socket.sendall(f"[You have been assigned as an admin of the {group_name} group because you are the only member left]".encode('utf-8'))
-        
-        elif len(groups[group_name]['members']) > 1:  # If more than one member left
-            user_socket.sendall(f"Do you want to assign an admin from the remaining members? (yes/no): ".encode('utf-8'))
-            response = user_socket.recv(1024).decode('utf-8').strip()
-            
-            if response.lower() == 'yes':
-                remaining_members = groups[group_name]['members']
-                user_socket.sendall(f"Remaining members: {', '.join(remaining_members)}\nChoose a member to assign as admin: ".encode('utf-8'))
-                admin_choice = user_socket.recv(1024).decode('utf-8').strip()
-                
-                if admin_choice in remaining_members:
-                    groups[group_name]['admins'].append(admin_choice)
-                    groups[group_name]['members'].remove(admin_choice)
-                    for member_socket, member_username in user_names.items():
-                        if member_username == admin_choice:
-                            member_socket.sendall(f"[You have been assigned as an admin of the {group_name} group]".encode('utf-8'))
-                            break  
-                    # Send notification to other members
-                    for member_socket, member_username in user_names.items():
-                        if member_username not in groups[group_name]['admins'] and member_username != admin_choice:
-                            member_socket.sendall(f"[{admin_choice} has been assigned as an admin of the {group_name} group]".encode('utf-8'))
-                            
-                else:
-                    auto_assigned_admin = groups[group_name]['members'][0]
-                    groups[group_name]['admins'].append(auto_assigned_admin)
-                    groups[group_name]['members'].remove(auto_assigned_admin) 
-                    for member_socket, member_username in user_names.items():
-                        if member_username == auto_assigned_admin:
-                            member_socket.sendall(f"[You have been auto-assigned as an admin of the {group_name} group]".encode('utf-8'))
-                            break  
-                    # Send notification to other members
-                    for member_socket, member_username in user_names.items():
-                        if member_username not in groups[group_name]['admins'] and member_username != auto_assigned_admin:
-                            member_socket.sendall(f"[{auto_assigned_admin} has been auto-assigned as an admin of the {group_name} group]".encode('utf-8'))
-                            
-            else:
-                auto_assigned_admin = groups[group_name]['members'][0]
-                groups[group_name]['admins'].append(auto_assigned_admin)
-                groups[group_name]['members'].remove(auto_assigned_admin) 
-                for member_socket, member_username in user_names.items():
-                    if member_username == auto_assigned_admin:
-                        member_socket.sendall(f"[You have been auto-assigned as an admin of the {group_name} group]".encode('utf-8'))
-                        break  
-                # Send notification to other members
-                for member_socket, member_username in user_names.items():
-                    if member_username not in groups[group_name]['admins'] and member_username != auto_assigned_admin:
-                        member_socket.sendall(f"[{auto_assigned_admin} has been auto-assigned as an admin of the {group_name} group]".encode('utf-8'))
-    
-    # Inform all group members except the leaving member and the previously left admin
-    for member_socket, member_username in user_names.items():
-        if member_username in groups[group_name]['members'] or member_username in groups[group_name]['admins']:
-            member_socket.sendall(f"[{leaving_member} has left the {group_name} group]".encode('utf-8'))
+    # Inform all group members except the leaving member
+    send_to_users(group.everyone(), f"[{leaving_member} has left the {group_name} group]".encode('utf-8'), user_names)
 
     # Inform user about leaving the group
     user_socket.sendall(f"[You have left the {group_name} group]".encode('utf-8'))
 
-    
-def delete_group(message, user_socket, user_names, groups):
-    # Parse group name
-    parts = message.split()[2:]
-    
-    # Check if the necessary parameters are present
-    if len(parts) < 1:
-        user_socket.sendall("[Invalid input. Please provide a group name.]".encode('utf-8'))
+    # If the leaving member is the last admin
+    if not group.admins and group.members:
+
+        if len(group.members) == 1:  # If only one member left
+            new_admin = next(iter(group.members))
+            if groups.promote(group, new_admin):
+                send_to_user(new_admin, f"[You have been assigned as an admin of the {group_name} group because you are the only member left]".encode('utf-8'), user_names)
+
+        else:  # If more than one member left, ask the leaving member who takes over
+            user_socket.ask("Do you want to assign an admin from the remaining members? (yes/no): ".encode('utf-8'),
+                            lambda response: answer_assign_admin(response, group, user_socket, user_names, groups),
+                            lambda: auto_assign_admin(group, user_names, groups))
+
+
+# Function to handle the answer to whether the leaving member picks the new admin
+def answer_assign_admin(response, group, user_socket, user_names, groups):
+    if response.strip().lower() != 'yes' or group.deleted or group.admins:
+        auto_assign_admin(group, user_names, groups)
         return
 
-    group_name = parts[0]
-    members_to_add = [member.strip() for member in ''.join(parts[1:]).split(',')]
+    remaining_members = sorted(group.members)
+    user_socket.ask(f"Remaining members: {', '.join(remaining_members)}\nChoose a member to assign as admin: ".encode('utf-8'),
+                    lambda admin_choice: choose_admin(admin_choice.strip(), group, user_names, groups),
+                    lambda: auto_assign_admin(group, user_names, groups))
+
+
+# Function to make the member the leaving member chose an admin
+def choose_admin(admin_choice, group, user_names, groups):
+    if groups.promote(group, admin_choice):
+        send_to_user(admin_choice, f"[You have been assigned as an admin of the {group.name} group]".encode('utf-8'), user_names)
+        # Send notification to other members
+        send_to_users(group.members, f"[{admin_choice} has been assigned as an admin of the {group.name} group]".encode('utf-8'), user_names)
+    else:
+        auto_assign_admin(group, user_names, groups)
 
-     # Check if group exists
-    if group_name not in groups:
+    
+def delete_group(args, user_socket, user_names, groups):
+    group_name = args[0]
+
+    # Check if group exists
+    group = groups.get(group_name)
+    if group is None:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
 
     # Check if user is the creator or an admin of the group
     user_username = user_names[user_socket]
-    if user_username not in groups[group_name]['admins']:
+    if user_username not in group.admins:
         user_socket.sendall("[You are not authorized to delete this group]".encode('utf-8'))
         return
 
     # Prompt the creator/admin if they want to delete the group
-    user_socket.sendall(f"Do you want to delete the group '{group_name}'? This action will remove all members. (yes/no): ".encode('utf-8'))
-    response = user_socket.recv(1024).decode('utf-8').strip()
+    user_socket.ask(f"Do you want to delete the group '{group_name}'? This action will remove all members. (yes/no): ".encode('utf-8'),
+                    lambda response: confirm_delete_group(response, group, user_socket, user_names, groups),
+                    lambda: user_socket.sendall("[No answer. Group deletion cancelled]".encode('utf-8')))
 
-    if response.lower() == 'no':
+
+# Function to delete a group once the admin has confirmed
+def confirm_delete_group(response, group, user_socket, user_names, groups):
+    response = response.strip().lower()
+    if response == 'no':
         user_socket.sendall("[Group deletion cancelled]".encode('utf-8'))
         return
-    elif response.lower() != 'yes':
+    elif response != 'yes':
         user_socket.sendall("[Invalid response. Group deletion cancelled]".encode('utf-8'))
         return
 
-    # Inform admin about group deletion
-    admin_message = f"You have deleted the group '{group_name}'."
-    deletion_message = f"The group '{group_name}' has been deleted by {user_username}."
-
-    for member in groups[group_name]['members'] + groups[group_name]['admins']:
-        for member_socket, username in user_names.items():
-            if username == member:
-                if member_socket == user_socket:
-                    member_socket.sendall(admin_message.encode('utf-8'))
-                elif username != user_username:
-                    member_socket.sendall(deletion_message.encode('utf-8'))
+    # The group may have changed while the admin was being asked
+    user_username = user_names[user_socket]
+    if user_username not in group.admins:
+        user_socket.sendall("[You are not authorized to delete this group]".encode('utf-8'))
+        return
+    if not groups.delete(group):
+        user_socket.sendall("[Group does not exist]".encode('utf-8'))
+        return
 
-    # Delete the group
-    del groups[group_name]
+    # Inform admin and members about group deletion
+    user_socket.sendall(f"You have deleted the group '{group.name}'.".encode('utf-8'))
+    send_to_users(group.everyone() - {user_username}, f"The group '{group.name}' has been deleted by {user_username}.".encode('utf-8'), user_names)
 
 
 
 # Function to add a member to a group
-def add_group_member(message, user_socket, user_names, groups):
-    # Parse group name and member(s) to add
-    parts = message.split()[2:]
-    
-    # Check if the necessary parameters are present
-    if len(parts) < 2:
-        user_socket.sendall("[Invalid input. Please provide a group name and at least one member to add.]".encode('utf-8'))
-        return
-    
-    group_name = parts[0]
-    members_to_add = [member.strip() for member in ''.join(parts[1:]).split(',')]
+def add_group_member(args, user_socket, user_names, groups):
+    group_name, members_to_add = args
+    # Use the spelling each user registered with
+    members_to_add = [user_names.canonical(member) or member for member in members_to_add]
 
     # Check if group exists
-    if group_name not in groups:
+    group = groups.get(group_name)
+    if group is None:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
 
     # Check if user is the creator or an admin of the group
     sender_name = user_names[user_socket]
-    if sender_name not in groups[group_name]['admins']:
+    if sender_name not in group.admins:
         user_socket.sendall("[You are not authorized to add members to this group]".encode('utf-8'))
         return
 
     # Check if any member to add is already in the group
-    existing_members = groups[group_name]['members'] + groups[group_name]['admins']
-    already_members = [member for member in members_to_add if member in existing_members]
+    already_members = [member for member in members_to_add if member in group]
     if already_members:
         user_socket.sendall(f"[{', '.join(already_members)} already member(s) of this group]".encode('utf-8'))
         return
 
     # Check if all members to add exist
-    non_existing_members = [member for member in members_to_add if member not in user_names.values()]
+    non_existing_members = [member for member in members_to_add if user_names.connection_for(member) is None]
     if non_existing_members:
         user_socket.sendall(f"[User(s) {' '.join(non_existing_members)} to add do(es) not exist]".encode('utf-8'))
         return
 
+    # Other members and admins to tell about the addition
+    others = group.everyone() - {sender_name}
+
     # Add members to the group
-    groups[group_name]['members'].extend(members_to_add)
+    members_to_add = groups.add_members(group, members_to_add)
+    if not members_to_add:
+        return
 
     # Inform the added members
-    for member_socket, member_username in user_names.items():
-        if member_username in members_to_add:
-            member_socket.sendall(f"[You are enrolled into the {group_name} group by {sender_name}]".encode('utf-8'))
+    send_to_users(members_to_add, f"[You are enrolled into the {group_name} group by {sender_name}]".encode('utf-8'), user_names)
 
     # Inform user that added members about the addition
     user_socket.sendall(f"[You added {' '.join(members_to_add)} to the {group_name} group]".encode('utf-8'))
 
     # Inform other members and admins about the addition
-    for member_socket, member_username in user_names.items():
-        if member_username != sender_name and member_username not in members_to_add and (member_username in groups[group_name]['members'] or member_username in groups[group_name]['admins']):
-            member_socket.sendall(f"[{', '.join(members_to_add)} were added to the {group_name} group by {sender_name}]".encode('utf-8'))
+    send_to_users(others, f"[{', '.join(members_to_add)} were added to the {group_name} group by {sender_name}]".encode('utf-8'), user_names)
 
 
 
 # Function to remove member(s) from a group
-def remove_group_member(message, user_socket, user_names, groups):
-    parts = message.split()[2:]
+def remove_group_member(args, user_socket, user_names, groups):
+    group_name, members_to_remove = args
+    # Use the spelling each user registered with
+    members_to_remove = [user_names.canonical(member) or member for member in members_to_remove]
 
-    if len(parts) < 2:
-        user_socket.sendall("[Invalid input. Please provide a group name and at least one member to remove.]".encode('utf-8'))
-        return
-
-    group_name = parts[0]
-    members_to_remove = [member.strip() for member in ''.join(parts[1:]).split(',')]
-
-    if group_name not in groups:
+    group = groups.get(group_name)
+    if group is None:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
 
-    if user_names[user_socket] not in groups[group_name]['admins']:
+    remover = user_names[user_socket]
+    if remover not in group.admins:
         user_socket.sendall("[You are not authorized to remove members from this group]".encode('utf-8'))
         return
 
-    # Combined members and admins for the removal check
-    existing_members = groups[group_name]['members'] + groups[group_name]['admins']
-    
     removed_members = []
 
     for member in members_to_remove:
         # Check if member is in the group (either as member or admin)
-        if member not in existing_members:
+        if member not in group:
             user_socket.sendall(f"[{member} is not a member of the {group_name} group]".encode('utf-8'))
             continue  # Skip to the next member
 
-        # Handle removing from members list if present
-        if member in groups[group_name]['members']:
-            groups[group_name]['members'].remove(member)
-
-        # Handle removing from admins list if present
-        if member in groups[group_name]['admins']:
-            groups[group_name]['admins'].remove(member)
-            # Optionally, demote to a regular member instead of removing from the group entirely
-            # groups[group_name]['members'].append(member)
-
+        # Remove the member whether they are a regular member or an admin
+        if not groups.remove_members(group, [member]):
+            continue
         removed_members.append(member)
 
         # Inform the removed member
-        for member_socket, member_username in user_names.items():
-            if member_username == member:
-                member_socket.sendall(f"[You have been removed from the {group_name} group by {user_names[user_socket]}]".encode('utf-8'))
+        send_to_user(member, f"[You have been removed from the {group_name} group by {remover}]".encode('utf-8'), user_names)
 
     # Inform the user who removed the members
     if removed_members:
         user_socket.sendall(f"[You removed {' '.join(removed_members)} from the {group_name} group]".encode('utf-8'))
 
-    # Inform the remaining group members and admins about the removal
-    for member_socket, member_username in user_names.items():
-        if removed_members and member_username in existing_members and member_username != user_names[user_socket]:
-            member_socket.sendall(f"[{' '.join(removed_members)} were removed from the {group_name} group by {user_names[user_socket]}]".encode('utf-8'))
+        # Inform the remaining group members and admins about the removal
+        send_to_users(group.everyone() - {remover}, f"[{' '.join(removed_members)} were removed from the {group_name} group by {remover}]".encode('utf-8'), user_names)
 
 
 
 # Function to list all groups a user is in
-def list_groups(message, user_socket, user_names, groups):
-    username = user_names[user_socket]
-    user_groups = [group_name for group_name, group_data in groups.items() if username in group_data['members'] or username in group_data['admins']]
+def list_groups(args, user_socket, user_names, groups):
+    user_groups = groups.groups_of(user_names[user_socket])
     if user_groups:
         user_socket.sendall(f"[Groups you are in: {', '.join(user_groups)}]".encode('utf-8'))
     else:
         user_socket.sendall("[You are not in any groups]".encode('utf-8'))
 
 # Function to list all members in a group
-def list_group_members(message, user_socket, user_names, groups):
-    # Parse group name
-    parts = message.split()
-
-    # Check if the necessary parameters are present
-    if len(parts) < 3:
-        user_socket.sendall("[Invalid input. Please provide a group name.]".encode('utf-8'))
-        return
-
-    group_name = parts[2]
-    
-    if group_name in groups:
-        group_members = groups[group_name]['members']
-        admins = groups[group_name]['admins']
-        formatted_members = [f"{member}" if member in admins else member for member in group_members]
-        formatted_admins = [f"{admin}" for admin in admins]
-        user_socket.sendall(f"[Members in {group_name} group: {', '.join(formatted_members)}]".encode('utf-8'))
-        user_socket.sendall(f"[Admins in {group_name} group: {', '.join(formatted_admins)}]".encode('utf-8'))
+def list_group_members(args, user_socket, user_names, groups):
+    group_name = args[0]
+    group = groups.get(group_name)
+    if group is not None:
+        user_socket.sendall(f"[Members in {group_name} group: {', '.join(sorted(group.members))}]".encode('utf-8'))
+        user_socket.sendall(f"[Admins in {group_name} group: {', '.join(sorted(group.admins))}]".encode('utf-8'))
     else:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         
 
-# Function to authorize a member as an admin of a group
-def authorize_group_member(message, user_socket, user_names, groups):
-    parts = message.split()[2:]
-    
-    if len(parts) < 2:
-        user_socket.sendall("[Invalid input. Please provide a group name and at least one username.]".encode('utf-8'))
+# Function to page through the recent messages of a group, newest page first
+def group_history(args, user_socket, user_names, groups):
+    group_name, before_id, count = args
+    count = HISTORY_PAGE if count is None else min(count, HISTORY_PAGE_MAX)
+
+    group = groups.get(group_name)
+    if group is None:
+        user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
+    if user_names[user_socket] not in group:
+        user_socket.sendall("[You are not a member of this group]".encode('utf-8'))
+        return
+
+    page, first_id = groups.history_page(group, before_id, count)
+    if not page:
+        user_socket.sendall(f"[No earlier messages in the {group_name} group]".encode('utf-8'))
+        return
+
+    user_socket.sendall(f"[Messages {page[0][0]}-{page[-1][0]} of the {group_name} group]".encode('utf-8'))
+    user_socket.send_batch([f"#{message_id} ".encode('utf-8') + data for message_id, data in page])
+    if page[0][0] > first_id:
+        user_socket.sendall(f"[For earlier messages: @group history {group_name} {page[0][0]} {count}]".encode('utf-8'))
+
 
-    group_name = parts[0]
-    usernames_to_authorize = ' '.join(parts[1:]).split(',')
+# Function to authorize a member as an admin of a group
+def authorize_group_member(args, user_socket, user_names, groups):
+    group_name, usernames_to_authorize = args
 
-    if group_name not in groups:
+    group = groups.get(group_name)
+    if group is None:
         user_socket.sendall("[Group does not exist]".encode('utf-8'))
         return
 
     sender_username = user_names[user_socket]
 
-    if sender_username not in groups[group_name]['admins']:
+    if sender_username not in group.admins:
         user_socket.sendall("[You are not authorized to authorize members in this group]".encode('utf-8'))
         return
 
     for username_to_authorize in usernames_to_authorize:
         username_to_authorize = username_to_authorize.strip()
 
-        if username_to_authorize not in user_names.values():
+        if user_names.connection_for(username_to_authorize) is None:
             user_socket.sendall(f"[{username_to_authorize} does not exist]".encode('utf-8'))
             continue
+        username_to_authorize = user_names.canonical(username_to_authorize)
 
         # Check if the user to authorize is already an admin
-        if username_to_authorize in groups[group_name]['admins']:
+        if username_to_authorize in group.admins:
             user_socket.sendall(f"[{username_to_authorize} is already an admin in {group_name}]".encode('utf-8'))
             continue
 
         # Check if the user to authorize is not a member (and not already covered by being an admin)
-        if username_to_authorize not in groups[group_name]['members']:
+        if username_to_authorize not in group.members:
             user_socket.sendall(f"[{username_to_authorize} is not a member of the {group_name} group]".encode('utf-8'))
             continue
 
         # Authorize the user as an admin
-        groups[group_name]['admins'].append(username_to_authorize)
-        
-        # Remove the user from regular members, if they are present
-        if username_to_authorize in groups[group_name]['members']:
-            groups[group_name]['members'].remove(username_to_authorize)
+        if not groups.promote(group, username_to_authorize):
+            continue
 
         # Inform the user who is assigned as admin
-        for member_socket, member_username in user_names.items():
-            if member_username == username_to_authorize:
-                member_socket.sendall(f"[You have been assigned as an admin of the {group_name} group by {sender_username}]".encode('utf-8'))
+        send_to_user(username_to_authorize, f"[You have been assigned as an admin of the {group_name} group by {sender_username}]".encode('utf-8'), user_names)
 
         # Inform the admin who authorized the new member
         user_socket.sendall(f"[You have authorized {username_to_authorize} as an admin of the {group_name} group]".encode('utf-8'))
 
         # Send notification to other members and admins
-        for member_socket, member_username in user_names.items():
-            if member_username != sender_username and member_username != username_to_authorize and (member_username in groups[group_name]['members'] or member_username in groups[group_name]['admins']):
-                member_socket.sendall(f"[{username_to_authorize} is authorized as an admin of the {group_name} group by {sender_username}]".encode('utf-8'))
+        send_to_users(group.everyone() - {sender_username, username_to_authorize}, f"[{username_to_authorize} is authorized as an admin of the {group_name} group by {sender_username}]".encode('utf-8'), user_names)
+
+
+# Function to make many changes to a group at once: create it, add, remove
+# and authorize members. The changes are checked together and either all
+# made, in one change to the group, or none; every user affected is told
+# once.
+def batch_group_changes(args, user_socket, user_names, groups):
+    group_name, changes = args
+    sender_name = user_names[user_socket]
+
+    # Users named by the changes, looked up in one pass
+    named = [username for op, usernames in changes if op != "remove" for username in usernames]
+    found, missing = user_names.resolve(named)
+    spelling = {username.lower(): username for username in found}
+    if missing:
+        user_socket.sendall(f"[User(s) {', '.join(dict.fromkeys(missing))} do(es) not exist; nothing was changed]".encode('utf-8'))
+        return
+
+    creating = changes[0][0] == "set"
+    if creating:
+        if not group_name.isalnum():
+            user_socket.sendall("[Group name must contain only alphanumeric characters]".encode('utf-8'))
+            return
+        if group_name in groups:
+            user_socket.sendall("[Group name already exists]".encode('utf-8'))
+            return
+        group = None
+        members, admins = set(), {sender_name}
+    else:
+        group = groups.get(group_name)
+        if group is None:
+            user_socket.sendall("[Group does not exist]".encode('utf-8'))
+            return
+        if sender_name not in group.admins:
+            user_socket.sendall("[You are not authorized to change this group]".encode('utf-8'))
+            return
+        members, admins = set(group.members), set(group.admins)
+    before_everyone, before_admins = members | admins, set(admins)
+
+    # Make the changes, in order, to a copy of the group
+    errors = []
+    for op, usernames in changes:
+        if op == "remove":
+            usernames = [user_names.canonical(username) or username for username in usernames]
+        else:
+            usernames = [spelling[username.lower()] for username in usernames]
+        if op == "set":
+            usernames = [username for username in usernames if username != sender_name]
+        if op in ("set", "add"):
+            errors += [f"{username} is already a member" for username in usernames if username in members | admins]
+            members.update(usernames)
+        elif op == "remove":
+            errors += [f"{username} is not a member" for username in usernames if username not in members | admins]
+            members.difference_update(usernames)
+            admins.difference_update(usernames)
+        else:
+            errors += [f"{username} is already an admin" for username in usernames if username in admins]
+            errors += [f"{username} is not a member" for username in usernames if username not in members | admins]
+            admins.update(usernames)
+            members.difference_update(usernames)
+    if sender_name not in admins:
+        errors.append(f"{sender_name} would not be an admin any more")
+    if errors:
+        user_socket.sendall(f"[{'; '.join(dict.fromkeys(errors))}; nothing was changed]".encode('utf-8'))
+        return
+
+    if creating:
+        group = groups.create(group_name, sender_name, members, admins - {sender_name})
+        if group is None:
+            # Another user took the name while we were checking the changes
+            user_socket.sendall("[Group name already exists]".encode('utf-8'))
+            return
+        added, removed, promoted = sorted((members | admins) - {sender_name}), [], sorted(admins - {sender_name})
+    else:
+        after = members | admins
+        added, removed, promoted = groups.change_members(group, sorted(after - before_everyone),
+                                                         sorted(before_everyone - after),
+                                                         sorted(admins - before_admins))
+
+    # One message for each user affected, and one for everyone else in the group
+    summary = "; ".join(f"{what} {', '.join(usernames)}" for what, usernames in
+                        (("added", added), ("removed", removed), ("authorized", promoted)) if usernames)
+    if not summary:
+        user_socket.sendall(f"[You {'created' if creating else 'changed nothing in'} the {group_name} group]".encode('utf-8'))
+        return
+    for username in added:
+        role = " as an admin" if username in promoted else ""
+        send_to_user(username, f"[You are enrolled into the {group_name} group{role} by {sender_name}]".encode('utf-8'), user_names)
+    for username in removed:
+        send_to_user(username, f"[You have been removed from the {group_name} group by {sender_name}]".encode('utf-8'), user_names)
+    for username in promoted:
+        if username not in added:
+            send_to_user(username, f"[You have been assigned as an admin of the {group_name} group by {sender_name}]".encode('utf-8'), user_names)
+    verb = "created" if creating else "changed"
+    user_socket.sendall(f"[You {verb} the {group_name} group: {summary}]".encode('utf-8'))
+    others = group.everyone() - {sender_name} - set(added) - set(promoted)
+    send_to_users(others, f"[{sender_name} changed the {group_name} group: {summary}]".encode('utf-8'), user_names)
 
 
 # Function to broadcast a message to all users except the sender
-def broadcast(message, sender_socket, user_names, is_join_message=False):
-    for user in users:
+def broadcast(message, sender_socket, user_names):
+    # Format and encode once; every recipient gets the same buffer
+    shared = SharedMessage(f"[{user_names[sender_socket]}]: {message}".encode('utf-8'))
+    recipients = 0
+    for user in user_names.all_connections():
         if user is not sender_socket:
-            if is_join_message:
-                user.sendall(f"{message}".encode('utf-8'))
-            else:
-                user.sendall(f"[{user_names[sender_socket]}]: {message}".encode('utf-8'))
-
-# Function to parse personal messages
-def parse_personal_message(message):
-    recipient_username, personal_message = message.split(maxsplit=1)
-    recipient_username = recipient_username[1:]  # Remove '@' symbol
-    return recipient_username, personal_message
+            user.send_shared(shared)
+            recipients += 1
+    metrics.observe("fanout_recipients", recipients, size_buckets)
 
 # Function to send a personal message to a specific user
 def send_personal_message(recipient_username, personal_message, sender_socket, user_names):
-    recipient_socket = None
-    for user_socket, username in user_names.items():
-        if username == recipient_username:
-            recipient_socket = user_socket
-            break
+    recipient_socket = user_names.connection_for(recipient_username)
+    data = f"[Personal Message from {user_names[sender_socket]}]: {personal_message}".encode('utf-8')
 
-    if recipient_socket is None:
-        sender_socket.sendall(f"[Error]: User '{recipient_username}' does not exist.".encode('utf-8'))
+    if recipient_socket is not None:
+        recipient_socket.sendall(data)
     else:
-        recipient_socket.sendall(f"[Personal Message from {user_names[sender_socket]}]: {personal_message}".encode('utf-8'))
-        
+        # The caller made sure the user exists, so they can be sent mail
+        user_names.mailboxes.put([recipient_username], data)
+        sender_socket.sendall(f"[{recipient_username} is offline and will get your message when they return]".encode('utf-8'))
+
+# Function to send a message to a user by name, if they are connected
+def send_to_user(username, data, user_names):
+    user_socket = user_names.connection_for(username)
+    if user_socket is not None:
+        user_socket.sendall(data)
+
+# Function to send one message to many users by name, encoded once
+def send_to_users(usernames, data, user_names):
+    shared = SharedMessage(data)
+    for username in usernames:
+        user_socket = user_names.connection_for(username)
+        if user_socket is not None:
+            user_socket.send_shared(shared)
+
+# Commands understood by the server, shared by every engine: the handler,
+# how its arguments are parsed, what to say when they are wrong and the rate
+# limit it counts against
+commands = {
+    "@quit": Command(quit_command),
+    "@names": Command(names, names_query, "[Invalid input. Usage: @names [prefix] [after <username>]]", limit="names"),
+    "@presence": Command(presence, one_of(*presence_modes), f"[Invalid input. Usage: @presence {'|'.join(presence_modes)}]"),
+    "@group set": Command(create_group, name_and_list,
+                          "[Invalid input. Please provide a group name and at least one member.]"),
+    "@group send": Command(send_group_message, name_and_text,
+                           "[Invalid input. Please provide a group name and a message.]", limit="group_send"),
+    "@group delete": Command(delete_group, name_only, "[Invalid input. Please provide a group name.]"),
+    "@group leave": Command(leave_group, name_only, "[Invalid input. Please provide a group name.]"),
+    "@group add": Command(add_group_member, name_and_list,
+                          "[Invalid input. Please provide a group name and at least one member to add.]"),
+    "@group list": Command(list_groups),
+    "@group remove": Command(remove_group_member, name_and_list,
+                             "[Invalid input. Please provide a group name and at least one member to remove.]"),
+    "@group members": Command(list_group_members, name_only, "[Invalid input. Please provide a group name.]"),
+    "@group authorize": Command(authorize_group_member, name_and_list,
+                                "[Invalid input. Please provide a group name and at least one username.]"),
+    "@group batch": Command(batch_group_changes, name_and_changes,
+                            "[Invalid input. Usage: @group batch <group_name> <set|add|remove|authorize> <members>; ...]"),
+    "@group history": Command(group_history, name_and_numbers,
+                              "[Invalid input. Usage: @group history <group_name> [before-id] [count]]"),
+}
+
+# The commands as a trie of words, built once
+command_table = CommandTable(commands)
+
+
+# Function to notify every user and stop accepting connections
+def shutdown_server(stop_server, user_names, groups):
+    print("Shutting down the server...")
+
+    # Inform all connected clients about server shutting down
+    for user_socket in user_names.local_connections():  # A snapshot, so cleanup cannot change it underneath us
+        try:
+            # Safely attempt to notify the client and close the socket.
+            user_socket.sendall("[Server is shutting down]".encode('utf-8'))
+            user_socket.resumable = False
+            cleanup_user(user_socket, user_names, groups)
+        except OSError as e:
+            print(f"Error sending shutdown message to a client: {e}")
+    print("All clients have been notified and disconnected.")
+
+    # Stop accepting new connections.
+    try:
+        stop_server()
+    except OSError as e:
+        print(f"Error closing server socket: {e}")
+
+    print("Server has been successfully shut down.")
+
+
+# Function to run one server command; True once the server is shut down
+def run_server_command(command, stop_server, user_names, groups, label=""):
+    if command.strip().lower() == "@quit":
+        shutdown_server(stop_server, user_names, groups)
+        return True
+    elif command.strip().lower() == "@stats":
+        print(label + format_snapshot(metrics.snapshot()))
+    return False
+
+
 # Function to handle server commands
-def handle_server_commands(server_socket, users, user_names, groups):
+def handle_server_commands(stop_server, user_names, groups):
     while True:
         command = input("Server command: ")
-        if command.strip().lower() == "@quit":
-            print("Shutting down the server...")
-
-            # Inform all connected clients about server shutting down
-            for user_socket in list(users):  # Use a copy of the list to avoid modification during iteration
-                try:
-                    # Safely attempt to notify the client and close the socket.
-                    user_socket.sendall("[Server is shutting down]".encode('utf-8'))
-                    cleanup_user(user_socket, user_names, groups)
-                except OSError as e:
-                    print(f"Error sending shutdown message to a client: {e}")
-            print("All clients have been notified and disconnected.")
-
-            # Close the server socket to stop accepting new connections.
-            try:
-                server_socket.close()
-            except OSError as e:
-                print(f"Error closing server socket: {e}")
-
-            print("Server has been successfully shut down.")
+        if run_server_command(command, stop_server, user_names, groups):
             break
 
-# Main function to start the server
-def main():
-    host = 'localhost'
-    port = 8888
 
+# Function to take server commands from the console, and from the cluster
+# when this server is a node of one; workers only take them from the supervisor
+def start_server_commands(stop_server, user_names, groups, node, console, daemon):
+    if node is not None:
+        node.on_command = lambda command: run_server_command(command, stop_server, user_names, groups,
+                                                             f"[node {node.node_id}]\n")
+    if not console:
+        return
+    command_thread = threading.Thread(target=handle_server_commands, args=(stop_server, user_names, groups))
+    command_thread.daemon = daemon
+    command_thread.start()
+
+
+# Function to claim a username for a user; False if the name is taken
+def register_user(username, user_socket, user_names, accepted_at):
+    # Claim the username; fails if it is already in use, ignoring case
+    try:
+        claimed = user_names.claim(username, user_socket)
+    except ClusterTimeout:
+        # The node lets the name go again if the claim does go through
+        user_socket.sendall("[The cluster did not answer in time. Please try again.]".encode('utf-8'))
+        return False
+    if not claimed:
+        # Inform user about duplicate username
+        user_socket.sendall("[Existing Username. Please enter another name instead.]".encode('utf-8'))
+        return False
+
+    # Welcome message for the new user
+    user_socket.sendall(f"[Welcome {username}!]".encode('utf-8'))
+    if user_names.sessions is not None:
+        user_names.sessions.start(user_socket, username)
+    metrics.observe("accept_to_welcome_seconds", time.monotonic() - accepted_at)
+    metrics.incr("users_connected")
+    # Other users hear of the new user from the presence feed
+
+    # Messages sent while the user was away follow in batches, behind the
+    # welcome; the user's writer sends them while the user is served
+    mail = user_names.mailboxes.take(username)
+    if mail:
+        count = "1 message" if len(mail) == 1 else f"{len(mail)} messages"
+        user_socket.sendall(f"[{count} arrived while you were away]".encode('utf-8'))
+        for start in range(0, len(mail), MAIL_BATCH):
+            user_socket.send_batch(mail[start:start + MAIL_BATCH])
+        metrics.incr("mail_delivered", len(mail))
+    return True
+
+
+# Function to take over the session a client names with "@resume <token>
+# <count>"; returns the username, or None if it cannot be resumed
+def resume_user(request, user_socket, user_names):
+    words = request.split()
+    session = None
+    if user_names.sessions is not None and len(words) == 3 and words[2].isdigit():
+        session, lost = user_names.sessions.resume(words[1], int(words[2]), user_socket)
+    if session is None:
+        user_socket.sendall("[Your session could not be resumed; please log in again]".encode('utf-8'))
+        return None
+    if lost:
+        user_socket.sendall(f"[{lost} messages for you were lost while you were away]".encode('utf-8'))
+    return session.username
+
+
+# Function to run a handler for an asyncio user. In a cluster, changes to
+# the state wait until every node has them, so there the handler runs on a
+# thread of its own rather than holding up the loop.
+async def run_handler(offload, handler, *args):
+    if not offload:
+        return handler(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, handler, *args)
+
+
+# Function to ask an asyncio user for a unique username
+async def login_user_async(user_socket, user_names, accepted_at, offload=False):
+    while True:
+        user_socket.sendall("Enter your username: ".encode('utf-8'))
+        username = await user_socket.recv_message()
+        if username is None:
+            return None
+        username = username.strip()
+        if username.startswith("@resume "):
+            # Not offloaded: the old connection must give up its queue on the
+            # loop before the session is handed over, and nothing here waits on
+            # the cluster
+            username = resume_user(username, user_socket, user_names)
+            if username is not None:
+                return username
+        elif await run_handler(offload, register_user, username, user_socket, user_names, accepted_at):
+            return username
+
+
+# Function to handle communication with a user on the asyncio engine
+async def handle_user_async(reader, writer, user_names, groups, args, limiter, heartbeat, compressor, offload=False):
+    accepted_at = time.monotonic()
+    set_keepalive(writer.get_extra_info('socket'), args.keepalive)
+    user_socket = AsyncUserConnection(reader, writer, args.max_frame_size, args.queue_size, args.overflow_policy,
+                                      args.prompt_timeout, args.flush_interval, args.flush_bytes, args.tcp)
+    user_socket.compressor = compressor
+    addr = user_socket.getpeername()
+    print(f"***Accepted connection from {addr[0]}:{addr[1]}***")
+    metrics.incr("connections_accepted")
+
+    try:
+        username = await asyncio.wait_for(login_user_async(user_socket, user_names, accepted_at, offload),
+                                          args.handshake_timeout)
+    except asyncio.TimeoutError:
+        metrics.incr("handshake_timeouts")
+        user_socket.sendall("[Login timed out]".encode('utf-8'))
+        username = None
+    except (OSError, ProtocolError) as e:
+        print(f"Socket error: {e}")
+        username = None
+    except asyncio.CancelledError:
+        # The server shut down before the user picked a name
+        username = None
+    if username is None:
+        user_socket.close()
+        return
+    if limiter is not None:
+        user_socket.limits = limiter.connect(addr[0])
+    if heartbeat is not None:
+        heartbeat.watch(user_socket)
+
+    try:
+        while True:
+            message = await user_socket.recv_message()
+            if message is None:
+                break
+
+            message = message.strip()
+            if not message:
+                continue
+
+            await run_handler(offload, process_message, message, user_socket, user_names, groups)
+            if user_socket.closed:
+                break
+
+            # Under the block policy, hold this user back until slow recipients catch up
+            await wait_for_room()
+
+    except OSError as e:
+        print(f"Socket error: {e}")
+    except ProtocolError as e:
+        print(f"Protocol error: {e}")
+    except Exception as e:
+        metrics.incr("handler_exceptions")
+        print(f"Unexpected error: {e}")
+    finally:
+        await run_handler(offload, cleanup_user, user_socket, user_names, groups)
+
+
+# Function to run the server on a single asyncio event loop
+async def main_async(args, user_names, groups, node=None):
+    loop = asyncio.get_running_loop()
+    limiter = rate_limiter(args)
+    heartbeat = heartbeats(args)
+    compressor = compressors(args)
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_user_async(reader, writer, user_names, groups, args, limiter, heartbeat,
+                                                 compressor, node is not None),
+        args.host, args.port, backlog=args.backlog, reuse_port=args.workers > 1)
+    if args.workers == 1:
+        print(f"***Listening on {args.host}:{args.port} (asyncio engine)***")
+
+    # Server commands are read on a thread; @quit resolves this future
+    stopped = loop.create_future()
+
+    def stop_server():
+        loop.call_soon_threadsafe(stopped.set_result, None)
+
+    start_server_commands(stop_server, user_names, groups, node, console=args.workers == 1, daemon=True)
+
+    await stopped
+    server.close()
+    await server.wait_closed()
+
+    # Give every user's writer a chance to flush the shutdown notice
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    if pending:
+        await asyncio.wait(pending, timeout=5)
+
+
+# Function to ask a user for a unique username
+def login_user(user_socket, user_names, accepted_at):
+    while True:
+        user_socket.sendall("Enter your username: ".encode('utf-8'))
+        username = user_socket.recv_message()
+        if username is None:
+            return None
+        username = username.strip()
+        if username.startswith("@resume "):
+            username = resume_user(username, user_socket, user_names)
+            if username is not None:
+                return username
+        elif register_user(username, user_socket, user_names, accepted_at):
+            return username
+
+
+# Function to log a user in and then serve them, run on the user's own thread
+def serve_user(user_socket, user_names, groups, accepted_at, handshake_timeout, limiter, heartbeat, address, logging_in):
+    # The handshake gets a deadline so an idle client cannot hold its thread forever
+    user_socket.settimeout(handshake_timeout)
+    try:
+        username = login_user(user_socket, user_names, accepted_at)
+    except socket.timeout:
+        metrics.incr("handshake_timeouts")
+        try:
+            user_socket.sendall("[Login timed out]".encode('utf-8'))
+        except OSError:
+            pass
+        username = None
+    except (OSError, ProtocolError) as e:
+        print(f"Socket error: {e}")
+        username = None
+    finally:
+        logging_in.discard(user_socket)
+    if username is None:
+        user_socket.close()
+        return
+
+    user_socket.settimeout(None)
+    if limiter is not None:
+        user_socket.limits = limiter.connect(address)
+    if heartbeat is not None:
+        heartbeat.watch(user_socket)
+    handle_user(user_socket, user_names, groups)
+
+
+# Function to run the server with one thread per connected user
+def main_threaded(args, user_names, groups, node=None):
     # Create a socket for the server
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if args.workers > 1:
+        # Every worker listens on the same port
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     # Bind the socket to the host and port
-    server_socket.bind((host, port))
+    server_socket.bind((args.host, args.port))
     # Start listening for connections
-    server_socket.listen(5)
-
-    print(f"***Listening on {host}:{port}***")
-
-    users = []
-    user_names = {}
-    groups = {}
+    server_socket.listen(args.backlog)
+
+    if args.workers == 1:
+        print(f"***Listening on {args.host}:{args.port}***")
+
+    stopped = threading.Event()
+    limiter = rate_limiter(args)
+    heartbeat = heartbeats(args)
+    compressor = compressors(args)
+    # Connections still logging in, which shutting down closes too; their
+    # threads would otherwise keep the server running until they log in
+    logging_in = set()
+    logging_in_lock = threading.Lock()
+
+    def stop_server():
+        # Shutting the socket down wakes up the accept() below
+        with logging_in_lock:
+            stopped.set()
+        try:
+            server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        server_socket.close()
+        for user_socket in list(logging_in):
+            user_socket.sendall("[Server is shutting down]".encode('utf-8'))
+            user_socket.close()
 
     # Start a thread to handle server commands
-    command_thread = threading.Thread(target=handle_server_commands, args=(server_socket, users, user_names, groups))
-    command_thread.start()
+    start_server_commands(stop_server, user_names, groups, node, console=args.workers == 1, daemon=False)
 
-    # Main loop to accept incoming connections
+    # Main loop to accept incoming connections; the login prompt runs on the
+    # user's own thread so a slow client never holds up the next accept()
     while True:
         try:
             user_socket, addr = server_socket.accept()
+            accepted_at = time.monotonic()
             print(f"***Accepted connection from {addr[0]}:{addr[1]}***")
         except OSError as e:
-            print(f"Error: {e}")
+            if not stopped.is_set():
+                print(f"Error: {e}")
             break
 
-        # Prompt user for username
-        while True:
-            user_socket.sendall("Enter your username: ".encode('utf-8'))
-            username = user_socket.recv(1024).decode('utf-8').strip()
+        metrics.incr("connections_accepted")
+        set_keepalive(user_socket, args.keepalive)
+        user_socket = UserConnection(user_socket, args.max_frame_size, args.queue_size, args.overflow_policy, args.prompt_timeout,
+                                     args.flush_interval, args.flush_bytes, args.tcp)
+        user_socket.compressor = compressor
+        with logging_in_lock:
+            if stopped.is_set():
+                # Accepted just as the server was shutting down
+                user_socket.close()
+                break
+            logging_in.add(user_socket)
+        thread = threading.Thread(target=serve_user, args=(user_socket, user_names, groups, accepted_at, args.handshake_timeout,
+                                                           limiter, heartbeat, addr[0], logging_in))
+        thread.start()
 
-            # Convert username to lowercase
-            username_lower = username.lower()
 
-            # Check if the username is already in use
-            if username_lower in map(str.lower, user_names.values()):
-                # Inform user about duplicate username
-                user_socket.sendall("[Existing Username. Please enter another name instead.]".encode('utf-8'))
-            else:
-                # Unique username, proceed
-                user_names[user_socket] = username
-                users.append(user_socket)
+# Function to parse the server's command-line options
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--host", default='localhost', help="address to listen on (default: localhost)")
+    parser.add_argument("--port", type=int, default=8888, help="port to listen on (default: 8888)")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded",
+                        help="threaded: one thread per user; asyncio: one event loop for all users")
+    parser.add_argument("--backlog", type=int, default=1024,
+                        help="queue length for connections waiting to be accepted (default: 1024)")
+    parser.add_argument("--handshake-timeout", type=float, default=60,
+                        help="seconds a new connection has to pick a username (default: 60)")
+    parser.add_argument("--max-frame-size", type=int, default=MAX_FRAME_SIZE,
+                        help=f"largest framed message accepted from a client in bytes (default: {MAX_FRAME_SIZE})")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help=f"messages that may wait to be written to one user (default: {QUEUE_SIZE})")
+    parser.add_argument("--overflow-policy", choices=overflow_policies, default=DROP_OLDEST,
+                        help="what to do when a user's queue is full (default: drop-oldest)")
+    parser.add_argument("--prompt-timeout", type=float, default=PROMPT_TIMEOUT,
+                        help=f"seconds a user has to answer a question such as @group delete's (default: {PROMPT_TIMEOUT})")
+    parser.add_argument("--flush-interval", type=float, default=FLUSH_INTERVAL,
+                        help="seconds to wait for more messages to write together to a user (default: 0, write as soon as possible)")
+    parser.add_argument("--flush-bytes", type=int, default=FLUSH_BYTES,
+                        help=f"bytes written to a user at most at a time; a flush interval ends early once this much is queued (default: {FLUSH_BYTES})")
+    parser.add_argument("--tcp", choices=tcp_modes, default=NODELAY,
+                        help="nodelay sends each write at once, nagle lets the kernel hold small ones back, "
+                             "cork sends each write in full packets (default: nodelay)")
+    parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD,
+                        help=f"bytes from which messages are compressed for clients that can inflate them, 0 to never compress (default: {COMPRESS_THRESHOLD})")
+    parser.add_argument("--compress-level", type=int, choices=range(1, 10), default=COMPRESS_LEVEL, metavar="1-9",
+                        help=f"zlib level messages are compressed at, 1 the fastest and 9 the smallest (default: {COMPRESS_LEVEL})")
+    parser.add_argument("--ping-interval", type=float, default=PING_INTERVAL,
+                        help=f"seconds of silence before a framed user is pinged, 0 for never (default: {PING_INTERVAL})")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help=f"seconds of silence, pings unanswered, before a framed user is disconnected, 0 for never (default: {IDLE_TIMEOUT})")
+    parser.add_argument("--plain-idle-timeout", type=float, default=PLAIN_IDLE_TIMEOUT,
+                        help="seconds of silence before a plain text user, who cannot be pinged, is disconnected (default: 0, never)")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                        help=f"seconds a message may take to arrive once it has started, 0 for no limit (default: {READ_TIMEOUT})")
+    parser.add_argument("--keepalive", type=float, default=KEEPALIVE,
+                        help=f"seconds of silence before the kernel probes a connection with TCP keepalive, 0 for never (default: {KEEPALIVE})")
+    parser.add_argument("--resume-timeout", type=float, default=RESUME_TIMEOUT,
+                        help=f"seconds a user whose connection dropped has to resume their session, 0 to log them out at once (default: {RESUME_TIMEOUT})")
+    parser.add_argument("--resume-buffer", type=int, default=RESUME_BUFFER,
+                        help=f"messages kept per session for a client to get again when it resumes (default: {RESUME_BUFFER})")
+    parser.add_argument("--presence-window", type=float, default=PRESENCE_WINDOW,
+                        help=f"seconds logins and logouts are gathered for, to tell users of them in one message (default: {PRESENCE_WINDOW})")
+    parser.add_argument("--presence-default", choices=presence_modes, default=NOTICES,
+                        help="what users are told of logins and logouts until they ask with @presence: notices, "
+                             "diffs for clients that keep a user list, or off (default: notices)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port, each with its own engine (default: 1)")
+    parser.add_argument("--cluster", metavar="ADDRESS",
+                        help="join the cluster whose pub/sub broker listens at host:port or a Unix socket path")
+    parser.add_argument("--broker", action="store_true", help="run the cluster's broker in this server, at --cluster")
+    parser.add_argument("--node-id", help="name of this server in the cluster (default: hostname:port)")
+    parser.add_argument("--data-dir", help="directory to save groups in, so they survive a restart (default: keep them in memory)")
+    parser.add_argument("--fsync-interval", type=float, default=FSYNC_INTERVAL,
+                        help=f"seconds between writes of group changes to disk (default: {FSYNC_INTERVAL})")
+    parser.add_argument("--snapshot-every", type=int, default=SNAPSHOT_EVERY,
+                        help=f"group changes logged before they are folded into a snapshot (default: {SNAPSHOT_EVERY})")
+    parser.add_argument("--history-size", type=int, default=HISTORY_SIZE,
+                        help=f"messages kept per group for @group history; 0 keeps none (default: {HISTORY_SIZE})")
+    parser.add_argument("--history-bytes", type=int, default=HISTORY_BYTES,
+                        help=f"bytes of messages kept per group for @group history (default: {HISTORY_BYTES})")
+    parser.add_argument("--mailbox-size", type=int, default=MAILBOX_SIZE,
+                        help=f"messages kept for a user who is offline (default: {MAILBOX_SIZE})")
+    parser.add_argument("--mailbox-ttl", type=float, default=MAILBOX_TTL,
+                        help=f"seconds a message is kept for a user who is offline (default: {MAILBOX_TTL})")
+    parser.add_argument("--mailbox-memory", type=int, default=MAILBOX_MEMORY,
+                        help=f"messages per mailbox kept in memory with --data-dir; the rest go to disk (default: {MAILBOX_MEMORY})")
+    parser.add_argument("--rate-limit", type=parse_limit, action="append", metavar="KIND=RATE/BURST",
+                        help="messages per second and burst a user may send, for KIND message (any), broadcast, "
+                             "personal, group_send or names; a rate of 0 turns the limit off (may be repeated)")
+    parser.add_argument("--ip-rate-factor", type=float, default=IP_FACTOR,
+                        help=f"users from one IP address together get this many times one user's limits; "
+                             f"0 turns the shared limits off (default: {IP_FACTOR})")
+    parser.add_argument("--flood-limit", type=int, default=FLOOD_LIMIT,
+                        help=f"messages a user may have refused in {FLOOD_WINDOW} seconds before being disconnected; "
+                             f"0 never disconnects (default: {FLOOD_LIMIT})")
+    parser.add_argument("--no-rate-limits", action="store_true", help="do not limit how fast users may send")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics over HTTP on this port, at /metrics (Prometheus) and /metrics.json; "
+                             "workers use the ports after it")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address to serve metrics on (default: 127.0.0.1)")
+    parser.add_argument("--metrics-file", help="write metrics as JSON to this file; workers add their number to the name")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help=f"seconds between writes of --metrics-file (default: {METRICS_INTERVAL})")
+    parser.add_argument("--no-metrics", action="store_true", help="record no metrics, for the least overhead")
+    args = parser.parse_args(argv)
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not have")
+    if args.queue_size < 1:
+        parser.error("--queue-size must be at least 1")
+    if args.flush_bytes < 1:
+        parser.error("--flush-bytes must be at least 1")
+    if args.history_bytes < 1:
+        parser.error("--history-bytes must be at least 1")
+    if args.broker and args.cluster is None:
+        parser.error("--broker needs --cluster to say where the broker listens")
+    if args.node_id is None:
+        args.node_id = f"{socket.gethostname()}:{args.port}"
+    return args
+
+
+# Function to run the chosen engine until the server is shut down
+def serve(args, user_names, groups, node=None):
+    if args.engine == "asyncio":
+        asyncio.run(main_async(args, user_names, groups, node))
+    else:
+        main_threaded(args, user_names, groups, node)
 
-                # Welcome message for the new user
-                user_socket.sendall(f"[Welcome {username}!]".encode('utf-8'))
 
-                # Broadcast to other users that a new user has joined
-                broadcast(f"[{username} joined]", user_socket, user_names, is_join_message=True)
-                break
+# Main function to start the server
+def main():
+    args = parse_args()
+    if args.workers > 1:
+        run_supervisor(serve, args)
+        return
+
+    start_metrics(args)
+    log = None if args.data_dir is None else GroupLog(args.data_dir, args.fsync_interval, args.snapshot_every)
+    try:
+        if args.cluster is not None:
+            if args.broker:
+                SocketBroker(args.cluster).start()
+            node, user_names, groups = join_cluster(SocketPubSub(args.cluster, node_will(args.node_id)), args.node_id, log,
+                                                    mailbox_options(args, args.data_dir), history_options(args))
+            print(f"***Joined the cluster at {args.cluster} as {args.node_id}***")
+        else:
+            node, user_names, groups = None, UserRegistry(), GroupStore(**history_options(args))
+            user_names.mailboxes = Mailboxes(user_names, **mailbox_options(args, args.data_dir))
+            if log is not None:
+                log.restore(groups)
+        user_names.sessions = resumable_sessions(args, user_names)
+        user_names.presence = presence_feed(args, user_names)
+        if log is not None:
+            print(f"***Saving groups in {args.data_dir} ({len(groups)} groups)***")
+        serve(args, user_names, groups, node)
+    finally:
+        if log is not None:
+            log.close()
 
-        # Start a new thread to handle communication with the user
-        thread = threading.Thread(target=handle_user, args=(user_socket, user_names, groups))
-        thread.start()
 
 if __name__ == "__main__":
     main()
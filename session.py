@@ -0,0 +1,250 @@
+import collections
+import secrets
+import threading
+import time
+
+from compression import Decompressor
+from heartbeat import TimerWheel
+from metrics import metrics
+from protocol import HELLO, KIND_COMPRESSED, KIND_SESSION, KIND_TEXT, encode_frame, frame_header
+
+# Resumable sessions, so a dropped connection costs a reconnect rather than a
+# new login. A framed client that asks for a session is given a token when it
+# logs in. Every text frame written to it after that is numbered in the
+# order it is written, and the client counts the ones it receives and acks
+# its count now and then. The server keeps the frames the client has not
+# acked yet, up to --resume-buffer of them.
+#
+# When the connection drops, the user is not logged out: they stay in the
+# user list, and messages for them are held, for --resume-timeout seconds.
+# A client that reconnects in that time sends "@resume <token> <count>" in
+# place of a username and takes the session over: it gets every message
+# after the ones it counted, and nobody sees it leave or join. Sessions live
+# in the server the user was connected to; a client that reconnects to
+# another one logs in again. Messages held for a session that expires go to
+# the user's offline mailbox.
+
+# Seconds a dropped session waits to be resumed by default
+RESUME_TIMEOUT = 30
+
+# Unacknowledged messages kept per session by default
+RESUME_BUFFER = 1000
+
+
+# Function to make the session table the command-line options ask for; None
+# if sessions cannot be resumed
+def resumable_sessions(args, user_names):
+    if not args.resume_timeout:
+        return None
+    return Sessions(user_names, args.resume_timeout, args.resume_buffer)
+
+
+# Frame kinds that carry a message, and are numbered
+text_kinds = (KIND_TEXT, KIND_COMPRESSED)
+
+# Inflates held messages that were compressed; the server made them, so
+# their size is not limited
+inflater = Decompressor(0)
+
+
+# Function to get the payloads of the text frames in some written data
+def text_payloads(items):
+    payloads = []
+    for data in items:
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            length, kind = frame_header.unpack_from(view, offset)
+            start = offset + frame_header.size
+            if kind == KIND_TEXT:
+                payloads.append(bytes(view[start:start + length]))
+            elif kind == KIND_COMPRESSED:
+                payloads.append(inflater.decompress(view[start:start + length]))
+            offset = start + length
+    return payloads
+
+
+class Session:
+    __slots__ = ("token", "username", "size", "connection", "lock", "sent", "next_number", "marker", "started",
+                 "held", "lost", "expires")
+
+    def __init__(self, token, username, size, connection):
+        self.token = token
+        self.username = username
+        self.size = size  # Messages kept, acked or held, at most
+        self.connection = connection  # Connection the session is on, or the one it dropped from
+        self.lock = threading.Lock()
+        self.sent = collections.deque()  # Frames written but not acked, oldest first
+        self.next_number = 1   # Number of the next text frame written
+        self.marker = None     # The session frame; numbering starts after it is written
+        self.started = False   # Whether the marker has been written
+        self.held = collections.deque()  # Messages not written yet when the connection dropped, and since
+        self.lost = 0          # Held messages dropped to make room since the session was last taken over
+        self.expires = None    # When a dropped session is given up on; None while connected
+
+    # Function to number the text frames of a batch the connection's writer
+    # is about to write, and keep them until they are acked
+    def taken(self, batch):
+        with self.lock:
+            for data in batch:
+                if not self.started:
+                    # Frames written before the session frame are not numbered
+                    self.started = data is self.marker
+                    continue
+                if data is HELLO:
+                    continue
+                view = memoryview(data)
+                offset = 0
+                while offset < len(view):
+                    length, kind = frame_header.unpack_from(view, offset)
+                    end = offset + frame_header.size + length
+                    if kind in text_kinds:
+                        self.sent.append(data if end - offset == len(view) else view[offset:end])
+                        self.next_number += 1
+                    offset = end
+            # The oldest are most likely received; if not, resuming finds them missing
+            while len(self.sent) > self.size:
+                self.sent.popleft()
+
+    # Function to forget the frames the client says it received
+    def ack(self, count):
+        with self.lock:
+            first = self.next_number - len(self.sent)
+            for _ in range(min(count - first + 1, len(self.sent))):
+                self.sent.popleft()
+
+    # Function to hold a message for the user while they are away
+    def hold(self, data):
+        with self.lock:
+            self.held.append(data)
+            self.trim()
+
+    # Function to hold the messages a dropped connection had not written yet,
+    # ahead of any held since
+    def unsent(self, queued):
+        with self.lock:
+            if self.started:
+                self.held.extendleft(reversed(queued))
+                self.trim()
+
+    def trim(self):
+        while len(self.held) > self.size:
+            self.held.popleft()
+            self.lost += 1
+
+
+class Sessions:
+    def __init__(self, user_names, timeout=RESUME_TIMEOUT, size=RESUME_BUFFER):
+        self.user_names = user_names
+        self.timeout = timeout
+        self.size = size
+        self.lock = threading.Lock()
+        self.sessions = {}  # token -> Session
+        self.wheel = TimerWheel()
+
+    # Function to give a user who just logged in a session, if they asked for one
+    def start(self, connection, username):
+        if not connection.resumable:
+            return
+        token = secrets.token_urlsafe(18)
+        session = Session(token, username, self.size, connection)
+        with self.lock:
+            self.sessions[token] = session
+        with session.lock:
+            marker = self.restart(session, 0)
+        connection.session = session
+        connection.write(marker)
+        metrics.incr("sessions_started")
+
+    # Function to number the text frames written from now on after count.
+    # Returns the session frame to write, which tells the client its token
+    # and where the numbers carry on from. The caller holds the session's lock.
+    def restart(self, session, count):
+        session.marker = encode_frame(f"{session.token} {count} {session.username}".encode('utf-8'), KIND_SESSION)
+        session.started = False
+        session.next_number = count + 1
+        return session.marker
+
+    # Function called when a user's connection drops; keeps the user's place
+    # and returns True if their session can be resumed. on_expire logs them
+    # out if nobody resumes it in time. Users the server disconnects on
+    # purpose are not resumable any more, and their session ends here.
+    def detach(self, connection, on_expire):
+        session = connection.session
+        if session is None or session.expires is not None:
+            return False
+        if not connection.resumable:
+            self.end(connection)
+            return False
+        session.expires = time.monotonic() + self.timeout
+        # Messages still queued are held for the user, ahead of any sent later
+        connection.abort()
+        metrics.incr("sessions_detached")
+        self.wheel.schedule(self.timeout, self.expire, session, on_expire)
+        return True
+
+    # Function run by the wheel once a dropped session may have expired
+    def expire(self, session, on_expire):
+        if session.expires is None or session.connection.session is not session:
+            return  # Resumed, or ended
+        remaining = session.expires - time.monotonic()
+        if remaining > 0:
+            self.wheel.schedule(remaining, self.expire, session, on_expire)
+            return
+        metrics.incr("sessions_expired")
+        self.end(session.connection)
+        on_expire()
+        with session.lock:
+            held = text_payloads(session.held)
+            session.held.clear()
+        # Logged out by now, so these are kept for the next login
+        for payload in held:
+            self.user_names.mailboxes.put([session.username], payload)
+
+    # Function to take a session over on a new connection, in the user list
+    # too. Returns the session, with every message after the count the client
+    # gave queued on the connection, and how many messages were lost; None
+    # if the token is unknown.
+    def resume(self, token, count, connection):
+        with self.lock:
+            session = self.sessions.get(token)
+        if session is None:
+            return None, 0
+        old = session.connection
+        # What the old connection still has queued is held like the rest. It
+        # may not have noticed it dropped yet, or its abort on detaching may
+        # still be waiting for the loop; aborting again collects the queue now.
+        old.abort()
+        with session.lock:
+            if old.session is not session or not self.user_names.replace(old, connection):
+                return None, 0  # Ended in the meantime
+            old.session = None
+            connection.session = session
+            session.connection = connection
+            session.expires = None
+            # What the client counted is acked; the rest is written again,
+            # then whatever was held, numbered on from count
+            first = session.next_number - len(session.sent)
+            count = max(0, min(count, session.next_number - 1))
+            if count < first - 1:
+                session.lost += first - 1 - count
+            missed = list(session.sent)[max(0, count - first + 1):] + list(session.held)
+            session.sent.clear()
+            session.held.clear()
+            lost, session.lost = session.lost, 0
+            marker = self.restart(session, count)
+        connection.write(marker)
+        if missed:
+            # One write, so the queue's limit does not drop any of them
+            connection.write(b''.join(missed))
+        metrics.incr("sessions_resumed")
+        return session, lost
+
+    # Function to end a connection's session, so it cannot be resumed
+    def end(self, connection):
+        session = connection.session
+        if session is None:
+            return
+        connection.session = None
+        with self.lock:
+            self.sessions.pop(session.token, None)
@@ -0,0 +1,338 @@
+import bisect
+import collections
+import threading
+
+from history import HISTORY_BYTES, HISTORY_SIZE, History
+from offline import Mailboxes
+
+
+# Usernames in one page of @names
+NAMES_PAGE = 100
+
+
+# Connected users, indexed both ways so every lookup is O(1), and kept in a
+# sorted list of lowercased names for @names to page through. Usernames are
+# unique ignoring case; lookups by name ignore case too. Changes take the
+# lock; single lookups do not need it.
+class UserRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}        # connection -> username
+        self.connections = {}  # lowercased username -> connection
+        self.sorted = []       # Lowercased usernames, in order
+        self.snapshot = None   # Tuple of every connection, rebuilt after a change
+        self.mailboxes = Mailboxes(self)  # Mail for users who are offline
+        self.sessions = None  # Sessions waiting to be resumed, if users can resume them
+        self.presence = None  # Tells users who joined and left (see presence.py), once serving
+
+    # Function to register a username for a connection; False if the name is taken
+    def claim(self, username, connection):
+        key = username.lower()
+        with self.lock:
+            if key in self.connections:
+                return False
+            self.connections[key] = connection
+            self.names[connection] = username
+            bisect.insort(self.sorted, key)
+            self.snapshot = None
+        if self.presence is not None:
+            self.presence.changed(username, True)
+        return True
+
+    # Function to forget a connection; returns its username, or None if it had none
+    def remove(self, connection):
+        with self.lock:
+            username = self.names.pop(connection, None)
+            if username is not None:
+                key = username.lower()
+                del self.connections[key]
+                del self.sorted[bisect.bisect_left(self.sorted, key)]
+                self.snapshot = None
+        if username is not None and self.presence is not None:
+            self.presence.changed(username, False)
+        return username
+
+    # Function to move a user over to a new connection, as when they resume a
+    # session; False if the old connection is not registered any more
+    def replace(self, connection, new_connection):
+        with self.lock:
+            username = self.names.pop(connection, None)
+            if username is None:
+                return False
+            self.names[new_connection] = username
+            self.connections[username.lower()] = new_connection
+            self.snapshot = None
+            return True
+
+    def connection_for(self, username):
+        return self.connections.get(username.lower())
+
+    # Function to get the spelling a user registered with, or None if nobody has the name
+    def canonical(self, username):
+        connection = self.connections.get(username.lower())
+        return None if connection is None else self.names.get(connection)
+
+    # Function to look many usernames up in one pass; returns the spelling of
+    # each connected user, in order and without repeats, and the names of
+    # nobody connected
+    def resolve(self, usernames):
+        found = {}
+        missing = []
+        for username in usernames:
+            canonical = self.canonical(username)
+            if canonical is None:
+                missing.append(username)
+            else:
+                found[canonical] = None
+        return list(found), missing
+
+    # Function to get every connection for a fan-out. Writers only drop the
+    # snapshot, so readers rebuild it at most once per change.
+    def all_connections(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None:
+                    snapshot = self.snapshot = tuple(self.names)
+        return snapshot
+
+    # Function to get the connections this process serves itself
+    def local_connections(self):
+        return self.all_connections()
+
+    def usernames(self):
+        with self.lock:
+            return list(self.names.values())
+
+    # Function to get up to count usernames, in order, that start with a
+    # prefix and come after a name (or from the first); True as well if
+    # there are more
+    def page(self, prefix="", after=None, count=NAMES_PAGE):
+        prefix = prefix.lower()
+        with self.lock:
+            start = bisect.bisect_left(self.sorted, prefix)
+            if after is not None:
+                start = max(start, bisect.bisect_right(self.sorted, after.lower()))
+            keys = self.sorted[start:start + count + 1]
+            if prefix:
+                keys = [key for key in keys if key.startswith(prefix)]
+            return [self.names[self.connections[key]] for key in keys[:count]], len(keys) > count
+
+    def items(self):
+        with self.lock:
+            return list(self.names.items())
+
+    def get(self, connection, default=None):
+        return self.names.get(connection, default)
+
+    def __getitem__(self, connection):
+        return self.names[connection]
+
+    def __contains__(self, connection):
+        return connection in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+
+# A chat group. Membership is held in an immutable snapshot that changes are
+# swapped in for under the group's lock, so fan-out reads never wait on a
+# writer and always see a consistent view.
+class Group:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.deleted = False
+        self.generation = 0  # Tells a group from an earlier one of the same name, where stores need it
+        self.history = None  # Recent messages, once there are any
+        self.snapshot = (frozenset(), frozenset(), frozenset())  # members, admins, everyone
+
+    @property
+    def members(self):
+        return self.snapshot[0]
+
+    @property
+    def admins(self):
+        return self.snapshot[1]
+
+    # Function to get every member of the group, admins included
+    def everyone(self):
+        return self.snapshot[2]
+
+    # Function to swap in new membership; the caller holds the group's lock
+    def replace(self, members, admins):
+        members = frozenset(members)
+        admins = frozenset(admins)
+        self.snapshot = (members, admins, members | admins)
+
+    def __contains__(self, username):
+        return username in self.snapshot[2]
+
+
+# All groups, plus an index from each user to the groups they belong to.
+# Changes to a group take that group's lock and then, briefly, the store's
+# lock for the index; never the other way round.
+class GroupStore:
+    def __init__(self, history_size=HISTORY_SIZE, history_bytes=HISTORY_BYTES):
+        self.lock = threading.Lock()  # Guards the groups dict and the index
+        self.groups = {}       # group name -> Group
+        self.memberships = {}  # username -> frozenset of the user's group names
+        self.log = None        # On-disk log of changes (see storage.py), if any
+        self.history_size = history_size    # Messages kept per group for @group history; 0 keeps none
+        self.history_bytes = history_bytes  # Bytes kept per group for @group history
+
+    # Function to create a group, with more admins than its creator if given;
+    # None if the name is already taken
+    def create(self, name, admin, members, admins=()):
+        group = Group(name)
+        admins = {admin, *admins}
+        group.replace(set(members) - admins, admins)
+        with self.lock:
+            if name in self.groups:
+                return None
+            # Logged before anyone can find the group and change it
+            self.record("create", name, admin, sorted(group.members), sorted(admins - {admin}))
+            self.groups[name] = group
+            for username in group.everyone():
+                self.index(username, name)
+        return group
+
+    # Function to delete a group; False if it was already gone
+    def delete(self, group):
+        with group.lock:
+            with self.lock:
+                if self.groups.get(group.name) is not group:
+                    return False
+                del self.groups[group.name]
+                for username in group.everyone():
+                    self.unindex(username, group.name)
+                self.record("delete", group.name)
+            group.deleted = True
+        return True
+
+    # Function to add regular members; returns the users that were not in the group yet
+    def add_members(self, group, usernames):
+        with group.lock:
+            if group.deleted:
+                return []
+            added = [username for username in dict.fromkeys(usernames) if username not in group]
+            if added:
+                group.replace(group.members | set(added), group.admins)
+                with self.lock:
+                    for username in added:
+                        self.index(username, group.name)
+                self.record("add_members", group.name, added)
+        return added
+
+    # Function to take users out of a group, whatever their role; returns who was removed
+    def remove_members(self, group, usernames):
+        with group.lock:
+            if group.deleted:
+                return []
+            removed = [username for username in dict.fromkeys(usernames) if username in group]
+            if removed:
+                gone = set(removed)
+                group.replace(group.members - gone, group.admins - gone)
+                with self.lock:
+                    for username in removed:
+                        self.unindex(username, group.name)
+                self.record("remove_members", group.name, removed)
+        return removed
+
+    # Function to make a regular member an admin; False if they are not a regular member
+    def promote(self, group, username):
+        with group.lock:
+            if group.deleted or username not in group.members:
+                return False
+            group.replace(group.members - {username}, group.admins | {username})
+            self.record("promote", group.name, username)
+        return True
+
+    # Function to add, remove and promote users in one change; returns the
+    # users that were added, removed and promoted. Users are removed
+    # whatever their role, and promoted if they are regular members by then.
+    def change_members(self, group, added, removed, promoted):
+        with group.lock:
+            if group.deleted:
+                return [], [], []
+            removed = [username for username in dict.fromkeys(removed) if username in group]
+            added = [username for username in dict.fromkeys(added) if username not in group and username not in removed]
+            members = (group.members | set(added)) - set(removed)
+            promoted = [username for username in dict.fromkeys(promoted) if username in members]
+            if added or removed or promoted:
+                group.replace(members - set(promoted), (group.admins - set(removed)) | set(promoted))
+                with self.lock:
+                    for username in added:
+                        self.index(username, group.name)
+                    for username in removed:
+                        self.unindex(username, group.name)
+                self.record("change_members", group.name, added, removed, promoted)
+        return added, removed, promoted
+
+    # Function to keep a message sent to a group for @group history
+    def add_history(self, group, message):
+        if self.history_size == 0:
+            return
+        with group.lock:
+            if group.deleted:
+                return
+            if group.history is None:
+                group.history = History(self.history_size, self.history_bytes)
+            group.history.append(message)
+
+    # Function to get up to count messages of a group sent before a message
+    # id (or the newest ones), oldest first, and the id of the oldest kept
+    def history_page(self, group, before_id, count):
+        with group.lock:
+            if group.history is None:
+                return [], None
+            return group.history.page(before_id, count), group.history.first_id
+
+    # Function to add saved groups, given as (name, members, admins), without
+    # logging them; returns the new groups. The index is built in one pass,
+    # as adding groups one by one copies each user's set every time.
+    def load_all(self, saved):
+        loaded = []
+        names = collections.defaultdict(set)  # username -> names of the loaded groups they are in
+        for name, members, admins in saved:
+            group = Group(name)
+            group.replace(members, admins)
+            loaded.append(group)
+            for username in group.everyone():
+                names[username].add(name)
+        with self.lock:
+            for group in loaded:
+                self.groups[group.name] = group
+            for username, added in names.items():
+                self.memberships[username] = self.memberships.get(username, frozenset()) | added
+        return loaded
+
+    # Function to pass a change on to the on-disk log, if there is one. Called
+    # under the locks that order the change, so the log keeps that order.
+    def record(self, *change):
+        if self.log is not None:
+            self.log.append(change)
+
+    # The index holds immutable sets too, so groups_of() needs no lock
+    def index(self, username, name):
+        self.memberships[username] = self.memberships.get(username, frozenset()) | {name}
+
+    def unindex(self, username, name):
+        names = self.memberships.get(username, frozenset()) - {name}
+        if names:
+            self.memberships[username] = names
+        else:
+            self.memberships.pop(username, None)
+
+    def groups_of(self, username):
+        return sorted(self.memberships.get(username, ()))
+
+    def get(self, name):
+        return self.groups.get(name)
+
+    def __contains__(self, name):
+        return name in self.groups
+
+    def __len__(self):
+        return len(self.groups)
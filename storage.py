@@ -0,0 +1,213 @@
+import gc
+import json
+import os
+import threading
+
+from state import GroupStore
+
+# Optional on-disk copy of the groups (--data-dir).
+#
+# Every change to the group store is appended to a log. A thread writes the
+# changes that piled up since its last pass and fsyncs once per batch, so a
+# crash loses at most --fsync-interval seconds of changes. Once the log holds
+# --snapshot-every changes, a new log file is started and the old ones are
+# folded into the snapshot on a thread of their own, then deleted. On startup
+# the snapshot is loaded and the log files after it are replayed.
+#
+#   snapshot.json   {"through": N, "groups": [[name, members, admins], ...]}
+#                   covering every log file up to log.N
+#   log.N           one change per line, as a JSON list, oldest first
+
+SNAPSHOT = "snapshot.json"
+
+# Seconds between writes of the log
+FSYNC_INTERVAL = 0.1
+
+# Changes logged before the log is folded into a new snapshot
+SNAPSHOT_EVERY = 100000
+
+
+# Function to make a logged change to a store again, without logging it
+def replay(store, change):
+    op, name, *args = change
+    if op == "create":
+        GroupStore.create(store, name, *args)
+        return
+    group = store.get(name)
+    if group is not None:
+        getattr(GroupStore, op)(store, group, *args)
+
+
+class GroupLog:
+    def __init__(self, directory, fsync_interval=FSYNC_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.pending = []  # Changes not written yet
+        self.pending_changed = threading.Condition()
+        self.stopped = threading.Event()
+        self.file = None
+        self.segment = 0   # Number of the log file being written
+        self.written = 0   # Changes logged since the last snapshot was started
+        self.compacting = threading.Lock()  # Held while a snapshot is written
+        self.writer = threading.Thread(target=self.write_pending, daemon=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # Function to get the numbers of the log files, oldest first
+    def segments(self):
+        return sorted(int(name[4:]) for name in os.listdir(self.directory) if name.startswith("log.") and name[4:].isdigit())
+
+    # Function to fill a store from the snapshot and the log files after it,
+    # up to log.through if given; returns the snapshot's number and the
+    # count of changes replayed
+    def load_into(self, store, through=None):
+        # Loading makes millions of objects and no garbage, so collecting
+        # while it runs only slows it down
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            try:
+                with open(self.path(SNAPSHOT), encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except FileNotFoundError:
+                snapshot = {"through": 0, "groups": []}
+            store.load_all(snapshot["groups"])
+
+            changes = 0
+            for segment in self.segments():
+                if segment <= snapshot["through"] or (through is not None and segment > through):
+                    continue
+                with open(self.path(f"log.{segment}"), encoding='utf-8') as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break  # Cut short by a crash
+                        replay(store, json.loads(line))
+                        changes += 1
+        finally:
+            if collecting:
+                gc.enable()
+        return snapshot["through"], changes
+
+    # Function to load the saved groups into an empty store and log its changes from now on
+    def restore(self, store):
+        through, self.written = self.load_into(store)
+        self.open_segment(max(self.segments(), default=through) + 1)
+        self.start(store)
+
+    # Function to save a store's groups in place of whatever was saved
+    # before and log its changes from now on
+    def reset(self, store):
+        through = max(self.segments(), default=0)
+        with self.compacting:
+            self.write_snapshot(through, store)
+            self.remove_segments(through)
+        self.open_segment(through + 1)
+        self.written = 0
+        self.start(store)
+
+    def start(self, store):
+        self.writer.start()
+        store.log = self
+
+    # Function called by the store, under its locks, for every change
+    def append(self, change):
+        with self.pending_changed:
+            self.pending.append(change)
+            self.pending_changed.notify()
+
+    # Function run by the writer thread until the log is closed
+    def write_pending(self):
+        while True:
+            with self.pending_changed:
+                while not self.pending and not self.stopped.is_set():
+                    self.pending_changed.wait()
+                changes = self.pending
+                self.pending = []
+            if changes:
+                try:
+                    self.file.write("".join(json.dumps(change) + "\n" for change in changes))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except OSError as e:
+                    print(f"Error writing the group log: {e}")
+                self.written += len(changes)
+                if self.written >= self.snapshot_every and not self.stopped.is_set():
+                    self.start_compaction()
+            # Stop once closed and everything appended has been written
+            with self.pending_changed:
+                if self.stopped.is_set() and not self.pending:
+                    break
+            # Let the next batch pile up
+            self.stopped.wait(self.fsync_interval)
+
+    # Function to start a new log file and fold the old ones into a snapshot
+    def start_compaction(self):
+        if not self.compacting.acquire(blocking=False):
+            return  # The last one is still running; try again after the next batch
+        through = self.segment
+        self.open_segment(through + 1)
+        self.written = 0
+        threading.Thread(target=self.compact, args=(through,), daemon=True).start()
+
+    # Function run on a thread of its own; builds the snapshot from the files,
+    # not from the live groups, so it matches the log exactly
+    def compact(self, through):
+        try:
+            store = GroupStore()
+            self.load_into(store, through)
+            self.write_snapshot(through, store)
+            self.remove_segments(through)
+        except OSError as e:
+            print(f"Error writing a group snapshot: {e}")
+        finally:
+            self.compacting.release()
+
+    def write_snapshot(self, through, store):
+        groups = [[group.name, sorted(group.members), sorted(group.admins)] for group in list(store.groups.values())]
+        temporary = self.path(SNAPSHOT + ".tmp")
+        with open(temporary, "w", encoding='utf-8') as f:
+            json.dump({"through": through, "groups": groups}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path(SNAPSHOT))
+        self.sync_directory()
+
+    def remove_segments(self, through):
+        for segment in self.segments():
+            if segment <= through:
+                os.remove(self.path(f"log.{segment}"))
+
+    def open_segment(self, segment):
+        if self.file is not None:
+            self.file.close()
+        self.segment = segment
+        self.file = open(self.path(f"log.{segment}"), "a", encoding='utf-8')
+        self.sync_directory()
+
+    # Function to make new and renamed files survive a crash, where the
+    # platform allows it
+    def sync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    # Function to write what is left and wait for a snapshot in progress
+    def close(self):
+        self.stopped.set()
+        with self.pending_changed:
+            self.pending_changed.notify()
+        if self.writer.is_alive():
+            self.writer.join()
+        with self.compacting:
+            if self.file is not None:
+                self.file.close()
@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from cluster import join_cluster, node_topic, node_will
+from history import history_options
+from metrics import start_metrics
+from offline import mailbox_options
+from presence import presence_feed
+from pubsub import SocketBroker, SocketPubSub
+from session import resumable_sessions
+from storage import GroupLog
+
+# Multi-process mode (--workers N).
+#
+# The supervisor forks N workers that all listen on the same port with
+# SO_REUSEPORT, so the kernel spreads connections over them. The workers are
+# nodes of a cluster (see cluster.py): each one serves its own connections
+# and keeps a copy of the users and groups that every other worker keeps in
+# step. Unless --cluster names a broker to use, the supervisor runs one on a
+# Unix socket for them. With --data-dir, worker 0 saves the groups and joins
+# first, so it is the one that restores them.
+
+
+# Function to get the node id of one of the workers
+def worker_id(args, worker):
+    return f"{args.node_id}/{worker}"
+
+
+# Function run in each forked worker
+def run_worker(serve, args, address, worker, first_joined):
+    node_id = worker_id(args, worker)
+    start_metrics(args, worker)
+    log = None
+    if worker == 0 and args.data_dir is not None:
+        log = GroupLog(args.data_dir, args.fsync_interval, args.snapshot_every)
+    elif args.data_dir is not None:
+        first_joined.wait()
+    try:
+        node, user_names, groups = join_cluster(SocketPubSub(address, node_will(node_id)), node_id, log,
+                                                mailbox_options(args, args.data_dir if log is not None else None),
+                                                history_options(args))
+        first_joined.set()
+        user_names.sessions = resumable_sessions(args, user_names)
+        user_names.presence = presence_feed(args, user_names)
+        serve(args, user_names, groups, node)
+    finally:
+        if log is not None:
+            log.close()
+
+
+# Function to fork the workers and pass console commands on to them until @quit
+def run_supervisor(serve, args):
+    directory = None
+    broker = None
+    address = args.cluster
+    if address is None:
+        directory = tempfile.mkdtemp(prefix="chat-")
+        address = os.path.join(directory, "broker.sock")
+        broker = SocketBroker(address)
+    elif args.broker:
+        broker = SocketBroker(address)
+
+    # Fork before the broker starts any threads
+    context = multiprocessing.get_context("fork")
+    first_joined = context.Event()
+    processes = [context.Process(target=run_worker, args=(serve, args, address, worker, first_joined))
+                 for worker in range(args.workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        if broker is not None:
+            broker.start()
+        commands = SocketPubSub(address)
+        print(f"***{args.workers} workers listening on {args.host}:{args.port}***")
+        while True:
+            try:
+                command = input("Server command: ").strip().lower()
+            except EOFError:
+                command = "@quit"
+            if command in ("@quit", "@stats"):
+                for worker in range(args.workers):
+                    commands.publish(node_topic(worker_id(args, worker)), {"op": "command", "command": command})
+            if command == "@quit":
+                break
+        for process in processes:
+            process.join(timeout=10)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)